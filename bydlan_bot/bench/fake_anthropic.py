@@ -0,0 +1,137 @@
+import asyncio
+import dataclasses
+import json
+import typing
+
+
+@dataclasses.dataclass
+class FakeAnthropicConfig:
+    # Time before the response (or the first stream event) is sent
+    latency_seconds: float = 0.2
+    # Length of every response text
+    response_chars: int = 300
+    # Streamed responses are sent in this many text deltas, evenly spread over `stream_seconds`
+    stream_deltas: int = 10
+    stream_seconds: float = 0.5
+    # Draws `(latency_seconds, response_chars)` for every request instead of the fixed values above
+    sample: typing.Optional[typing.Callable[[], typing.Tuple[float, int]]] = None
+
+
+class FakeAnthropicServer:
+    """
+    A local HTTP server speaking just enough of the Messages API (https://docs.anthropic.com/en/api/messages) for
+    `AsyncAnthropic` to work against it: plain and streamed (SSE) `POST /v1/messages`.
+    """
+
+    def __init__(self, config: FakeAnthropicConfig):
+        self.config = config
+        self.requests = 0
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+        self._writers: typing.Set[asyncio.StreamWriter] = set()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, "127.0.0.1", 0)
+
+    async def stop(self):
+        self._server.close()
+        # let keep-alive connections finish quietly instead of being cancelled
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.sleep(0)
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                method, request = await self._read_request(reader)
+                if request is None:
+                    break
+                if method != "POST":
+                    # e.g. connection warm-up requests
+                    writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                    await writer.drain()
+                    continue
+                self.requests += 1
+                if request.get("stream"):
+                    await self._write_stream(writer, request)
+                    break
+                await self._write_message(writer, request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> typing.Tuple[str, typing.Optional[dict]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return "", None
+        lines = head.decode("latin-1").split("\r\n")
+        content_length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value.strip())
+        body = await reader.readexactly(content_length)
+        return lines[0].split(" ", 1)[0], json.loads(body) if body else {}
+
+    def _draw(self) -> typing.Tuple[float, int]:
+        if self.config.sample is not None:
+            return self.config.sample()
+        return self.config.latency_seconds, self.config.response_chars
+
+    @staticmethod
+    def _response_text(chars: int) -> str:
+        sentence = "Слышь, ну это база, ёбана. "
+        return (sentence * (chars // len(sentence) + 1))[:chars]
+
+    def _message(self, request: dict, text: str) -> dict:
+        input_chars = sum(len(json.dumps(m, ensure_ascii=False)) for m in request.get("messages", []))
+        return {
+            "id": f"msg_bench_{self.requests}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model", "bench"),
+            "content": [{"type": "text", "text": text}] if text else [],
+            "stop_reason": "end_turn" if text else None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_chars // 4, "output_tokens": len(text) // 4},
+        }
+
+    async def _write_message(self, writer: asyncio.StreamWriter, request: dict):
+        latency_seconds, response_chars = self._draw()
+        await asyncio.sleep(latency_seconds)
+        body = json.dumps(self._message(request, self._response_text(response_chars))).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _write_stream(self, writer: asyncio.StreamWriter, request: dict):
+        async def event(name: str, data: dict):
+            writer.write(f"event: {name}\ndata: {json.dumps(dict(type=name, **data))}\n\n".encode())
+            await writer.drain()
+
+        latency_seconds, response_chars = self._draw()
+        await asyncio.sleep(latency_seconds)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        text = self._response_text(response_chars)
+        message = self._message(request, "")
+        await event("message_start", {"message": message})
+        await event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        delta_size = max(1, len(text) // self.config.stream_deltas + 1)
+        for i in range(0, len(text), delta_size):
+            await asyncio.sleep(self.config.stream_seconds / self.config.stream_deltas)
+            await event("content_block_delta", {"index": 0, "delta": {"type": "text_delta",
+                                                                     "text": text[i:i + delta_size]}})
+        await event("content_block_stop", {"index": 0})
+        await event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": len(text) // 4}})
+        await event("message_stop", {})
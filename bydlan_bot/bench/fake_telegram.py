@@ -0,0 +1,144 @@
+import asyncio
+import dataclasses
+import itertools
+import time
+import typing
+
+
+_USER_IDS = itertools.count(1)
+
+
+@dataclasses.dataclass
+class FakeUser:
+    first_name: typing.Optional[str]
+    username: typing.Optional[str] = None
+    id: int = dataclasses.field(default_factory=lambda: next(_USER_IDS))
+
+
+@dataclasses.dataclass
+class FakeChat:
+    id: int
+
+
+class FakeMessage:
+    """
+    Mimics the parts of `pyrogram.types.Message` the bot uses. Like pyrogram, `reply_to_message` is only parsed one
+    level deep: see `FakeTelegram.parsed`.
+    """
+
+    def __init__(self, telegram: "FakeTelegram", chat_id: int, message_id: int, text: typing.Optional[str],
+                 from_user: typing.Optional[FakeUser], reply_to_message_id: typing.Optional[int]):
+        self._telegram = telegram
+        self.chat = FakeChat(id=chat_id)
+        self.id = message_id
+        self.text = text
+        self.from_user = from_user
+        self.reply_to_message_id = reply_to_message_id
+        self.reply_to_message: typing.Optional["FakeMessage"] = None
+        self.empty = False
+        # Monotonic time and id of every reply sent to this message (by the bot)
+        self.reply_times: typing.List[float] = []
+        self.reply_ids: typing.List[int] = []
+
+    async def reply(self, text: str, reply_to_message_id: typing.Optional[int] = None, **_) -> "FakeMessage":
+        return await self._telegram.send(self.chat.id, text, self._telegram.bot,
+                                         reply_to_message_id or self.id)
+
+    async def edit_text(self, text: str, **_) -> "FakeMessage":
+        await asyncio.sleep(self._telegram.latency_seconds)
+        self._telegram.edits += 1
+        self._telegram.get(self.chat.id, self.id).text = text
+        return self._telegram.parsed(self.chat.id, self.id)
+
+    async def delete(self, **_) -> bool:
+        await asyncio.sleep(self._telegram.latency_seconds)
+        self._telegram.deletes += 1
+        return self._telegram.delete(self.chat.id, self.id)
+
+
+class FakeTelegram:
+    """
+    In-memory Telegram: keeps every message per chat and serves them to the bot through `client`.
+    """
+
+    def __init__(self, bot_username: str, latency_seconds: float = 0.05):
+        self.bot = FakeUser(first_name="Быдлан", username=bot_username)
+        self.latency_seconds = latency_seconds
+        self.client = FakeClient(self)
+        self.sent = 0
+        self.edits = 0
+        self.deletes = 0
+        self._messages: typing.Dict[typing.Tuple[int, int], FakeMessage] = {}
+        self._ids = itertools.count(1)
+
+    def post(self, chat_id: int, text: str, author: FakeUser,
+             reply_to_message_id: typing.Optional[int] = None) -> FakeMessage:
+        """
+        Stores a message written by a user, returns it the way pyrogram would pass it to a handler.
+        """
+        message = FakeMessage(self, chat_id, next(self._ids), text, author, reply_to_message_id)
+        self._messages[(chat_id, message.id)] = message
+        return self.parsed(chat_id, message.id)
+
+    async def send(self, chat_id: int, text: str, author: FakeUser, reply_to_message_id: int) -> FakeMessage:
+        await asyncio.sleep(self.latency_seconds)
+        self.sent += 1
+        message = self.post(chat_id, text, author, reply_to_message_id)
+        replied = self._messages.get((chat_id, reply_to_message_id))
+        if replied is not None:
+            replied.reply_times.append(time.monotonic())
+            replied.reply_ids.append(message.id)
+        return message
+
+    def delete(self, chat_id: int, message_id: int) -> bool:
+        message = self._messages.pop((chat_id, message_id), None)
+        if message is None:
+            return False
+        replied = self._messages.get((chat_id, message.reply_to_message_id))
+        if replied is not None and message_id in replied.reply_ids:
+            i = replied.reply_ids.index(message_id)
+            del replied.reply_ids[i], replied.reply_times[i]
+        return True
+
+    def last_reply(self, chat_id: int, message_id: int) -> typing.Optional[int]:
+        """
+        Returns the id of the last part of the bot's (possibly split) reply to the message.
+        """
+        last_id = None
+        message = self._messages.get((chat_id, message_id))
+        while message is not None and message.reply_ids:
+            last_id = message.reply_ids[-1]
+            message = self._messages.get((chat_id, last_id))
+        return last_id
+
+    def get(self, chat_id: int, message_id: int) -> typing.Optional[FakeMessage]:
+        return self._messages.get((chat_id, message_id))
+
+    def parsed(self, chat_id: int, message_id: int, replies: int = 1) -> typing.Optional[FakeMessage]:
+        """
+        Returns a copy of the stored message with `replies` levels of replied-to messages attached.
+        """
+        stored = self._messages.get((chat_id, message_id))
+        if stored is None:
+            return None
+        message = FakeMessage(self, chat_id, stored.id, stored.text, stored.from_user, stored.reply_to_message_id)
+        if replies > 0 and stored.reply_to_message_id:
+            message.reply_to_message = self.parsed(chat_id, stored.reply_to_message_id, replies - 1)
+        return message
+
+
+class FakeClient:
+    """
+    Mimics the parts of `pyrogram.Client` the bot uses.
+    """
+
+    def __init__(self, telegram: FakeTelegram):
+        self._telegram = telegram
+        self.get_messages_calls = 0
+
+    async def get_messages(self, chat_id: int, message_ids: typing.Union[int, typing.Iterable[int]], replies: int = 1):
+        await asyncio.sleep(self._telegram.latency_seconds)
+        self.get_messages_calls += 1
+        if isinstance(message_ids, int):
+            return self._telegram.parsed(chat_id, message_ids, replies)
+        return [m for m in (self._telegram.parsed(chat_id, i, replies) for i in message_ids) if m is not None]
@@ -0,0 +1,185 @@
+"""
+Replays a traffic trace recorded by the bot (see `BYDLAN_TRACE_PATH` and `metrics.trace.TraceRecorder`) through
+`bydlan.handle_group_message`, against the same fake Telegram and Anthropic as `bench.run`.
+
+Messages arrive in the recorded order, with the recorded gaps divided by `--speed`. Texts are filler of the recorded
+length, API latencies and response lengths are taken from the recorded completions, in order. API latency is not
+scaled, so a sped up replay puts more replies in flight at once than production did. Production scheduler limits,
+chat quotas and Telegram rate limits apply unless `--no-limits` is given.
+
+Run from the `bydlan_bot` directory:
+    python -m bench.replay trace.jsonl.gz [--speed 10] [--streaming] [--no-limits]
+"""
+import argparse
+import asyncio
+import collections
+import random
+import time
+import typing
+
+import structlog
+from anthropic import AsyncAnthropic
+
+import bydlan
+from bench.fake_anthropic import FakeAnthropicConfig, FakeAnthropicServer
+from bench.fake_telegram import FakeMessage, FakeUser
+from bench.run import Bench, reset_bot_state
+from bench.stats import print_report, summarize
+from metrics.trace import TRACE_VERSION, read_trace
+from realm.anthropic import api as anthropic_api
+
+MIN_SPEED = 1
+MAX_SPEED = 100
+
+_FILLER = "ну и чё ты мне тут "
+
+# Recorded trigger kinds, see `TraceRecorder`
+_PREFIX_TRIGGER = 1
+_REPLY_TRIGGER = 2
+
+
+class Trace:
+    def __init__(self, events: typing.Iterable[dict]):
+        self.messages: typing.List[dict] = []
+        self.completions: typing.List[dict] = []
+        # (chat, id of a message sent by the bot) -> id of the message it replied to
+        self.sent_parents: typing.Dict[typing.Tuple[int, int], int] = {}
+        headers = 0
+        for event in events:
+            kind = event["k"]
+            if kind == "h":
+                headers += 1
+                if event["v"] != TRACE_VERSION:
+                    raise ValueError(f"unsupported trace version {event['v']}")
+                # older bots appended every run to the same file, with its own clock and chat hashes
+                if headers > 1:
+                    raise ValueError("the trace holds several recordings, replay one at a time")
+            elif kind == "m":
+                self.messages.append(event)
+            elif kind == "a":
+                self.completions.append(event)
+            elif kind == "s" and event["r"] is not None:
+                self.sent_parents[(event["c"], event["m"])] = event["r"]
+
+
+class Replayer:
+    """
+    Maps recorded ids to the ids of the fake Telegram. Messages written by the bot are not replayed, the bot writes
+    them again: a recorded bot message maps to the reply the replayed bot sent to the same parent, if it already did.
+    """
+
+    def __init__(self, bench: Bench, trace: Trace):
+        self._bench = bench
+        self._trace = trace
+        self._posted: typing.Dict[typing.Tuple[int, int], int] = {}
+        self._users: typing.Dict[int, FakeUser] = {}
+        self.triggers: typing.List[FakeMessage] = []
+        # replies to bot messages the replayed bot hasn't sent (yet), posted as prefix triggers instead
+        self.unresolved_replies = 0
+
+    def _resolve(self, chat: int, recorded_id: typing.Optional[int]) -> typing.Optional[int]:
+        if recorded_id is None:
+            return None
+        posted_id = self._posted.get((chat, recorded_id))
+        if posted_id is not None:
+            return posted_id
+        parent_id = self._resolve(chat, self._trace.sent_parents.get((chat, recorded_id)))
+        parent = self._bench.telegram.get(-chat, parent_id) if parent_id is not None else None
+        return parent.reply_ids[0] if parent is not None and parent.reply_ids else None
+
+    def _user(self, recorded_user: typing.Optional[int]) -> FakeUser:
+        if recorded_user not in self._users:
+            self._users[recorded_user] = FakeUser(first_name=f"юзер{len(self._users) + 1}")
+        return self._users[recorded_user]
+
+    async def post(self, event: dict):
+        chat = event["c"]
+        reply_to = self._resolve(chat, event["r"])
+        prefix = ""
+        if event["tr"] == _PREFIX_TRIGGER or (event["tr"] == _REPLY_TRIGGER and reply_to is None):
+            if event["tr"] == _REPLY_TRIGGER:
+                self.unresolved_replies += 1
+            prefix = bydlan.BYDLAN_PREFIX + " "
+        length = max(event["l"] - len(prefix), 0)
+        text = prefix + (_FILLER * (length // len(_FILLER) + 1))[:length]
+
+        # chat ids are hashes, negative like the ids of groups
+        message = self._bench.telegram.post(-chat, text, self._user(event["u"]), reply_to)
+        self._posted[(chat, event["m"])] = message.id
+        if event["tr"]:
+            message.triggered_at = time.monotonic()
+            self.triggers.append(message)
+        await self._bench.receive(message)
+
+
+def completion_sampler(completions: typing.List[dict]) -> typing.Callable[[], typing.Tuple[float, int]]:
+    """
+    Returns recorded completions in order, then random ones once the replay asks for more than were recorded.
+    """
+    recorded = collections.deque(completions)
+
+    def sample() -> typing.Tuple[float, int]:
+        completion = recorded.popleft() if recorded else random.choice(completions)
+        return completion["lat"], completion["n"]
+
+    return sample
+
+
+async def replay(bench: Bench, trace: Trace, speed: float) -> Replayer:
+    replayer = Replayer(bench, trace)
+    started_at = time.monotonic()
+    for event in trace.messages:
+        delay = started_at + event["t"] / 1000 / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await replayer.post(event)
+    while bydlan._PENDING_BURSTS:
+        await asyncio.sleep(0.01)
+    await bench.drain()
+    return replayer
+
+
+async def main(args: argparse.Namespace):
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(40))
+    if not MIN_SPEED <= args.speed <= MAX_SPEED:
+        raise ValueError(f"speed must be within {MIN_SPEED}..{MAX_SPEED}")
+
+    trace = Trace(read_trace(args.trace))
+    if not trace.completions:
+        raise ValueError("the trace has no completions to take API latencies from")
+
+    # the limits configured for production, before they are lifted for benchmarks
+    scheduler, outbox, quotas = bydlan._SCHEDULER, bydlan._OUTBOX, bydlan._QUOTAS
+    reset_bot_state(streaming=args.streaming)
+    if not args.no_limits:
+        bydlan._SCHEDULER, bydlan._OUTBOX, bydlan._QUOTAS = scheduler, outbox, quotas
+
+    server = FakeAnthropicServer(FakeAnthropicConfig(stream_seconds=0, sample=completion_sampler(trace.completions)))
+    await server.start()
+    anthropic_api._CLIENT = AsyncAnthropic(api_key="bench", base_url=server.base_url, max_retries=0)
+    bench = Bench(server, tg_latency=args.tg_latency)
+
+    started_at = time.monotonic()
+    replayer = await replay(bench, trace, args.speed)
+    elapsed = time.monotonic() - started_at
+    await server.stop()
+
+    answered = [t for t in replayer.triggers if bench.telegram.get(t.chat.id, t.id).reply_times]
+    scheduler_stats = bydlan._SCHEDULER.stats()
+    print_report([summarize(f"replay_x{args.speed:g}", [bench.latency(t) for t in answered], elapsed,
+                            messages=len(trace.messages), unanswered=len(replayer.triggers) - len(answered),
+                            unresolved_replies=replayer.unresolved_replies, api_requests=server.requests,
+                            tg_sent=bench.telegram.sent,
+                            queue_wait_p95_ms=round(scheduler_stats.wait_p95_seconds * 1000, 1))],
+                 unit="reply")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="trace file recorded with BYDLAN_TRACE_PATH")
+    parser.add_argument("--speed", type=float, default=1, help=f"replay speed, {MIN_SPEED}..{MAX_SPEED}")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="fake Telegram request latency, seconds")
+    parser.add_argument("--streaming", action="store_true", help="stream replies")
+    parser.add_argument("--no-limits", action="store_true",
+                        help="lift scheduler and Telegram rate limits, like `bench.run` does")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,197 @@
+"""
+Offline benchmarks of `bydlan.handle_group_message`.
+
+Drives the real handler with a fake Telegram (`bench.fake_telegram`) and a local fake Anthropic HTTP server
+(`bench.fake_anthropic`), so no live services are touched. Latency is measured from the moment a trigger message is
+handed to the handler to the moment the first reply to it is sent (time to first visible reply).
+
+Run from the `bydlan_bot` directory:
+    python -m bench.run [--api-latency 0.2] [--tg-latency 0.05] [--quick]
+"""
+import argparse
+import asyncio
+import time
+import typing
+
+import structlog
+from anthropic import AsyncAnthropic
+
+import bydlan
+from bench.fake_anthropic import FakeAnthropicConfig, FakeAnthropicServer
+from bench.fake_telegram import FakeMessage, FakeTelegram, FakeUser
+from bench.stats import BenchResult, print_report, summarize
+from db.conversations import MemoryConversationStore
+from realm.anthropic import api as anthropic_api
+from realm.anthropic.api import MIN_ANSWER_TOKENS
+from realm.anthropic.quotas import ChatQuotas
+from realm.anthropic.scheduler import CompletionScheduler
+from realm.telegram.message_index import MessageIndex
+from realm.telegram.outbox import Outbox
+
+BOT_USERNAME = "bydlan_bench_bot"
+
+USERS = [FakeUser(first_name="Вася", username="vasya"), FakeUser(first_name="Петя", username="petya"),
+         FakeUser(first_name="Серый", username="seryi")]
+
+
+class Bench:
+    def __init__(self, server: FakeAnthropicServer, tg_latency: float):
+        self.server = server
+        self.telegram = FakeTelegram(BOT_USERNAME, latency_seconds=tg_latency)
+        self._chat_ids = iter(range(-1000, -10 ** 9, -1))
+
+    def new_chat(self) -> int:
+        return next(self._chat_ids)
+
+    async def receive(self, message: FakeMessage):
+        """
+        Passes a message to the bot the same way pyrogram does: through every registered handler group.
+        """
+        await bydlan.index_group_message(self.telegram.client, message)
+        if await bydlan.bydlan_triggers(self.telegram.client, message):
+            await bydlan.handle_group_message(self.telegram.client, message)
+
+    def post_chain(self, chat_id: int, depth: int) -> typing.List[FakeMessage]:
+        chain = []
+        reply_to = None
+        for i in range(depth):
+            if i % 3 == 2:
+                message = self.telegram.post(chat_id, f"ответ бота {i}", self.telegram.bot, reply_to)
+            else:
+                message = self.telegram.post(chat_id, f"сообщение {i} в треде", USERS[i % len(USERS)], reply_to)
+            chain.append(message)
+            reply_to = message.id
+        return chain
+
+    async def trigger(self, chat_id: int, text: str, reply_to: typing.Optional[int] = None) -> FakeMessage:
+        message = self.telegram.post(chat_id, text, USERS[0], reply_to)
+        message.triggered_at = time.monotonic()
+        await self.receive(message)
+        return message
+
+    async def drain(self):
+        while True:
+            stats = bydlan._SCHEDULER.stats()
+            if stats.queued == 0 and stats.in_flight == 0:
+                return
+            await asyncio.sleep(0.005)
+
+    def latency(self, message: FakeMessage) -> float:
+        stored = self.telegram.get(message.chat.id, message.id)
+        if not stored.reply_times:
+            raise RuntimeError(f"message {message.id} got no reply")
+        return stored.reply_times[0] - message.triggered_at
+
+
+def reset_bot_state(streaming: bool = False):
+    """
+    Gives the bot a clean state between scenarios. Outgoing rate limits and chat quotas are lifted, otherwise
+    Telegram limits (20 messages per minute per group) dominate every number.
+    """
+    bydlan.BYDLAN_USERNAME = BOT_USERNAME
+    bydlan.STREAM_REPLIES = streaming
+    bydlan.STREAM_EDIT_INTERVAL_SECONDS = 0.1
+    bydlan._CONVERSATIONS = MemoryConversationStore(max_bytes=256 * 1024 * 1024, ttl_seconds=3600,
+                                                    max_entries_per_chat=10_000, max_bytes_per_chat=64 * 1024 * 1024)
+    bydlan._MESSAGE_INDEX = MessageIndex(maxsize=100_000)
+    bydlan._QUOTAS = ChatQuotas(tokens_per_minute=0, requests_per_minute=0, min_output_tokens=MIN_ANSWER_TOKENS)
+    bydlan._SCHEDULER = CompletionScheduler(max_in_flight=4, max_queued_per_chat=1000)
+    bydlan._OUTBOX = Outbox(global_rate=10_000, per_chat_rate=10_000, per_chat_burst=10_000)
+
+
+async def scenario_deep_chain(bench: Bench, name: str, depth: int, count: int, indexed: bool) -> BenchResult:
+    reset_bot_state()
+    calls_before = bench.telegram.client.get_messages_calls
+    latencies = []
+    started_at = time.monotonic()
+    for _ in range(count):
+        chat_id = bench.new_chat()
+        chain = bench.post_chain(chat_id, depth)
+        if indexed:
+            for message in chain:
+                await bydlan.index_group_message(bench.telegram.client, message)
+        trigger = await bench.trigger(chat_id, "быдлан что думаешь?", chain[-1].id)
+        await bench.drain()
+        latencies.append(bench.latency(trigger))
+    return summarize(name, latencies, time.monotonic() - started_at,
+                     tg_fetches=bench.telegram.client.get_messages_calls - calls_before)
+
+
+async def scenario_cache_hits(bench: Bench, count: int) -> BenchResult:
+    reset_bot_state()
+    chat_id = bench.new_chat()
+    trigger = await bench.trigger(chat_id, "быдлан привет")
+    await bench.drain()
+    latencies = []
+    started_at = time.monotonic()
+    for i in range(count):
+        trigger = await bench.trigger(chat_id, f"а дальше? {i}", bench.telegram.last_reply(chat_id, trigger.id))
+        await bench.drain()
+        latencies.append(bench.latency(trigger))
+    stats = bydlan._CONVERSATIONS.stats()
+    return summarize("cache_hits", latencies, time.monotonic() - started_at, store_hits=stats.hits,
+                     store_misses=stats.misses)
+
+
+async def scenario_long_replies(bench: Bench, count: int, streaming: bool) -> BenchResult:
+    reset_bot_state(streaming=streaming)
+    sent_before = bench.telegram.sent
+    response_chars = bench.server.config.response_chars
+    bench.server.config.response_chars = 10_000
+    try:
+        latencies = []
+        started_at = time.monotonic()
+        for _ in range(count):
+            trigger = await bench.trigger(bench.new_chat(), "быдлан расскажи подробно")
+            await bench.drain()
+            latencies.append(bench.latency(trigger))
+    finally:
+        bench.server.config.response_chars = response_chars
+    return summarize("long_split_replies" + ("_streamed" if streaming else ""), latencies,
+                     time.monotonic() - started_at, tg_sent=bench.telegram.sent - sent_before,
+                     tg_edits=bench.telegram.edits)
+
+
+async def scenario_concurrent_chats(bench: Bench, chats: int, per_chat: int) -> BenchResult:
+    reset_bot_state()
+    requests_before = bench.server.requests
+    chat_ids = [bench.new_chat() for _ in range(chats)]
+    started_at = time.monotonic()
+    triggers = []
+    for i in range(per_chat):
+        for chat_id in chat_ids:
+            triggers.append(await bench.trigger(chat_id, f"быдлан вопрос {i}"))
+    await bench.drain()
+    scheduler = bydlan._SCHEDULER.stats()
+    return summarize(f"concurrent_{chats}x{per_chat}", [bench.latency(t) for t in triggers],
+                     time.monotonic() - started_at, api_requests=bench.server.requests - requests_before,
+                     queue_wait_p95_ms=round(scheduler.wait_p95_seconds * 1000, 1))
+
+
+async def main(args: argparse.Namespace):
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(40))
+
+    server = FakeAnthropicServer(FakeAnthropicConfig(latency_seconds=args.api_latency))
+    await server.start()
+    anthropic_api._CLIENT = AsyncAnthropic(api_key="bench", base_url=server.base_url, max_retries=0)
+    bench = Bench(server, tg_latency=args.tg_latency)
+    scale = 1 if args.quick else 4
+
+    results = [
+        await scenario_deep_chain(bench, "deep_chain_cold", depth=30, count=scale, indexed=False),
+        await scenario_deep_chain(bench, "deep_chain_indexed", depth=30, count=2 * scale, indexed=True),
+        await scenario_cache_hits(bench, count=5 * scale),
+        await scenario_long_replies(bench, count=scale, streaming=False),
+        await scenario_long_replies(bench, count=scale, streaming=True),
+        await scenario_concurrent_chats(bench, chats=10 * scale, per_chat=3),
+    ]
+    await server.stop()
+    print_report(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-latency", type=float, default=0.2, help="fake Anthropic response latency, seconds")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="fake Telegram request latency, seconds")
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,80 @@
+"""
+Microbenchmark of building the API payload of a conversation on every turn: re-dumping every Pydantic message
+(`[m.dict() for m in messages]`, as it used to be done) vs reusing cached wire representations (`to_wire`).
+
+Run from the `bydlan_bot` directory:
+    python -m bench.serialization [--turns 200]
+"""
+import argparse
+import time
+import tracemalloc
+import typing
+import warnings
+
+from realm.anthropic.api import AnthropicModel, _build_request
+from realm.anthropic.models import AnthropicConversationMessage
+
+SYSTEM_PROMPT = "You are a benchmark."
+
+Serializer = typing.Callable[[typing.List[AnthropicConversationMessage]], typing.Any]
+
+
+def _thread(turns: int) -> typing.List[AnthropicConversationMessage]:
+    messages = []
+    for turn in range(turns):
+        if turn % 2 == 0:
+            messages.append(AnthropicConversationMessage.from_group_chat_text("Вася", f"быдлан вопрос {turn} " * 10))
+        else:
+            messages.append(AnthropicConversationMessage.from_group_chat_bot_text(f"ответ {turn}, ёбана " * 30))
+    return messages
+
+
+def _run(thread: typing.List[AnthropicConversationMessage], serialize: Serializer) -> float:
+    """
+    Simulates a thread growing by one message per turn, serializing the whole history every turn.
+    Returns total seconds spent serializing.
+    """
+    elapsed = 0.0
+    for turn in range(1, len(thread) + 1):
+        history = thread[:turn]
+        started_at = time.perf_counter()
+        serialize(history)
+        elapsed += time.perf_counter() - started_at
+    return elapsed
+
+
+def _allocated_per_turn(thread: typing.List[AnthropicConversationMessage], serialize: Serializer) -> float:
+    """
+    Returns average bytes allocated (and kept alive by the result) by serializing the whole thread once more.
+    """
+    serialize(thread)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    result = serialize(thread)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main(turns: int):
+    warnings.simplefilter("ignore", DeprecationWarning)
+    variants: typing.Dict[str, Serializer] = {
+        "pydantic dict() per turn": lambda messages: [m.dict() for m in messages],
+        "cached to_wire()": lambda messages: [m.to_wire() for m in messages],
+        "_build_request": lambda messages: _build_request(
+            AnthropicModel.CLAUDE_3_7_SONNET_LATEST, SYSTEM_PROMPT, messages),
+    }
+    print(f"{turns} turns, thread grows by one message per turn")
+    print(f"{'variant':<28}{'total ms':>10}{'us/turn':>10}{'KiB/turn':>10}")
+    for name, serialize in variants.items():
+        # every variant gets fresh messages, so nothing is cached in advance
+        elapsed = _run(_thread(turns), serialize)
+        allocated = _allocated_per_turn(_thread(turns), serialize)
+        print(f"{name:<28}{elapsed * 1000:>10.1f}{elapsed / turns * 1e6:>10.1f}{allocated / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    main(parser.parse_args().turns)
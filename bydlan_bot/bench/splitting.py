@@ -0,0 +1,146 @@
+"""
+Microbenchmark of splitting large replies into Telegram messages: slicing every 4096 characters (as it used to be
+done) vs `MessageSplitter`, both on the whole text at once and fed in small pieces the way a streamed reply is.
+
+Besides time, counts messages over the Telegram limit (which is in UTF-16 code units, so emoji count twice) and
+messages with an unclosed code block.
+
+`--check` instead splits known troublesome texts and random ones at small limits, whole and streamed, and fails
+unless both ways give the same messages within the limit.
+
+Run from the `bydlan_bot` directory:
+    python -m bench.splitting [--chars 10000 50000 200000] [--delta 20] [--check]
+"""
+import argparse
+import itertools
+import random
+import time
+import typing
+
+from realm.telegram.utils import (MIN_LIMIT, MessageSplitter, TELEGRAM_MAX_MESSAGE_LENGTH, split_if_large_message,
+                                  utf16_length)
+
+Splitter = typing.Callable[[str], typing.List[str]]
+
+_WORDS = ["ёбана", "короче", "слышь", "пацаны", "ваще", "🔥", "😂", "👍🏻", "**жирно**", "__курсив__", "`код`",
+          "||спойлер||", "[ссылка](https://example.com)"]
+_CODE_BLOCK = "```python\nfor i in range(10):\n    print('быдлан', i)  # 🐍\n```"
+
+# Texts which used to hang the splitter: a code block with a first line longer than a message
+_REGRESSIONS = ["```" + "a" * 5000 + "\nb\n```", "```" + "слово " * 1200 + "```"]
+_PIECES = ["слово", "word", "😂", "👍🏻", " ", " ", " ", "\n", "\n\n", ". ", "! ", "```", "```py\n", "`", "**", "__",
+           "--", "~~", "||", "[ссылка](https://example.com)", "[", "a" * 40]
+
+
+def _reply(chars: int, seed: int = 0) -> str:
+    """
+    Returns a Markdown reply of about `chars` characters: paragraphs of sentences with emoji and formatting, and
+    code blocks in between.
+    """
+    rnd = random.Random(seed)
+    paragraphs = []
+    length = 0
+    while length < chars:
+        if rnd.random() < 0.2:
+            paragraph = "\n".join([_CODE_BLOCK] * rnd.randint(1, 30))
+        else:
+            sentences = (" ".join(rnd.choices(_WORDS, k=rnd.randint(3, 20))).capitalize() + rnd.choice(".!?")
+                         for _ in range(rnd.randint(1, 15)))
+            paragraph = " ".join(sentences)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def _naive(message: str) -> typing.List[str]:
+    return [message[i:i + TELEGRAM_MAX_MESSAGE_LENGTH] for i in range(0, len(message), TELEGRAM_MAX_MESSAGE_LENGTH)]
+
+
+def _incremental(delta: int) -> Splitter:
+    def split(message: str) -> typing.List[str]:
+        splitter = MessageSplitter()
+        for i in range(0, len(message), delta):
+            splitter.feed(message[i:i + delta])
+            # what a streaming sender reads on every edit
+            splitter.pending()
+        return splitter.finish()
+    return split
+
+
+def _random_text(rnd: random.Random, pieces: int) -> str:
+    return "".join(rnd.choices(_PIECES, k=pieces))
+
+
+def _check_text(text: str, limit: int, delta: int) -> typing.Optional[str]:
+    """
+    Returns what is wrong with splitting `text`, None when nothing is.
+    """
+    whole = split_if_large_message(text, limit)
+    splitter = MessageSplitter(limit)
+    for i in range(0, len(text), delta):
+        splitter.feed(text[i:i + delta])
+    streamed = splitter.finish()
+    too_long = [chunk for chunk in whole + streamed if utf16_length(chunk) > limit]
+    if too_long:
+        return f"{len(too_long)} messages over the limit, e.g. {too_long[0]!r}"
+    if whole != streamed:
+        return f"streamed by {delta} differs from the whole text: {len(streamed)} vs {len(whole)} messages"
+    return None
+
+
+def check(trials: int, seed: int = 0) -> int:
+    """
+    Returns the number of failed cases, printing every one of them.
+    """
+    rnd = random.Random(seed)
+    cases = [(text, TELEGRAM_MAX_MESSAGE_LENGTH, delta) for text in _REGRESSIONS for delta in (1, 7, 1000)]
+    for _ in range(trials):
+        cases.append((_random_text(rnd, rnd.randint(1, 400)), rnd.randint(MIN_LIMIT, 200), rnd.randint(1, 50)))
+    failed = 0
+    for text, limit, delta in cases:
+        problem = _check_text(text, limit, delta)
+        if problem is not None:
+            failed += 1
+            print(f"limit {limit}, text {text[:60]!r}...: {problem}")
+    print(f"{len(cases) - failed} of {len(cases)} cases passed")
+    return failed
+
+
+def _best_of(split: Splitter, message: str, repeat: int) -> typing.Tuple[float, typing.List[str]]:
+    best = float("inf")
+    chunks: typing.List[str] = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        chunks = split(message)
+        best = min(best, time.perf_counter() - started_at)
+    return best, chunks
+
+
+def main(sizes: typing.List[int], delta: int, repeat: int):
+    variants: typing.Dict[str, Splitter] = {
+        "slice every 4096 chars": _naive,
+        "split_if_large_message": split_if_large_message,
+        f"fed by {delta} chars": _incremental(delta),
+    }
+    print(f"best of {repeat}, Telegram limit {TELEGRAM_MAX_MESSAGE_LENGTH} UTF-16 units")
+    print(f"{'chars':>8}  {'variant':<24}{'ms':>10}{'us/KiB':>10}{'messages':>10}{'too long':>10}{'open code':>10}")
+    for chars, (name, split) in itertools.product(sizes, variants.items()):
+        message = _reply(chars)
+        elapsed, chunks = _best_of(split, message, repeat)
+        too_long = sum(utf16_length(chunk) > TELEGRAM_MAX_MESSAGE_LENGTH for chunk in chunks)
+        open_code = sum(chunk.count("```") % 2 for chunk in chunks)
+        print(f"{len(message):>8}  {name:<24}{elapsed * 1000:>10.2f}{elapsed / len(message) * 1024 * 1e6:>10.1f}"
+              f"{len(chunks):>10}{too_long:>10}{open_code:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, nargs="+", default=[10_000, 50_000, 200_000], help="reply sizes")
+    parser.add_argument("--delta", type=int, default=20, help="characters per streamed piece")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check", action="store_true", help="check correctness instead of measuring time")
+    parser.add_argument("--trials", type=int, default=2000, help="random texts to check")
+    args = parser.parse_args()
+    if args.check:
+        raise SystemExit(1 if check(args.trials) else 0)
+    main(args.chars, args.delta, args.repeat)
@@ -0,0 +1,51 @@
+import dataclasses
+import statistics
+import typing
+
+
+@dataclasses.dataclass
+class BenchResult:
+    name: str
+    count: int
+    elapsed_seconds: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    # Arbitrary scenario-specific numbers, e.g. API requests made
+    extra: typing.Dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    @property
+    def per_second(self) -> float:
+        return self.count / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+
+def percentile(ordered: typing.Sequence[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def summarize(name: str, latencies_seconds: typing.Iterable[float], elapsed_seconds: float,
+              **extra) -> BenchResult:
+    ordered = sorted(latencies_seconds)
+    return BenchResult(
+        name=name,
+        count=len(ordered),
+        elapsed_seconds=elapsed_seconds,
+        p50_ms=statistics.median(ordered) * 1000 if ordered else 0.0,
+        p95_ms=percentile(ordered, 0.95) * 1000,
+        p99_ms=percentile(ordered, 0.99) * 1000,
+        max_ms=ordered[-1] * 1000 if ordered else 0.0,
+        extra=extra,
+    )
+
+
+def print_report(results: typing.Iterable[BenchResult], unit: str = "msg"):
+    header = f"{'scenario':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{unit + '/s':>11}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        extra = "  ".join(f"{k}={v}" for k, v in r.extra.items())
+        print(f"{r.name:<28}{r.count:>7}{r.p50_ms:>10.1f}{r.p95_ms:>10.1f}{r.p99_ms:>10.1f}{r.max_ms:>10.1f}"
+              f"{r.per_second:>11.1f}  {extra}")
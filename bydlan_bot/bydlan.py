@@ -1,17 +1,34 @@
 import asyncio
+import os
+import sqlite3
+import time
 import typing
 
-import cachetools
 import pyrogram.enums
 import structlog
 from pyrogram import Client, filters
-from pyrogram.handlers import MessageHandler
+from pyrogram.errors import FloodWait, Unauthorized
+from pyrogram.handlers import EditedMessageHandler, MessageHandler
 from pyrogram.types import Message
 
 from db import kv
-from realm.anthropic.api import create_completion, AnthropicModel
-from realm.anthropic.models import AnthropicConversationMessage
+from db.conversations import BYTES_PER_TOKEN, ConversationNode, ConversationStore, MemoryConversationStore
+from db.sqlite_conversations import SqliteConversationStore
+from db.usage import UsageStore
+from metrics.registry import REGISTRY
+from metrics.trace import TraceRecorder
+from realm.anthropic.api import MIN_ANSWER_TOKENS, create_completion, create_completion_stream
+from realm.anthropic.context_window import estimate_tokens, fit_to_budget
+from realm.anthropic.models import AnthropicConversationMessage, AnthropicUsage
+from realm.anthropic.quotas import ChatQuotas, QuotaRequest
+from realm.anthropic.routing import choose_route
+from realm.anthropic.scheduler import CompletionScheduler, QueueFullError, SchedulerClosedError
 from realm.anthropic.system_prompts import BYDLAN_SYSTEM_PROMPT
+from realm.telegram.message_index import IndexedMessage, MessageIndex
+from realm.telegram import sharding
+from realm.telegram.outbox import TELEGRAM_GLOBAL_MESSAGES_PER_SECOND, Outbox
+from realm.telegram.streaming import DEFAULT_EDIT_INTERVAL_SECONDS, StreamingReply
+from realm.telegram.triggers import TriggerConfig, parse_chat_ids, parse_chat_prefixes
 from realm.telegram.utils import split_if_large_message
 from realm.telegram.myno_debug import send_debug_message
 
@@ -22,27 +39,194 @@ BYDLAN_USERNAME = None
 
 BYDLAN_PREFIX = "быдлан"
 
+# Chats the bot answers in (all by default), chats it ignores, and per-chat prefixes replacing BYDLAN_PREFIX
+TRIGGERS = TriggerConfig(
+    default_prefixes=(BYDLAN_PREFIX,),
+    chat_prefixes=parse_chat_prefixes(kv.get_setting(kv.Settings.chat_prefixes, "")),
+    enabled_chats=parse_chat_ids(kv.get_setting(kv.Settings.enabled_chats, "")),
+    disabled_chats=parse_chat_ids(kv.get_setting(kv.Settings.disabled_chats, "")),
+)
+
+# Post the reply while it's being generated instead of waiting for the whole completion
+STREAM_REPLIES = kv.get_setting(kv.Settings.stream_replies, False)
+STREAM_EDIT_INTERVAL_SECONDS = kv.get_setting(kv.Settings.stream_edit_interval_seconds, DEFAULT_EDIT_INTERVAL_SECONDS)
+# Triggers replying to the same message within this window get one reply (to the latest of them). 0 disables it.
+COALESCE_WINDOW_SECONDS = kv.get_setting(kv.Settings.coalesce_window_seconds, 0.0)
+# On shutdown, replies being produced get this long to be sent before they are cancelled
+SHUTDOWN_DRAIN_SECONDS = kv.get_setting(kv.Settings.shutdown_drain_seconds, 25.0)
+
+# Conversations are kept in this SQLite file when it's set (so they survive restarts and are shared by workers),
+# in process memory otherwise
+CONVERSATIONS_DB = kv.get_setting(kv.Settings.conversations_db, "")
+# In-memory conversations are saved to this file on shutdown and restored on startup. Empty disables it.
+CONVERSATIONS_SNAPSHOT = kv.get_setting(kv.Settings.conversations_snapshot, "conversations.snapshot.json")
+# Telegram session is kept in this directory, so restarts don't authorize the bot again. Empty keeps it in memory.
+SESSION_DIR = kv.get_setting(kv.Settings.telegram_session_dir, ".")
+# Token usage of every chat is saved to this SQLite database, off when empty
+USAGE_DB = kv.get_setting(kv.Settings.usage_db, "")
+# Records an anonymized trace of the traffic to this file (`.gz` to compress it) for `bench.replay`, off when empty.
+# The file is overwritten on startup, workers of a sharded deployment record to `<name>-<worker index>.<ext>`.
+TRACE_PATH = kv.get_setting(kv.Settings.trace_path, "")
+
 _CLIENT: Client = None
-_CONVERSATIONS = cachetools.Cache(maxsize=1000)
+_TRACE: typing.Optional[TraceRecorder] = None
+_USAGE: typing.Optional[UsageStore] = None
+# Cleared on shutdown, new triggers are ignored from then on
+_ACCEPTING_TRIGGERS = True
+_CONVERSATION_LIMITS = dict(
+    max_bytes=kv.get_setting(kv.Settings.conversations_max_bytes, 64 * 1024 * 1024),
+    ttl_seconds=kv.get_setting(kv.Settings.conversations_ttl_seconds, 7 * 24 * 60 * 60.0),
+    max_entries_per_chat=kv.get_setting(kv.Settings.conversations_max_entries_per_chat, 200),
+    max_bytes_per_chat=kv.get_setting(kv.Settings.conversations_max_bytes_per_chat, 8 * 1024 * 1024),
+)
+_CONVERSATIONS: ConversationStore = SqliteConversationStore(CONVERSATIONS_DB, **_CONVERSATION_LIMITS) \
+    if CONVERSATIONS_DB else MemoryConversationStore(**_CONVERSATION_LIMITS)
+# Share of the API rate limit every chat may use, 0 is unlimited. Workers of a sharded deployment own different chats,
+# so a chat's quota is enforced by a single process.
+_QUOTAS = ChatQuotas(
+    tokens_per_minute=kv.get_setting(kv.Settings.chat_tokens_per_minute, 0),
+    requests_per_minute=kv.get_setting(kv.Settings.chat_requests_per_minute, 0),
+    min_output_tokens=MIN_ANSWER_TOKENS,
+)
+# Replies are produced outside of pyrogram workers, fairly across chats and with a limited number of API calls in flight
+_SCHEDULER = CompletionScheduler(
+    max_in_flight=kv.get_setting(kv.Settings.completions_max_in_flight, 4),
+    max_queued_per_chat=kv.get_setting(kv.Settings.completions_max_queued_per_chat, 20),
+    admission=_QUOTAS.delay,
+)
+# (chat_id, replied-to message id) -> triggers waiting for the coalescing window to close, the oldest goes first
+_PENDING_BURSTS: typing.Dict[typing.Tuple[int, int], typing.List[Message]] = {}
+# Every message the bot sends goes through the outbox to stay within Telegram rate limits. The global limit is per bot,
+# so workers share it.
+_OUTBOX = Outbox(global_rate=TELEGRAM_GLOBAL_MESSAGES_PER_SECOND / sharding.WORKER_COUNT)
+# Every group message the bot has seen, so reply chains don't need a Telegram round trip per hop
+_MESSAGE_INDEX = MessageIndex(maxsize=kv.get_setting(kv.Settings.message_index_size, 50_000))
+
+_STAGE_SECONDS = REGISTRY.histogram("bydlan_stage_seconds", "Time spent in every stage of a reply", ["stage"])
+_CHAIN_HOPS = REGISTRY.counter("bydlan_chain_hops_total", "Reply chain messages resolved, by source", ["source"])
+_CONVERSATION_LOOKUPS = REGISTRY.counter(
+    "bydlan_conversation_lookups_total",
+    "Conversations resolved from the conversation store (hit) or built from scratch (miss)", ["result"])
+REGISTRY.gauge("bydlan_conversation_store_entries", "Message ids mapped to conversations",
+               lambda: {(): _CONVERSATIONS.stats().entries})
+REGISTRY.gauge("bydlan_conversation_store_bytes", "Approximate size of stored conversations",
+               lambda: {(): _CONVERSATIONS.stats().size_bytes})
+REGISTRY.gauge("bydlan_conversation_store_evictions", "Conversation store evictions, by reason",
+               lambda: {(reason,): count for reason, count in _CONVERSATIONS.stats().evictions.items()}, ["reason"])
+REGISTRY.gauge("bydlan_message_index_entries", "Messages in the local message index", lambda: {(): len(_MESSAGE_INDEX)})
+_TRIGGER_UPDATES = REGISTRY.counter("bydlan_trigger_updates_total",
+                                    "Group messages dispatched to the reply handler or filtered out, by reason",
+                                    ["result"])
+_COALESCED_TRIGGERS = REGISTRY.counter("bydlan_coalesced_triggers_total",
+                                       "Triggers answered together with a later trigger in the same thread")
+REGISTRY.gauge("bydlan_scheduler_queued", "Replies waiting for a completion slot",
+               lambda: {(): _SCHEDULER.stats().queued})
+REGISTRY.gauge("bydlan_scheduler_in_flight", "Replies being produced", lambda: {(): _SCHEDULER.stats().in_flight})
 
 
 async def graceful_shutdown():
     global _CLIENT
+    await drain_replies()
     if _CLIENT:
         try:
             await _CLIENT.stop()
             logger.info("Bot stopped gracefully")
         except Exception as e:
             logger.error("Error during shutdown", error=e)
+    save_conversations()
+    _CONVERSATIONS.close()
+    if _TRACE is not None:
+        _TRACE.close()
+    if _USAGE is not None:
+        _USAGE.close()
+
+
+async def drain_replies():
+    """
+    Stops accepting triggers and lets replies being produced finish (within `SHUTDOWN_DRAIN_SECONDS`), so a
+    restart doesn't throw away completions which are already paid for.
+    """
+    global _ACCEPTING_TRIGGERS
+    _ACCEPTING_TRIGGERS = False
+
+    # bursts waiting for the coalescing window are answered now, if there is a free slot
+    for key in list(_PENDING_BURSTS):
+        schedule_reply(_CLIENT, _PENDING_BURSTS.pop(key))
+
+    report = await _SCHEDULER.drain(SHUTDOWN_DRAIN_SECONDS)
+    if report.dropped_queued or report.cancelled:
+        logger.warning("replies lost on shutdown", finished=report.finished, dropped_queued=report.dropped_queued,
+                       cancelled=report.cancelled, lost_per_chat=report.lost_per_chat,
+                       seconds=round(report.seconds, 3))
+    else:
+        logger.info("replies drained", finished=report.finished, seconds=round(report.seconds, 3))
+
+
+def session_name() -> str:
+    return "bydlan" if sharding.WORKER_INDEX < 0 else f"bydlan-{sharding.WORKER_INDEX}"
+
+
+def trace_path() -> str:
+    if sharding.WORKER_INDEX < 0:
+        return TRACE_PATH
+    gz = ".gz" if TRACE_PATH.endswith(".gz") else ""
+    root, ext = os.path.splitext(TRACE_PATH[:len(TRACE_PATH) - len(gz)])
+    return f"{root}-{sharding.WORKER_INDEX}{ext}{gz}"
+
+
+def has_saved_session() -> bool:
+    """
+    Whether the bot is already authorized, so connecting to Telegram doesn't sign the bot in again.
+    """
+    return bool(SESSION_DIR) and os.path.exists(os.path.join(SESSION_DIR, f"{session_name()}.session"))
+
+
+def restore_conversations():
+    """
+    Loads the conversations snapshot saved by the previous run, if any.
+    """
+    if CONVERSATIONS_DB or not CONVERSATIONS_SNAPSHOT or not os.path.exists(CONVERSATIONS_SNAPSHOT):
+        return
+    started_at = time.monotonic()
+    try:
+        restored = _CONVERSATIONS.load_snapshot(CONVERSATIONS_SNAPSHOT)
+    except Exception as e:
+        logger.error("failed to restore conversations", error=e, path=CONVERSATIONS_SNAPSHOT)
+        return
+    logger.info("conversations restored", entries=restored, seconds=round(time.monotonic() - started_at, 3))
+
+
+def save_conversations():
+    # SQLite conversations are persistent already
+    if CONVERSATIONS_DB or not CONVERSATIONS_SNAPSHOT:
+        return
+    started_at = time.monotonic()
+    try:
+        _CONVERSATIONS.save_snapshot(CONVERSATIONS_SNAPSHOT)
+    except Exception as e:
+        logger.error("failed to save conversations", error=e, path=CONVERSATIONS_SNAPSHOT)
+        return
+    logger.info("conversations saved", entries=_CONVERSATIONS.stats().entries,
+                seconds=round(time.monotonic() - started_at, 3))
 
 
 async def init():
-    global _CLIENT, BYDLAN_USERNAME
+    global _CLIENT, _TRACE, _USAGE, BYDLAN_USERNAME
     
     logger.info("Initializing Telegram client...")
+
+    if TRACE_PATH:
+        _TRACE = TraceRecorder(trace_path())
+        logger.info("recording traffic trace", path=trace_path())
+    if USAGE_DB:
+        _USAGE = UsageStore(USAGE_DB)
     
-    # in-memory session will be discarded as soon as the client stops
-    client = Client("bydlan", in_memory=True, workers=4)
+    if SESSION_DIR:
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        client = Client(session_name(), workdir=SESSION_DIR, workers=4)
+    else:
+        # in-memory session will be discarded as soon as the client stops
+        client = Client(session_name(), in_memory=True, workers=4)
 
     # Set secrets
     try:
@@ -55,12 +239,27 @@ async def init():
         logger.error("Failed to load credentials", error=e)
         raise
 
-    # Register handlers
-    client.add_handler(MessageHandler(handle_group_message, filters=filters.group))
+    # Register handlers. Indexing runs in an earlier group, so it sees every message before it's handled.
+    # Workers of a sharded deployment only see the chats of their shard.
+    group_filter = filters.group & sharding.owned_chats
+    client.add_handler(MessageHandler(index_group_message, filters=group_filter), group=-1)
+    client.add_handler(EditedMessageHandler(index_group_message, filters=group_filter), group=-1)
+    client.add_handler(MessageHandler(handle_group_message, filters=group_filter & bydlan_triggers))
 
     # Start client, so it's ready to be used
     logger.info("Starting Telegram client...")
-    await client.start()
+    try:
+        await client.start()
+    except Unauthorized:
+        # the saved session was revoked, the next attempt signs the bot in again
+        if not client.in_memory:
+            logger.warning("Saved Telegram session is no longer valid, removing it")
+            try:
+                await client.storage.close()
+            except Exception:
+                pass
+            await client.storage.delete()
+        raise
     
     # Get bot info and set username
     try:
@@ -91,123 +290,310 @@ async def send_debug_msg(msg: str):
         await send_debug_message(f"failed to send debug message, go check logs mfer: {cut}")
 
 
+async def index_group_message(_: Client, message: Message):
+    """
+    Records every (new or edited) group message to the local message index.
+    """
+    try:
+        _MESSAGE_INDEX.record(message)
+    except Exception as e:
+        logger.error("failed to index group message", error=e)
+
+
+async def _is_trigger(_, __, message: Message) -> bool:
+    if not _ACCEPTING_TRIGGERS:
+        _TRIGGER_UPDATES.inc(result="shutting_down")
+        return False
+    if not TRIGGERS.is_enabled(message.chat.id):
+        _TRIGGER_UPDATES.inc(result="disabled_chat")
+        return False
+    reacts = should_react(message)
+    if _TRACE is not None:
+        _trace_message(message, reacts)
+    if not reacts:
+        _TRIGGER_UPDATES.inc(result="not_trigger")
+        return False
+    _TRIGGER_UPDATES.inc(result="handled")
+    return True
+
+
+def _trace_message(message: Message, reacts: bool):
+    if not reacts:
+        trigger = 0
+    elif message.text and TRIGGERS.matched_prefix(message.chat.id, message.text) is not None:
+        trigger = 1
+    else:
+        trigger = 2
+    _TRACE.message(message.chat.id, message.id, message.reply_to_message_id,
+                   message.from_user.id if message.from_user else None, len(message.text or ""), trigger)
+
+
+# Evaluated by the dispatcher, so messages the bot ignores never reach the reply handler.
+# A coroutine, like `sharding.owned_chats`.
+bydlan_triggers = filters.create(_is_trigger, "BydlanTriggersFilter")
+
+
 async def handle_group_message(client: Client, message: Message):
     """
-    If a group message is bydlan-reactable:
-      1. Go through reply chain to build context
-      2. Reply to the message
+    Schedules a reply to a bydlan-reactable group message (see `bydlan_triggers`). Doesn't wait for the reply,
+    so pyrogram workers are free to handle other chats.
+    """
+    # Top-level triggers start conversations of their own, even when they arrive together
+    if COALESCE_WINDOW_SECONDS <= 0 or message.reply_to_message_id is None:
+        schedule_reply(client, [message])
+        return
 
-    It also maintains a conversation history which gets saved on every bydlan response. On the next response, the previous
-    conversation gets cleared.
+    # Pile-ons: several replies to the same message within the window are answered with a single reply
+    key = (message.chat.id, message.reply_to_message_id)
+    burst = _PENDING_BURSTS.get(key)
+    if burst is not None:
+        burst.append(message)
+        return
+    _PENDING_BURSTS[key] = [message]
+    asyncio.get_running_loop().call_later(COALESCE_WINDOW_SECONDS, lambda: _close_burst(client, key))
+
+
+def _close_burst(client: Client, key: typing.Tuple[int, int]):
+    # the burst is gone if it was flushed on shutdown
+    burst = _PENDING_BURSTS.pop(key, None)
+    if burst:
+        schedule_reply(client, burst)
+
+
+def schedule_reply(client: Client, burst: typing.List[Message]):
+    """
+    Schedules a single reply to the latest message of the burst, all of them are added to the conversation.
     """
+    message = burst[-1]
+    if len(burst) > 1:
+        _COALESCED_TRIGGERS.inc(len(burst) - 1)
+        logger.info("coalesced triggers", chat_id=message.chat.id, count=len(burst))
     try:
-        if not should_react(message):
-            return
+        _SCHEDULER.submit(message.chat.id, lambda: reply_to_group_message(client, message, burst[:-1]))
+        logger.info("Scheduled message from group", chat_id=message.chat.id, scheduler=_SCHEDULER.stats())
+    except (QueueFullError, SchedulerClosedError) as e:
+        logger.warning("dropping message", chat_id=message.chat.id, error=e)
 
+
+async def reply_to_group_message(client: Client, message: Message, preceding: typing.Sequence[Message] = ()):
+    """
+      1. Go through reply chain to build context
+      2. Reply to the message (`preceding` are triggers in the same thread answered by the same reply)
+
+    It also maintains a conversation tree: every user and bydlan message of a conversation is mapped to its node,
+    so replying to any of them continues the conversation from that point.
+    """
+    try:
         logger.info("Processing message from group", chat_id=message.chat.id)
 
         # Gather context
-        messages = await get_conversation(client, message)
+        with _STAGE_SECONDS.time(stage="get_conversation"):
+            parent_node = await get_conversation(client, message)
 
-        # Add current message to the context
+        # Add current message (and the ones coalesced with it) to the context
         # and strip bydlan prefix from it so he doesn't get triggered
-        user_name = message.from_user.first_name if message.from_user else "Unknown"
-        messages.append(AnthropicConversationMessage.from_group_chat_text(
-            user_name, strip_bydlan_prefix(message.text)
-        ))
-
-        # Get response from anthropic
-        logger.info("Getting response from Claude...")
-        bydlan_response = await create_completion(AnthropicModel.CLAUDE_3_7_SONNET_LATEST, BYDLAN_SYSTEM_PROMPT,
-                                                  messages)
-        messages.append(bydlan_response)
-        bydlan_response_text = "".join(bydlan_response.assistant_text_blocks())
-
-        # Send response(s) to the chat
-        last_sent_msg = await send_reply(message, bydlan_response_text)
-
-        # and save conversation (with deleting the previous one)
-        key = make_cache_key(message.chat.id, message.reply_to_message_id)
-        if message.reply_to_message_id and _CONVERSATIONS.get(key):
-            del _CONVERSATIONS[key]
-        _CONVERSATIONS[make_cache_key(message.chat.id, last_sent_msg.id)] = messages
-
-        logger.info("Message processed successfully")
+        user_node = parent_node
+        user_entries = []
+        for user_message in [*preceding, message]:
+            user_name = user_message.from_user.first_name if user_message.from_user else "Unknown"
+            user_node = ConversationNode.append_to(user_node, AnthropicConversationMessage.from_group_chat_text(
+                user_name, strip_bydlan_prefix(user_message.chat.id, user_message.text)
+            ))
+            user_entries.append((user_message.id, user_node))
+        _CONVERSATIONS.put_many(message.chat.id, user_entries)
+        # long conversations get their beginning summarized
+        messages = await fit_to_budget(user_node, _CONVERSATIONS,
+                                       on_summary=lambda summary: _account_usage(message.chat.id, None, summary))
+        # model, output and thinking budget depend on how hard the request looks
+        route = choose_route(message.chat.id, "\n".join(m.text for m in [*preceding, message]), user_node.depth)
+        # a chat close to its token quota gets a shorter answer
+        input_tokens = 0
+        if _QUOTAS.limits_tokens:
+            input_tokens = len(BYDLAN_SYSTEM_PROMPT.encode("utf-8")) // BYTES_PER_TOKEN \
+                + estimate_tokens(user_node, messages)
+        max_tokens, quota_request = _QUOTAS.grant(message.chat.id, input_tokens, route.max_tokens)
+
+        # Get response from anthropic and send response(s) to the chat
+        logger.info("Getting response from Claude...", streaming=STREAM_REPLIES, route=route.name)
+        completion_started_at = time.monotonic()
+        if STREAM_REPLIES:
+            streaming_reply = StreamingReply(message, _OUTBOX, edit_interval=STREAM_EDIT_INTERVAL_SECONDS)
+            try:
+                with _STAGE_SECONDS.time(stage="completion"):
+                    bydlan_response = await _accounted(message.chat.id, quota_request, create_completion_stream(
+                        route.model, BYDLAN_SYSTEM_PROMPT, messages, on_text=streaming_reply.append,
+                        max_tokens=max_tokens, thinking_budget=route.thinking_budget))
+                completion_seconds = time.monotonic() - completion_started_at
+                bydlan_response_text = "".join(bydlan_response.assistant_text_blocks())
+                with _STAGE_SECONDS.time(stage="send_reply"):
+                    sent_messages = await streaming_reply.finish(bydlan_response_text)
+            finally:
+                # a reply cut short by an error is replaced with the error message
+                await streaming_reply.abort()
+            for sent_msg in sent_messages:
+                _MESSAGE_INDEX.record(sent_msg)
+        else:
+            with _STAGE_SECONDS.time(stage="completion"):
+                bydlan_response = await _accounted(message.chat.id, quota_request, create_completion(
+                    route.model, BYDLAN_SYSTEM_PROMPT, messages, max_tokens=max_tokens,
+                    thinking_budget=route.thinking_budget))
+            completion_seconds = time.monotonic() - completion_started_at
+            bydlan_response_text = "".join(bydlan_response.assistant_text_blocks())
+            with _STAGE_SECONDS.time(stage="send_reply"):
+                sent_messages = await send_reply(message, bydlan_response_text)
+
+        # and save conversation, so a reply to any part of the response continues it
+        bydlan_node = user_node.append(bydlan_response)
+        _CONVERSATIONS.put_many(message.chat.id, [(sent_msg.id, bydlan_node) for sent_msg in sent_messages])
+        if _TRACE is not None:
+            _trace_reply(message, bydlan_response.model or route.model, completion_seconds, bydlan_response_text,
+                         bydlan_response.usage, sent_messages)
+
+        logger.info("Message processed successfully", usage=bydlan_response.usage,
+                    conversations=_CONVERSATIONS.stats())
 
     except Exception as e:
         logger.error("failed to handle group message", error=e)
+        if isinstance(e, FloodWait):
+            # replying with an error would only make flooding worse
+            return
         try:
-            await message.reply(f"еррор ебана\n\n{e}", reply_to_message_id=message.id)
+            await _OUTBOX.send(message.chat.id, lambda: message.reply(f"еррор ебана\n\n{e}",
+                                                                      reply_to_message_id=message.id))
         except Exception as reply_error:
             logger.error("Failed to send error message", error=reply_error)
 
 
-def make_cache_key(chat_id, message_id) -> str:
-    return f"{chat_id}:{message_id}"
+async def _accounted(chat_id: int, quota_request: QuotaRequest,
+                     completion: typing.Awaitable[AnthropicConversationMessage]) -> AnthropicConversationMessage:
+    """
+    Awaits the completion of a granted request, then settles the request whether the completion succeeded or not.
+    """
+    response = None
+    try:
+        response = await completion
+        return response
+    finally:
+        if response is not None:
+            _account_usage(chat_id, quota_request, response)
+        else:
+            # a failed completion isn't billed, its estimate would hold back the chat's next requests
+            _QUOTAS.settle(quota_request, 0)
 
 
-async def get_conversation(client: Client, message: Message) -> typing.List[AnthropicConversationMessage]:
+def _account_usage(chat_id: int, quota_request: typing.Optional[QuotaRequest], response: AnthropicConversationMessage):
     """
-    Either returns a cached conversation (containing bydlan responses) or creates a new one (traversing
-    through parent messages if present).
+    Counts the usage of a completion towards the chat's quota (settling `quota_request`, if it was granted one) and
+    records it.
     """
-    if message.reply_to_message_id:
-        cached_context: typing.List[AnthropicConversationMessage] = _CONVERSATIONS.get(
-            make_cache_key(message.chat.id, message.reply_to_message_id))
-        if cached_context:
-            return cached_context
+    usage = response.usage
+    # cache reads are cheap and don't count towards the API's input tokens rate limit
+    tokens = usage.input_tokens + usage.cache_creation_input_tokens + usage.output_tokens
+    if quota_request is not None:
+        _QUOTAS.settle(quota_request, tokens)
+    else:
+        _QUOTAS.charge(chat_id, tokens)
+    if _USAGE is not None:
+        try:
+            _USAGE.record(chat_id, response.model, usage)
+        except sqlite3.Error as e:
+            logger.error("failed to record token usage", chat_id=chat_id, error=e)
+
+
+def _trace_reply(message: Message, model: str, completion_seconds: float, response_text: str, usage: AnthropicUsage,
+                 sent_messages: typing.List[Message]):
+    _TRACE.completion(message.chat.id, model, completion_seconds, len(response_text), usage.input_tokens,
+                      usage.output_tokens, usage.cache_read_input_tokens, usage.cache_creation_input_tokens)
+    for sent_msg in sent_messages:
+        _TRACE.sent(message.chat.id, sent_msg.id, sent_msg.reply_to_message_id, len(sent_msg.text or ""))
 
-    # Message was not yet cached, traverse the replies (if any) and cache them
-    context = []
+
+async def get_conversation(client: Client, message: Message) -> typing.Optional[ConversationNode]:
+    """
+    Returns the conversation the message replies to: either a cached one, or a new one built by traversing parent
+    messages (if present). The traversal stops as soon as it reaches a cached conversation and continues it.
+    """
+    # Traverse the replies (if any) until a cached message and cache them.
+    # Parents are resolved from the local message index; Telegram is only asked for messages the bot never saw.
     chat_id = message.chat.id
     next_msg_id = message.reply_to_message_id
-    logger.info("start iterating over telegram replies")
+    context: typing.List[typing.Tuple[int, AnthropicConversationMessage]] = []
+    base_node = None
+    fetched_count = 0
+    indexed_count = 0
     while next_msg_id:
-        # Get parent and save it to the context
-        parent_msg = await client.get_messages(chat_id, message_ids=next_msg_id)
-        logger.info("handling parent message", msg=parent_msg)
-        # wait for a bit to avoid spamming tg servers
-        await asyncio.sleep(0.2)
+        base_node = _CONVERSATIONS.get(chat_id, next_msg_id)
+        if base_node:
+            break
+
+        parent_msg = _MESSAGE_INDEX.get(chat_id, next_msg_id)
+        if not parent_msg:
+            if fetched_count > 0:
+                # wait for a bit to avoid spamming tg servers
+                await asyncio.sleep(0.2)
+            parent_msg = await fetch_missing_message(client, chat_id, next_msg_id)
+            fetched_count += 1
+            logger.info("fetched parent message from telegram", msg=parent_msg)
+        else:
+            indexed_count += 1
 
         if not parent_msg:
             break
-        author = parent_msg.from_user
-        if not author:
+        if not parent_msg.has_author:
             # this is likely another bot's message
             logger.warning("msg author not found", msg=parent_msg)
             await send_debug_msg(f"msg author not found: {parent_msg}")
             # just in case to avoid spamming
             await asyncio.sleep(0.3)
-        elif author.username and author.username == BYDLAN_USERNAME:
-            context.append(
-                AnthropicConversationMessage.from_group_chat_bot_text(parent_msg.text))
+        elif parent_msg.author_username and parent_msg.author_username == BYDLAN_USERNAME:
+            context.append((parent_msg.id, AnthropicConversationMessage.from_group_chat_bot_text(parent_msg.text)))
         else:
-            if not author.first_name:
+            if not parent_msg.author_first_name:
                 logger.warning("author without a first name", msg=parent_msg)
                 await send_debug_msg(f"author without a first name: {parent_msg}")
                 # just in case to avoid spamming
                 await asyncio.sleep(0.3)
 
-            context.append(
-                AnthropicConversationMessage.from_group_chat_text(parent_msg.from_user.first_name, parent_msg.text))
+            context.append((parent_msg.id, AnthropicConversationMessage.from_group_chat_text(
+                parent_msg.author_first_name, parent_msg.text)))
 
-        next_msg_id = parent_msg.reply_to_message_id
-    logger.info("finish iterating over telegram replies")
+        next_msg_id = parent_msg.reply_to_id
+    logger.info("finished iterating over replies", depth=len(context), fetched_from_telegram=fetched_count,
+                continues_cached=base_node is not None)
+    _CONVERSATION_LOOKUPS.inc(result="hit" if base_node else "miss")
+    _CHAIN_HOPS.inc(indexed_count, source="index")
+    _CHAIN_HOPS.inc(fetched_count, source="telegram")
 
-    # reverse the history so the oldest message goes first
-    context.reverse()
-    return context
+    # build the conversation starting from the oldest message, caching every message on the way
+    node = base_node
+    entries = []
+    for msg_id, context_message in reversed(context):
+        node = ConversationNode.append_to(node, context_message)
+        entries.append((msg_id, node))
+    _CONVERSATIONS.put_many(chat_id, entries)
+    return node
+
+
+async def fetch_missing_message(client: Client, chat_id: int, message_id: int) -> typing.Optional[IndexedMessage]:
+    """
+    Fetches a message the bot never observed and indexes it. Pyrogram also parses the replied-to message of every
+    fetched message, so each round trip resolves two hops of the chain.
+    """
+    fetched = await client.get_messages(chat_id, message_ids=[message_id])
+    for fetched_msg in fetched:
+        _MESSAGE_INDEX.record(fetched_msg)
+    return _MESSAGE_INDEX.get(chat_id, message_id)
 
 
 def should_react(message: Message) -> bool:
     """
     Returns True when bydlan should react to a message:
-        1. if it starts with "быдлан"
+        1. if it starts with "быдлан" (or a prefix configured for the chat)
         2. if it is a reply to bydlan's message
     """
     if not message.text:
         return False
-    if message.text.lower().startswith(BYDLAN_PREFIX):
+    if TRIGGERS.matched_prefix(message.chat.id, message.text) is not None:
         return True
     parent_message = message.reply_to_message
     if (parent_message is not None 
@@ -218,28 +604,29 @@ def should_react(message: Message) -> bool:
     return False
 
 
-async def send_reply(message: Message, response: str) -> Message:
+async def send_reply(message: Message, response: str) -> typing.List[Message]:
+    """
+    Sends the response as a chain of replies (if it's large), returns all sent messages.
+    """
     reply_messages = split_if_large_message(response)
-    last_reply_to_message = message
+    sent_messages = []
     reply_to_id = message.id
-    for reply_msg in reply_messages:
-        if len(reply_msg) == 0:
-            continue
-
-        logger.info("sending reply message", message=reply_msg)
-        sent_msg = await message.reply(
-            reply_msg,
-            reply_to_message_id=reply_to_id,
-            parse_mode=pyrogram.enums.ParseMode.MARKDOWN,
-        )
-        reply_to_id = sent_msg.id
-        last_reply_to_message = sent_msg
-    return last_reply_to_message
-
-
-def strip_bydlan_prefix(text: str) -> str:
-    if text.lower().startswith(BYDLAN_PREFIX):
-        # remove the first word (to support cases like быдланчик, etc.)
-        return " ".join(text.split(" ")[1:])
-    else:
-        return text
+    async with _OUTBOX.sequence(message.chat.id):
+        for reply_msg in reply_messages:
+            if len(reply_msg) == 0:
+                continue
+
+            logger.info("sending reply message", message=reply_msg)
+            sent_msg = await _OUTBOX.send(message.chat.id, lambda: message.reply(
+                reply_msg,
+                reply_to_message_id=reply_to_id,
+                parse_mode=pyrogram.enums.ParseMode.MARKDOWN,
+            ))
+            _MESSAGE_INDEX.record(sent_msg)
+            reply_to_id = sent_msg.id
+            sent_messages.append(sent_msg)
+    return sent_messages
+
+
+def strip_bydlan_prefix(chat_id: int, text: str) -> str:
+    return TRIGGERS.strip_prefix(chat_id, text)
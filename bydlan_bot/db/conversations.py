@@ -0,0 +1,349 @@
+import abc
+import collections
+import dataclasses
+import json
+import os
+import time
+import typing
+
+import structlog
+
+from realm.anthropic.models import AnthropicConversationMessage
+
+logger = structlog.get_logger()
+
+ConversationKey = typing.Tuple[int, int]
+
+
+def estimate_size_bytes(message: AnthropicConversationMessage) -> int:
+    """
+    Approximates memory taken by a message with the size of its JSON representation. This also builds (and caches)
+    the API representation, so it's not serialized again when sent.
+    """
+    return len(json.dumps(message.to_wire(), ensure_ascii=False).encode("utf-8"))
+
+
+# Rough average for a mix of Cyrillic and Latin text, good enough to budget context without asking the API
+BYTES_PER_TOKEN = 4
+
+
+@dataclasses.dataclass(frozen=True, eq=False, slots=True, weakref_slot=True)
+class ConversationNode:
+    """
+    An immutable conversation: a message plus a link to the conversation it continues.
+
+    Conversations form a tree: continuing a conversation from any point is O(1) and shares the whole history with
+    every other branch, nothing is ever copied or mutated. The only exception is `summary`, a cache of a value
+    derived from the conversation.
+    """
+    message: AnthropicConversationMessage
+    parent: typing.Optional["ConversationNode"] = None
+    # Number of messages in the conversation, including this one
+    depth: int = 1
+    size_bytes: int = 0
+    # Estimated number of tokens in the conversation, including this message
+    history_tokens: int = 0
+    # Summary of the conversation up to (and including) this node, see `realm.anthropic.context_window`
+    summary: typing.Optional[AnthropicConversationMessage] = dataclasses.field(default=None, repr=False)
+
+    @property
+    def tokens(self) -> int:
+        """
+        Estimated number of tokens in this message.
+        """
+        return self.size_bytes // BYTES_PER_TOKEN
+
+    @classmethod
+    def root(cls, message: AnthropicConversationMessage) -> "ConversationNode":
+        size_bytes = estimate_size_bytes(message)
+        return cls(message=message, parent=None, depth=1, size_bytes=size_bytes,
+                   history_tokens=size_bytes // BYTES_PER_TOKEN)
+
+    @classmethod
+    def from_messages(cls, messages: typing.Iterable[AnthropicConversationMessage],
+                      parent: typing.Optional["ConversationNode"] = None) -> typing.Optional["ConversationNode"]:
+        """
+        Continues `parent` (or starts a new conversation) with `messages`, the oldest message goes first.
+        """
+        node = parent
+        for message in messages:
+            node = ConversationNode.append_to(node, message)
+        return node
+
+    @staticmethod
+    def append_to(node: typing.Optional["ConversationNode"],
+                  message: AnthropicConversationMessage) -> "ConversationNode":
+        return node.append(message) if node is not None else ConversationNode.root(message)
+
+    def append(self, message: AnthropicConversationMessage) -> "ConversationNode":
+        size_bytes = estimate_size_bytes(message)
+        return ConversationNode(message=message, parent=self, depth=self.depth + 1, size_bytes=size_bytes,
+                                history_tokens=self.history_tokens + size_bytes // BYTES_PER_TOKEN)
+
+    def set_summary(self, summary: AnthropicConversationMessage):
+        object.__setattr__(self, "summary", summary)
+
+    def history(self, since: typing.Optional["ConversationNode"] = None) -> typing.List[AnthropicConversationMessage]:
+        """
+        Returns conversation messages, the oldest message goes first. If `since` (an ancestor) is passed, only
+        messages after it are returned.
+        """
+        count = self.depth - (since.depth if since is not None else 0)
+        messages = [None] * count
+        node = self
+        for i in range(count - 1, -1, -1):
+            messages[i] = node.message
+            node = node.parent
+        return messages
+
+
+@dataclasses.dataclass
+class _Entry:
+    node: ConversationNode
+    expires_at: float
+
+
+@dataclasses.dataclass
+class _NodeRecord:
+    node: ConversationNode
+    chat_id: int
+    # Number of store entries and stored child nodes referencing the node
+    refs: int
+
+
+@dataclasses.dataclass
+class ConversationStoreStats:
+    entries: int = 0
+    nodes: int = 0
+    size_bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    # eviction reason -> count
+    evictions: typing.Dict[str, int] = dataclasses.field(default_factory=lambda: collections.defaultdict(int))
+
+
+class ConversationStore(abc.ABC):
+    """
+    Maps `(chat_id, message_id)` of every user and bot message in a conversation to its `ConversationNode`.
+    """
+
+    @abc.abstractmethod
+    def get(self, chat_id: int, message_id: int) -> typing.Optional[ConversationNode]:
+        ...
+
+    @abc.abstractmethod
+    def put(self, chat_id: int, message_id: int, node: ConversationNode):
+        ...
+
+    @abc.abstractmethod
+    def pop(self, chat_id: int, message_id: int):
+        ...
+
+    @abc.abstractmethod
+    def stats(self) -> ConversationStoreStats:
+        ...
+
+    def put_many(self, chat_id: int, entries: typing.Sequence[typing.Tuple[int, ConversationNode]]):
+        """
+        Same as `put` for every `(message_id, node)`, in order. Stores may write them at once.
+        """
+        for message_id, node in entries:
+            self.put(chat_id, message_id, node)
+
+    def save_summary(self, node: ConversationNode):
+        """
+        Persists `node.summary` of a stored node. Stores keeping nodes in memory have it already.
+        """
+
+    def close(self):
+        """
+        Writes anything not written yet and releases the storage. Stores keeping nodes in memory have nothing to do.
+        """
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Keeps conversations in process memory.
+
+    Size accounting is structural: a node shared by several branches is counted once, and is freed only when
+    no entry references it (directly or through a descendant).
+
+    Eviction policy:
+      - TTL: entries not accessed for `ttl_seconds` are dropped;
+      - per-chat caps: a chat can't hold more than `max_entries_per_chat` entries / `max_bytes_per_chat` bytes,
+        its least recently used entries are dropped first;
+      - global LRU: least recently used entries are dropped while the store is above `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, max_entries_per_chat: int, max_bytes_per_chat: int,
+                 timer: typing.Callable[[], float] = time.monotonic):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._max_entries_per_chat = max_entries_per_chat
+        self._max_bytes_per_chat = max_bytes_per_chat
+        self._timer = timer
+
+        # Global LRU order: the oldest entry goes first. As TTL is refreshed on access, it is also expiration order.
+        self._entries: typing.OrderedDict[ConversationKey, _Entry] = collections.OrderedDict()
+        # id(node) -> record of every node reachable from the entries
+        self._nodes: typing.Dict[int, _NodeRecord] = {}
+        # Per-chat LRU order and size
+        self._chat_keys: typing.Dict[int, typing.OrderedDict[ConversationKey, None]] = {}
+        self._chat_bytes: typing.Dict[int, int] = collections.defaultdict(int)
+        self._stats = ConversationStoreStats()
+
+    def get(self, chat_id: int, message_id: int) -> typing.Optional[ConversationNode]:
+        self._expire()
+        key = (chat_id, message_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats.misses += 1
+            return None
+
+        self._stats.hits += 1
+        self._touch(key, entry)
+        return entry.node
+
+    def put(self, chat_id: int, message_id: int, node: ConversationNode):
+        key = (chat_id, message_id)
+        existing = self._entries.get(key)
+        if existing is not None and existing.node is node:
+            self._touch(key, existing)
+            return
+        self._remove(key)
+
+        entry = _Entry(node=node, expires_at=0)
+        self._entries[key] = entry
+        self._chat_keys.setdefault(chat_id, collections.OrderedDict())[key] = None
+        self._incref(node, chat_id)
+        self._touch(key, entry)
+
+        self._expire()
+        chat_keys = self._chat_keys.get(chat_id, {})
+        while chat_keys and (len(chat_keys) > self._max_entries_per_chat
+                             or self._chat_bytes[chat_id] > self._max_bytes_per_chat):
+            self._evict(next(iter(chat_keys)), "chat_cap")
+        while self._stats.size_bytes > self._max_bytes:
+            self._evict(next(iter(self._entries)), "lru")
+
+    def pop(self, chat_id: int, message_id: int):
+        self._remove((chat_id, message_id))
+
+    def stats(self) -> ConversationStoreStats:
+        self._stats.entries = len(self._entries)
+        self._stats.nodes = len(self._nodes)
+        return self._stats
+
+    def save_snapshot(self, path: str):
+        """
+        Writes every entry with its remaining TTL to `path`, so the store can be restored after a restart.
+        Shared nodes are written once, with their summaries.
+        """
+        now = self._timer()
+        node_indexes: typing.Dict[int, int] = {}
+        nodes = []
+        entries = []
+        for (chat_id, message_id), entry in self._entries.items():
+            # parents go before their children
+            unsaved = []
+            node = entry.node
+            while node is not None and id(node) not in node_indexes:
+                unsaved.append(node)
+                node = node.parent
+            for node in reversed(unsaved):
+                parent_index = node_indexes[id(node.parent)] if node.parent is not None else None
+                node_indexes[id(node)] = len(nodes)
+                nodes.append([parent_index, node.message.to_wire(), node.size_bytes,
+                              node.summary.to_wire() if node.summary is not None else None])
+            entries.append([chat_id, message_id, node_indexes[id(entry.node)], entry.expires_at - now])
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"saved_at": time.time(), "nodes": nodes, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: str) -> int:
+        """
+        Restores entries saved by `save_snapshot`, time spent offline counts towards their TTL.
+        Returns the number of restored entries.
+        """
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+
+        nodes: typing.List[ConversationNode] = []
+        for parent_index, message, size_bytes, *summary in snapshot["nodes"]:
+            message = AnthropicConversationMessage.model_validate(message)
+            parent = nodes[parent_index] if parent_index is not None else None
+            depth = parent.depth + 1 if parent is not None else 1
+            history_tokens = (parent.history_tokens if parent is not None else 0) + size_bytes // BYTES_PER_TOKEN
+            # snapshots of older versions have no summaries
+            summary = AnthropicConversationMessage.model_validate(summary[0]) if summary and summary[0] else None
+            nodes.append(ConversationNode(message=message, parent=parent, depth=depth, size_bytes=size_bytes,
+                                          history_tokens=history_tokens, summary=summary))
+
+        offline_seconds = max(time.time() - snapshot["saved_at"], 0)
+        restored = 0
+        # entries are saved in LRU order, so restoring them one by one keeps it
+        for chat_id, message_id, node_index, ttl_seconds in snapshot["entries"]:
+            ttl_seconds -= offline_seconds
+            if ttl_seconds <= 0:
+                continue
+            self.put(chat_id, message_id, nodes[node_index])
+            entry = self._entries.get((chat_id, message_id))
+            if entry is not None:
+                entry.expires_at = self._timer() + ttl_seconds
+                restored += 1
+        return restored
+
+    def _touch(self, key: ConversationKey, entry: _Entry):
+        entry.expires_at = self._timer() + self._ttl_seconds
+        self._entries.move_to_end(key)
+        self._chat_keys[key[0]].move_to_end(key)
+
+    def _expire(self):
+        now = self._timer()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._evict(key, "ttl")
+
+    def _evict(self, key: ConversationKey, reason: str):
+        self._remove(key)
+        self._stats.evictions[reason] += 1
+
+    def _remove(self, key: ConversationKey):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        chat_id = key[0]
+        chat_keys = self._chat_keys[chat_id]
+        del chat_keys[key]
+        self._decref(entry.node)
+        if not chat_keys:
+            del self._chat_keys[chat_id]
+            self._chat_bytes.pop(chat_id, None)
+
+    def _incref(self, node: typing.Optional[ConversationNode], chat_id: int):
+        while node is not None:
+            record = self._nodes.get(id(node))
+            if record is not None:
+                record.refs += 1
+                return
+            # a newly stored node references its parent
+            self._nodes[id(node)] = _NodeRecord(node=node, chat_id=chat_id, refs=1)
+            self._chat_bytes[chat_id] += node.size_bytes
+            self._stats.size_bytes += node.size_bytes
+            node = node.parent
+
+    def _decref(self, node: typing.Optional[ConversationNode]):
+        while node is not None:
+            record = self._nodes[id(node)]
+            record.refs -= 1
+            if record.refs > 0:
+                return
+            del self._nodes[id(node)]
+            if record.chat_id in self._chat_bytes:
+                self._chat_bytes[record.chat_id] -= node.size_bytes
+            self._stats.size_bytes -= node.size_bytes
+            node = node.parent
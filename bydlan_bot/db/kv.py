@@ -1,6 +1,10 @@
 from enum import Enum
 import os
 import sys
+import typing
+
+T = typing.TypeVar("T", int, float, bool, str)
+
 
 class Keys(Enum):
     tg_client_api_id = "TG_API_ID"
@@ -8,6 +12,58 @@ class Keys(Enum):
     tg_bot_token_bydlan = "TG_BOT_TOKEN"
     bydlan_anthropic_api_key = "ANTHROPIC_API_KEY"
 
+
+class Settings(Enum):
+    """
+    Optional tuning knobs. Unlike `Keys`, these are never required and fall back to a default when unset.
+    """
+    enabled_chats = "BYDLAN_ENABLED_CHATS"
+    disabled_chats = "BYDLAN_DISABLED_CHATS"
+    chat_prefixes = "BYDLAN_CHAT_PREFIXES"
+    message_index_size = "BYDLAN_MESSAGE_INDEX_SIZE"
+    stream_replies = "BYDLAN_STREAM_REPLIES"
+    stream_edit_interval_seconds = "BYDLAN_STREAM_EDIT_INTERVAL_SECONDS"
+    conversations_db = "BYDLAN_CONVERSATIONS_DB"
+    conversations_snapshot = "BYDLAN_CONVERSATIONS_SNAPSHOT"
+    conversations_max_bytes = "BYDLAN_CONVERSATIONS_MAX_BYTES"
+    conversations_ttl_seconds = "BYDLAN_CONVERSATIONS_TTL_SECONDS"
+    conversations_max_entries_per_chat = "BYDLAN_CONVERSATIONS_MAX_ENTRIES_PER_CHAT"
+    conversations_max_bytes_per_chat = "BYDLAN_CONVERSATIONS_MAX_BYTES_PER_CHAT"
+    coalesce_window_seconds = "BYDLAN_COALESCE_WINDOW_SECONDS"
+    shutdown_drain_seconds = "BYDLAN_SHUTDOWN_DRAIN_SECONDS"
+    completions_max_in_flight = "BYDLAN_COMPLETIONS_MAX_IN_FLIGHT"
+    completions_max_queued_per_chat = "BYDLAN_COMPLETIONS_MAX_QUEUED_PER_CHAT"
+    completion_deadline_seconds = "BYDLAN_COMPLETION_DEADLINE_SECONDS"
+    chat_tokens_per_minute = "BYDLAN_CHAT_TOKENS_PER_MINUTE"
+    chat_requests_per_minute = "BYDLAN_CHAT_REQUESTS_PER_MINUTE"
+    usage_db = "BYDLAN_USAGE_DB"
+    completion_attempts_per_model = "BYDLAN_COMPLETION_ATTEMPTS_PER_MODEL"
+    completion_hedge_quantile = "BYDLAN_COMPLETION_HEDGE_QUANTILE"
+    route = "BYDLAN_ROUTE"
+    chat_routes = "BYDLAN_CHAT_ROUTES"
+    context_token_budget = "BYDLAN_CONTEXT_TOKEN_BUDGET"
+    context_recent_tokens = "BYDLAN_CONTEXT_RECENT_TOKENS"
+    response_cache_size = "BYDLAN_RESPONSE_CACHE_SIZE"
+    response_cache_ttl_seconds = "BYDLAN_RESPONSE_CACHE_TTL_SECONDS"
+    anthropic_max_connections = "BYDLAN_ANTHROPIC_MAX_CONNECTIONS"
+    anthropic_max_keepalive_connections = "BYDLAN_ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS"
+    anthropic_keepalive_expiry_seconds = "BYDLAN_ANTHROPIC_KEEPALIVE_EXPIRY_SECONDS"
+    anthropic_http2 = "BYDLAN_ANTHROPIC_HTTP2"
+    anthropic_keepalive_ping_seconds = "BYDLAN_ANTHROPIC_KEEPALIVE_PING_SECONDS"
+    metrics_host = "BYDLAN_METRICS_HOST"
+    metrics_port = "BYDLAN_METRICS_PORT"
+    trace_path = "BYDLAN_TRACE_PATH"
+    telegram_session_dir = "BYDLAN_TELEGRAM_SESSION_DIR"
+    startup_delay_min_seconds = "BYDLAN_STARTUP_DELAY_MIN_SECONDS"
+    startup_delay_max_seconds = "BYDLAN_STARTUP_DELAY_MAX_SECONDS"
+    log_production = "BYDLAN_LOG_PRODUCTION"
+    log_max_field_chars = "BYDLAN_LOG_MAX_FIELD_CHARS"
+    log_sample_rates = "BYDLAN_LOG_SAMPLE_RATES"
+    log_max_queued = "BYDLAN_LOG_MAX_QUEUED"
+    workers = "BYDLAN_WORKERS"
+    worker_index = "BYDLAN_WORKER_INDEX"
+
+
 async def get_value(key: Keys) -> str:
     """Get environment variable value with validation"""
     value = os.getenv(key.value)
@@ -18,3 +74,22 @@ async def get_value(key: Keys) -> str:
         sys.exit(1)
     
     return value.strip()
+
+
+def get_setting(key: Settings, default: T) -> T:
+    """
+    Get optional setting value, parsed to the type of `default`. Returns `default` when the variable is unset or
+    can't be parsed.
+    """
+    value = os.getenv(key.value)
+    if value is None or value.strip() == "":
+        return default
+
+    value = value.strip()
+    try:
+        if isinstance(default, bool):
+            return value.lower() in ("1", "true", "yes", "on")
+        return type(default)(value)
+    except ValueError:
+        print(f"WARNING: Environment variable {key.value}={value!r} is invalid, using {default!r}")
+        return default
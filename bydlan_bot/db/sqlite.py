@@ -0,0 +1,12 @@
+import sqlite3
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Opens a database every process of the bot may use at once. The connection is in autocommit mode, transactions
+    are started explicitly where they are needed, and WAL lets readers go on while another process writes.
+    """
+    db = sqlite3.connect(path, isolation_level=None, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
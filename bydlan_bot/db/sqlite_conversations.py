@@ -0,0 +1,340 @@
+import hashlib
+import json
+import sqlite3
+import time
+import typing
+import weakref
+
+import cachetools
+import structlog
+
+from db import sqlite
+from db.conversations import BYTES_PER_TOKEN, ConversationNode, ConversationStore, ConversationStoreStats
+from realm.anthropic.models import AnthropicConversationMessage
+
+logger = structlog.get_logger()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_nodes (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT,
+    chat_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    -- summary of the conversation up to the node, see `ConversationNode.summary`
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS conversation_entries (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    node_id TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS conversation_entries_expires_at ON conversation_entries (expires_at);
+CREATE INDEX IF NOT EXISTS conversation_entries_chat_expires_at ON conversation_entries (chat_id, expires_at);
+CREATE INDEX IF NOT EXISTS conversation_entries_node_id ON conversation_entries (node_id);
+CREATE INDEX IF NOT EXISTS conversation_nodes_parent_id ON conversation_nodes (parent_id);
+"""
+
+# Node and its ancestors, the node goes first
+_CHAIN_QUERY = """
+WITH RECURSIVE chain(id, parent_id, message, size_bytes, summary, position) AS (
+    SELECT id, parent_id, message, size_bytes, summary, 0 FROM conversation_nodes WHERE id = ?
+    UNION ALL
+    SELECT n.id, n.parent_id, n.message, n.size_bytes, n.summary, c.position + 1
+    FROM conversation_nodes n JOIN chain c ON n.id = c.parent_id
+)
+SELECT id, parent_id, message, size_bytes, summary FROM chain ORDER BY position
+"""
+
+# Parent and size of a node if no entry or child node references it
+_UNREFERENCED_NODE = """
+SELECT parent_id, size_bytes FROM conversation_nodes n WHERE id = ?
+AND NOT EXISTS (SELECT 1 FROM conversation_entries WHERE node_id = n.id)
+AND NOT EXISTS (SELECT 1 FROM conversation_nodes WHERE parent_id = n.id)
+"""
+
+# Nodes no entry references, directly or through a descendant
+_DELETE_UNREACHABLE = """
+DELETE FROM conversation_nodes WHERE id NOT IN (
+    WITH RECURSIVE reachable(id) AS (
+        SELECT node_id FROM conversation_entries
+        UNION
+        SELECT n.parent_id FROM conversation_nodes n JOIN reachable r ON n.id = r.id WHERE n.parent_id IS NOT NULL
+    )
+    SELECT id FROM reachable
+)
+"""
+
+
+class SqliteConversationStore(ConversationStore):
+    """
+    Keeps conversations in a SQLite database, so they survive restarts and are shared by every process using the
+    same file.
+
+    Nodes are content-addressed within a chat (the id is a hash of the message and the parent id, the chat id for a
+    root), so a conversation shared by several branches is stored once, a node loaded by any process is the same
+    conversation, and every node belongs to the single chat its size counts against. Recently used conversations are
+    also kept in memory, so the database is only read for the entry on the hot path.
+
+    Eviction policy is the same as `MemoryConversationStore`'s. Per-chat entry caps are applied on every `put`,
+    while TTL and size caps are applied by a periodic sweep (any process may sweep), and `stats` sizes are as of the
+    latest sweep. Accessed entries get their TTL refreshed in memory, and written by the sweep in a single batch.
+    Nodes are deleted along with the last entry referencing them.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: float, max_entries_per_chat: int,
+                 max_bytes_per_chat: int, sweep_interval_seconds: float = 60, memory_cache_size: int = 1024,
+                 timer: typing.Callable[[], float] = time.time):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._max_entries_per_chat = max_entries_per_chat
+        self._max_bytes_per_chat = max_bytes_per_chat
+        self._sweep_interval_seconds = sweep_interval_seconds
+        # Wall clock, as expiration times are shared between processes and restarts
+        self._timer = timer
+
+        self._db = sqlite.connect(path)
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        # nodes left behind by versions which only deleted unreachable nodes in the sweep
+        self._db.execute(_DELETE_UNREACHABLE)
+
+        # node id -> node, for every node alive in this process, plus strong references to the recently used ones
+        self._nodes: "weakref.WeakValueDictionary[str, ConversationNode]" = weakref.WeakValueDictionary()
+        self._recent: cachetools.LRUCache = cachetools.LRUCache(maxsize=memory_cache_size)
+        self._ids: "weakref.WeakKeyDictionary[ConversationNode, str]" = weakref.WeakKeyDictionary()
+
+        # (chat_id, message_id) -> expiration time refreshed by `get`, not written yet
+        self._touched: typing.Dict[typing.Tuple[int, int], float] = {}
+
+        self._stats = ConversationStoreStats()
+        self._next_sweep_at = 0.0
+        self._sweep()
+
+    def get(self, chat_id: int, message_id: int) -> typing.Optional[ConversationNode]:
+        now = self._timer()
+        row = self._db.execute(
+            "SELECT node_id, expires_at FROM conversation_entries WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id)).fetchone()
+        key = (chat_id, message_id)
+        alive = row is not None and max(row[1], self._touched.get(key, 0.0)) > now
+        node = self._load(row[0]) if alive else None
+        if node is None:
+            self._stats.misses += 1
+            return None
+
+        self._stats.hits += 1
+        self._touched[key] = now + self._ttl_seconds
+        self._recent[row[0]] = node
+        return node
+
+    def put(self, chat_id: int, message_id: int, node: ConversationNode):
+        self.put_many(chat_id, [(message_id, node)])
+
+    def put_many(self, chat_id: int, entries: typing.Sequence[typing.Tuple[int, ConversationNode]]):
+        if not entries:
+            return
+        replaced = []
+        with self._transaction():
+            for message_id, node in entries:
+                node_id = self._node_id(chat_id, node)
+                self._recent[node_id] = node
+                self._insert_nodes(chat_id, node)
+                replaced += self._db.execute(
+                    "SELECT node_id FROM conversation_entries WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id)).fetchall()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO conversation_entries (chat_id, message_id, node_id, expires_at) "
+                    "VALUES (?, ?, ?, ?)", (chat_id, message_id, node_id, self._timer() + self._ttl_seconds))
+            self._delete_unreferenced(node_id for node_id, in replaced)
+            # expiration order is LRU order (as of the latest sweep), as TTL is refreshed on access
+            evicted, _ = self._delete_entries(
+                "SELECT rowid, node_id FROM conversation_entries WHERE chat_id = ? "
+                "ORDER BY expires_at DESC LIMIT -1 OFFSET ?", (chat_id, self._max_entries_per_chat))
+        if evicted:
+            self._stats.evictions["chat_cap"] += evicted
+
+        if self._timer() >= self._next_sweep_at:
+            self._sweep()
+
+    def pop(self, chat_id: int, message_id: int):
+        with self._transaction():
+            self._delete_entries("SELECT rowid, node_id FROM conversation_entries WHERE chat_id = ? AND message_id = ?",
+                                 (chat_id, message_id))
+
+    def stats(self) -> ConversationStoreStats:
+        return self._stats
+
+    def save_summary(self, node: ConversationNode):
+        node_id = self._ids.get(node)
+        if node_id is None or node.summary is None:
+            return
+        self._db.execute("UPDATE conversation_nodes SET summary = ? WHERE id = ?",
+                         (json.dumps(node.summary.to_wire(), ensure_ascii=False), node_id))
+
+    def close(self):
+        try:
+            with self._transaction():
+                self._write_touched()
+        finally:
+            self._db.close()
+
+    def _migrate(self):
+        # databases created before summaries were stored
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(conversation_nodes)")}
+        if "summary" not in columns:
+            try:
+                self._db.execute("ALTER TABLE conversation_nodes ADD COLUMN summary TEXT")
+            except sqlite3.OperationalError as e:
+                # another process added it first
+                if "duplicate column" not in str(e):
+                    raise
+
+    def _transaction(self) -> sqlite3.Connection:
+        # takes the write lock upfront, so a concurrent sweep can't delete nodes between the reads and the writes
+        self._db.execute("BEGIN IMMEDIATE")
+        return self._db
+
+    def _node_id(self, chat_id: int, node: ConversationNode) -> str:
+        # ids are computed from the oldest unknown ancestor down
+        unknown = []
+        current = node
+        while current is not None and current not in self._ids:
+            unknown.append(current)
+            current = current.parent
+        parent_id = self._ids[current] if current is not None else str(chat_id)
+        for current in reversed(unknown):
+            digest = hashlib.blake2b(parent_id.encode(), digest_size=16)
+            digest.update(json.dumps(current.message.to_wire(), ensure_ascii=False, sort_keys=True).encode())
+            parent_id = self._ids[current] = digest.hexdigest()
+            self._nodes[parent_id] = current
+        return self._ids[node]
+
+    def _insert_nodes(self, chat_id: int, node: ConversationNode):
+        # a stored node always has all of its ancestors stored, so the walk stops at the first known one
+        current = node
+        while current is not None:
+            inserted = self._db.execute(
+                "INSERT OR IGNORE INTO conversation_nodes (id, parent_id, chat_id, message, size_bytes, summary) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._ids[current], self._ids[current.parent] if current.parent is not None else None, chat_id,
+                 json.dumps(current.message.to_wire(), ensure_ascii=False), current.size_bytes,
+                 json.dumps(current.summary.to_wire(), ensure_ascii=False) if current.summary is not None else None)
+            ).rowcount
+            if not inserted:
+                break
+            current = current.parent
+
+    def _load(self, node_id: str) -> typing.Optional[ConversationNode]:
+        node = self._nodes.get(node_id)
+        if node is not None:
+            return node
+
+        # rows of the nodes missing in memory, the newest goes first
+        rows = []
+        parent = None
+        for row in self._db.execute(_CHAIN_QUERY, (node_id,)):
+            parent = self._nodes.get(row[0])
+            if parent is not None:
+                break
+            rows.append(row)
+        if not rows or (parent is None and rows[-1][1] is not None):
+            # the conversation was swept while being read
+            return None
+
+        for row_id, _, message, size_bytes, summary in reversed(rows):
+            message = AnthropicConversationMessage.model_validate_json(message)
+            summary = AnthropicConversationMessage.model_validate_json(summary) if summary is not None else None
+            if parent is None:
+                node = ConversationNode(message=message, depth=1, size_bytes=size_bytes,
+                                        history_tokens=size_bytes // BYTES_PER_TOKEN, summary=summary)
+            else:
+                node = ConversationNode(message=message, parent=parent, depth=parent.depth + 1, size_bytes=size_bytes,
+                                        history_tokens=parent.history_tokens + size_bytes // BYTES_PER_TOKEN,
+                                        summary=summary)
+            self._ids[node] = row_id
+            self._nodes[row_id] = node
+            parent = node
+        return node
+
+    def _sweep(self):
+        now = self._timer()
+        self._next_sweep_at = now + self._sweep_interval_seconds
+        with self._transaction():
+            self._write_touched()
+            expired, _ = self._delete_entries(
+                "SELECT rowid, node_id FROM conversation_entries WHERE expires_at <= ?", (now,))
+            if expired:
+                self._stats.evictions["ttl"] += expired
+
+            # the least recently used entries are dropped in batches while a chat or the whole store is too large
+            large_chats = self._db.execute(
+                "SELECT chat_id, SUM(size_bytes) FROM conversation_nodes GROUP BY chat_id HAVING SUM(size_bytes) > ?",
+                (self._max_bytes_per_chat,)).fetchall()
+            for chat_id, chat_bytes in large_chats:
+                while chat_bytes > self._max_bytes_per_chat:
+                    evicted, freed_bytes = self._evict_oldest("WHERE chat_id = ?", (chat_id,))
+                    if not evicted:
+                        break
+                    self._stats.evictions["chat_cap"] += evicted
+                    chat_bytes -= freed_bytes
+            size_bytes = self._db.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM conversation_nodes").fetchone()[0]
+            while size_bytes > self._max_bytes:
+                evicted, freed_bytes = self._evict_oldest("", ())
+                if not evicted:
+                    break
+                self._stats.evictions["lru"] += evicted
+                size_bytes -= freed_bytes
+
+            self._stats.size_bytes = size_bytes
+            self._stats.entries = self._db.execute("SELECT COUNT(*) FROM conversation_entries").fetchone()[0]
+            self._stats.nodes = self._db.execute("SELECT COUNT(*) FROM conversation_nodes").fetchone()[0]
+
+    def _write_touched(self):
+        # an entry replaced since it was touched may expire later already
+        self._db.executemany(
+            "UPDATE conversation_entries SET expires_at = MAX(expires_at, ?) WHERE chat_id = ? AND message_id = ?",
+            [(expires_at, chat_id, message_id) for (chat_id, message_id), expires_at in self._touched.items()])
+        self._touched.clear()
+
+    def _evict_oldest(self, where: str, params: typing.Tuple) -> typing.Tuple[int, int]:
+        """
+        Drops the oldest tenth of the matching entries (at least one) and the nodes only they referenced.
+        Returns the number of dropped entries and the size of the dropped nodes.
+        """
+        count = self._db.execute(f"SELECT COUNT(*) FROM conversation_entries {where}", params).fetchone()[0]
+        if not count:
+            return 0, 0
+        return self._delete_entries(
+            f"SELECT rowid, node_id FROM conversation_entries {where} ORDER BY expires_at LIMIT ?",
+            (*params, max(count // 10, 1)))
+
+    def _delete_entries(self, query: str, params: typing.Tuple) -> typing.Tuple[int, int]:
+        """
+        Deletes the entries `query` selects (as `rowid, node_id`) and the nodes only they referenced.
+        Returns the number of deleted entries and the size of the deleted nodes.
+        """
+        rows = self._db.execute(query, params).fetchall()
+        self._db.executemany("DELETE FROM conversation_entries WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
+        return len(rows), self._delete_unreferenced(node_id for _, node_id in rows)
+
+    def _delete_unreferenced(self, node_ids: typing.Iterable[str]) -> int:
+        """
+        Deletes the nodes of `node_ids` which nothing references anymore, then their parents the same way, so only
+        the conversations of deleted entries are walked. Returns the size of the deleted nodes.
+        """
+        deleted_bytes = 0
+        pending = list(node_ids)
+        while pending:
+            node_id = pending.pop()
+            row = self._db.execute(_UNREFERENCED_NODE, (node_id,)).fetchone()
+            if row is None:
+                continue
+            self._db.execute("DELETE FROM conversation_nodes WHERE id = ?", (node_id,))
+            parent_id, size_bytes = row
+            deleted_bytes += size_bytes
+            if parent_id is not None:
+                pending.append(parent_id)
+        return deleted_bytes
@@ -0,0 +1,127 @@
+"""
+Token usage per chat, model and day.
+
+Print the totals of a database, heaviest chats first:
+    python -m db.usage usage.sqlite3 [--since 2025-01-31]
+"""
+import argparse
+import dataclasses
+import time
+import typing
+
+from db import sqlite
+from realm.anthropic.models import AnthropicUsage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_usage (
+    chat_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    day TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cache_read_tokens INTEGER NOT NULL,
+    cache_write_tokens INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, model, day)
+);
+"""
+
+_UPSERT = """
+INSERT INTO token_usage (chat_id, model, day, requests, input_tokens, output_tokens, cache_read_tokens,
+                         cache_write_tokens)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (chat_id, model, day) DO UPDATE SET
+    requests = requests + excluded.requests,
+    input_tokens = input_tokens + excluded.input_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    cache_read_tokens = cache_read_tokens + excluded.cache_read_tokens,
+    cache_write_tokens = cache_write_tokens + excluded.cache_write_tokens
+"""
+
+
+@dataclasses.dataclass
+class ChatUsage:
+    chat_id: int
+    model: str
+    requests: int
+    input_tokens: int
+    output_tokens: int
+    cache_read_tokens: int
+    cache_write_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens + self.cache_read_tokens + self.cache_write_tokens
+
+
+class UsageStore:
+    """
+    Keeps token counts of every completion in a SQLite database, summed per chat, model and day (UTC). Every
+    process using the same file adds to the same counts.
+
+    Counts are summed in memory and written in a single transaction once per `flush_interval_seconds` (and on
+    `close`), so a completion doesn't wait for the disk.
+    """
+
+    def __init__(self, path: str, flush_interval_seconds: float = 60, timer: typing.Callable[[], float] = time.time):
+        self._flush_interval_seconds = flush_interval_seconds
+        self._timer = timer
+        self._db = sqlite.connect(path)
+        self._db.executescript(_SCHEMA)
+        # (chat_id, model, day) -> [requests, input, output, cache read, cache write], not written yet
+        self._pending: typing.Dict[typing.Tuple[int, str, str], typing.List[int]] = {}
+        self._next_flush_at = timer() + flush_interval_seconds
+
+    def record(self, chat_id: int, model: str, usage: AnthropicUsage):
+        now = self._timer()
+        day = time.strftime("%Y-%m-%d", time.gmtime(now))
+        counts = self._pending.setdefault((chat_id, model, day), [0, 0, 0, 0, 0])
+        for i, tokens in enumerate((1, usage.input_tokens, usage.output_tokens, usage.cache_read_input_tokens,
+                                    usage.cache_creation_input_tokens)):
+            counts[i] += tokens
+        if now >= self._next_flush_at:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the counts recorded since the last flush. They are kept for the next flush if writing fails.
+        """
+        self._next_flush_at = self._timer() + self._flush_interval_seconds
+        if not self._pending:
+            return
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(_UPSERT, [(*key, *counts) for key, counts in self._pending.items()])
+        self._pending.clear()
+
+    def totals(self, since: typing.Optional[str] = None) -> typing.List[ChatUsage]:
+        """
+        Returns usage per chat and model, since the given day (`YYYY-MM-DD`, inclusive) or for all time.
+        """
+        self.flush()
+        rows = self._db.execute(
+            "SELECT chat_id, model, SUM(requests), SUM(input_tokens), SUM(output_tokens), SUM(cache_read_tokens), "
+            "SUM(cache_write_tokens) FROM token_usage WHERE day >= ? GROUP BY chat_id, model",
+            (since or "",)).fetchall()
+        return [ChatUsage(*row) for row in rows]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="usage database")
+    parser.add_argument("--since", help="first day to count, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    store = UsageStore(args.path)
+    print(f"{'chat':>16}  {'model':<28}{'requests':>9}{'input':>12}{'output':>12}{'cache read':>12}"
+          f"{'cache write':>12}")
+    for u in sorted(store.totals(args.since), key=lambda u: u.total_tokens, reverse=True):
+        print(f"{u.chat_id:>16}  {u.model:<28}{u.requests:>9}{u.input_tokens:>12}{u.output_tokens:>12}"
+              f"{u.cache_read_tokens:>12}{u.cache_write_tokens:>12}")
+    store.close()
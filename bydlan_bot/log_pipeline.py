@@ -0,0 +1,160 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import typing
+
+import structlog
+
+from metrics.registry import REGISTRY
+
+# Chatty events on the hot path, logged for a fraction of occurrences unless configured otherwise
+DEFAULT_SAMPLE_RATES = {
+    "fetched parent message from telegram": 0.1,
+    "sending reply message": 0.1,
+    "sending streamed reply message": 0.1,
+    "request waited in scheduler queue": 0.1,
+}
+
+# Warnings and errors are never sampled out
+_SAMPLED_LEVELS = {"debug", "info"}
+# Fields written first and never truncated
+_HEADER_FIELDS = ("timestamp", "level", "event")
+_UNTRUNCATED_FIELDS = {*_HEADER_FIELDS, "exception"}
+
+_STOP = object()
+
+_SAMPLED_OUT = REGISTRY.counter("bydlan_log_events_sampled_out_total", "Log events dropped by sampling", ["event"])
+_DROPPED = REGISTRY.counter("bydlan_log_events_dropped_total", "Log events dropped because the log queue was full")
+
+
+def parse_sample_rates(value: str) -> typing.Dict[str, float]:
+    """
+    Parses `event=rate` pairs separated by `;`, e.g. `completion received=0.5;coalesced triggers=0.1`.
+    """
+    rates = {}
+    for pair in value.split(";"):
+        if "=" not in pair:
+            continue
+        event, rate = pair.rsplit("=", 1)
+        try:
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            print(f"WARNING: invalid log sample rate {pair!r}, ignoring it")
+    return rates
+
+
+class EventSampler:
+    """
+    Drops a share of `debug` and `info` events, by event name. Runs first, so sampled out events cost nothing else.
+    """
+
+    def __init__(self, rates: typing.Dict[str, float]):
+        self._rates = rates
+
+    def __call__(self, _, method_name: str, event_dict: structlog.typing.EventDict) -> structlog.typing.EventDict:
+        if method_name in _SAMPLED_LEVELS:
+            rate = self._rates.get(event_dict.get("event"))
+            if rate is not None and random.random() >= rate:
+                _SAMPLED_OUT.inc(event=event_dict.get("event"))
+                raise structlog.DropEvent
+        return event_dict
+
+
+class FieldTruncator:
+    """
+    Turns every field which is not a plain number into a string of at most `max_chars` characters. Runs last, so
+    only strings and numbers are queued: objects in fields may change (or not be thread-safe) by the time the writer
+    thread gets to them.
+    """
+
+    def __init__(self, max_chars: int):
+        self._max_chars = max_chars
+
+    def __call__(self, _, __, event_dict: structlog.typing.EventDict) -> structlog.typing.EventDict:
+        for key, value in event_dict.items():
+            if key in _UNTRUNCATED_FIELDS or value is None or isinstance(value, (bool, int, float)):
+                continue
+            text = value if isinstance(value, str) else str(value)
+            if len(text) > self._max_chars:
+                text = f"{text[:self._max_chars]}…(+{len(text) - self._max_chars} chars)"
+            event_dict[key] = text
+        return event_dict
+
+
+class QueueWriter:
+    """
+    Serializes and writes log events in a background thread. The event loop only puts events to a bounded queue,
+    events are dropped (and counted) rather than blocking when the writer falls behind.
+    """
+
+    def __init__(self, stream: typing.TextIO, max_queued: int):
+        self._stream = stream
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, event_dict: structlog.typing.EventDict):
+        try:
+            self._queue.put_nowait(event_dict)
+        except queue.Full:
+            _DROPPED.inc()
+
+    def stop(self, timeout: float = 5):
+        """
+        Writes the queued events and stops the thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            event_dict = self._queue.get()
+            if event_dict is _STOP:
+                break
+            try:
+                ordered = {key: event_dict.pop(key) for key in _HEADER_FIELDS if key in event_dict}
+                line = json.dumps({**ordered, **event_dict}, ensure_ascii=False, default=str)
+            except Exception as e:
+                line = json.dumps({"event": "failed to render log event", "error": repr(e)})
+            self._stream.write(line + "\n")
+            # lines are flushed as soon as the queue is drained, not one by one
+            if self._queue.empty():
+                self._stream.flush()
+
+
+class _QueueLogger:
+    def __init__(self, writer: QueueWriter):
+        self._writer = writer
+
+    def msg(self, **event_dict):
+        self._writer.put(event_dict)
+
+    debug = info = warning = warn = error = critical = exception = fatal = log = msg
+
+
+def configure_production(max_field_chars: int, sample_rates: typing.Dict[str, float], max_queued: int):
+    """
+    Logs one JSON object per line to stdout. Events are processed in the calling thread down to strings and numbers,
+    serializing and writing them happens in a background writer thread.
+    """
+    writer = QueueWriter(sys.stdout, max_queued)
+    atexit.register(writer.stop)
+    structlog.configure(
+        processors=[
+            EventSampler(sample_rates),
+            structlog.contextvars.merge_contextvars,
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="iso"),
+            structlog.processors.dict_tracebacks,
+            FieldTruncator(max_field_chars),
+        ],
+        context_class=dict,
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+        logger_factory=lambda *_: _QueueLogger(writer),
+        cache_logger_on_first_use=True,
+    )
@@ -2,25 +2,41 @@ import asyncio
 import signal
 import os
 import sys
+import time
 import structlog
 import random
 from pyrogram import idle
+from db import kv
+import log_pipeline
+from metrics import server as metrics_server
 from realm.anthropic import api as anthropic_api
-from bydlan import init as bydlan_init, graceful_shutdown, get_bydlan
+from realm.telegram import sharding
+from bydlan import (init as bydlan_init, graceful_shutdown, get_bydlan, has_saved_session,
+                    restore_conversations)
 from pyrogram.errors import FloodWait
 
-# Configure logging - simpler for Railway
-structlog.configure(
-    processors=[
-        structlog.stdlib.add_log_level,
-        structlog.processors.TimeStamper(fmt="iso"),
-        structlog.processors.dict_tracebacks,
-        structlog.dev.ConsoleRenderer()
-    ],
-    context_class=dict,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    cache_logger_on_first_use=True,
-)
+# Configure logging - simpler for Railway.
+# Production mode writes sampled JSON lines with truncated fields from a background thread.
+if kv.get_setting(kv.Settings.log_production, False):
+    log_pipeline.configure_production(
+        max_field_chars=kv.get_setting(kv.Settings.log_max_field_chars, 512),
+        sample_rates={**log_pipeline.DEFAULT_SAMPLE_RATES,
+                      **log_pipeline.parse_sample_rates(kv.get_setting(kv.Settings.log_sample_rates, ""))},
+        max_queued=kv.get_setting(kv.Settings.log_max_queued, 10_000),
+    )
+else:
+    structlog.configure(
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            structlog.stdlib.add_log_level,
+            structlog.processors.TimeStamper(fmt="iso"),
+            structlog.processors.dict_tracebacks,
+            structlog.dev.ConsoleRenderer()
+        ],
+        context_class=dict,
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        cache_logger_on_first_use=True,
+    )
 
 logger = structlog.get_logger()
 
@@ -37,58 +53,84 @@ def check_env_vars():
     
     logger.info("✅ All environment variables present")
 
+async def init_anthropic():
+    started_at = time.monotonic()
+    logger.info("Connecting to Anthropic API...")
+    await anthropic_api.init()
+    logger.info("✅ Anthropic API connected", seconds=round(time.monotonic() - started_at, 3))
+
+
+async def connect_telegram() -> bool:
+    started_at = time.monotonic()
+    retry_count = 0
+    max_retries = 3
+
+    while retry_count < max_retries:
+        try:
+            logger.info(f"Connecting to Telegram (attempt {retry_count + 1}/{max_retries})...")
+            await bydlan_init()
+            logger.info("✅ Telegram bot connected", seconds=round(time.monotonic() - started_at, 3))
+            return True
+
+        except FloodWait as e:
+            retry_count += 1
+            wait_time = min(e.value, 300)
+            logger.warning(f"Rate limited. Waiting {wait_time} seconds...")
+
+            if retry_count >= max_retries:
+                logger.error("Too many rate limit errors. Exiting.")
+                return False
+
+            await asyncio.sleep(wait_time)
+
+        except Exception as e:
+            retry_count += 1
+            logger.error(f"Connection failed: {e}")
+
+            if retry_count >= max_retries:
+                logger.error("Could not connect to Telegram after 3 attempts")
+                return False
+
+            wait_time = 30 * retry_count
+            logger.info(f"Retrying in {wait_time} seconds...")
+            await asyncio.sleep(wait_time)
+    return False
+
+
 async def main():
+    started_at = time.monotonic()
     logger.info("=" * 50)
     logger.info("STARTING BYDLAN BOT")
     logger.info("=" * 50)
     
     # Check environment variables
     check_env_vars()
+
+    # Expose metrics, set port to 0 to disable. Workers of a sharded deployment listen on consecutive ports.
+    metrics_port = kv.get_setting(kv.Settings.metrics_port, 9090)
+    if metrics_port:
+        metrics_port += max(sharding.WORKER_INDEX, 0)
+        try:
+            await metrics_server.start(kv.get_setting(kv.Settings.metrics_host, "127.0.0.1"), metrics_port)
+        except OSError as e:
+            logger.error(f"Failed to start metrics endpoint: {e}")
     
-    # Small delay to avoid rate limits
-    delay = random.randint(3, 10)
-    logger.info(f"Waiting {delay} seconds before connecting...")
-    await asyncio.sleep(delay)
+    # Small delay to avoid rate limits when signing the bot in. A saved session doesn't sign in again.
+    if has_saved_session():
+        logger.info("Telegram session found, connecting right away")
+    else:
+        delay = random.uniform(kv.get_setting(kv.Settings.startup_delay_min_seconds, 3.0),
+                               kv.get_setting(kv.Settings.startup_delay_max_seconds, 10.0))
+        logger.info(f"Waiting {delay:.1f} seconds before connecting...")
+        await asyncio.sleep(delay)
     
     try:
-        # Initialize Anthropic API
-        logger.info("Connecting to Anthropic API...")
-        await anthropic_api.init()
-        logger.info("✅ Anthropic API connected")
-        
-        # Initialize Telegram bot
-        retry_count = 0
-        max_retries = 3
-        
-        while retry_count < max_retries:
-            try:
-                logger.info(f"Connecting to Telegram (attempt {retry_count + 1}/{max_retries})...")
-                await bydlan_init()
-                logger.info("✅ Telegram bot connected")
-                break
-                
-            except FloodWait as e:
-                retry_count += 1
-                wait_time = min(e.value, 300)
-                logger.warning(f"Rate limited. Waiting {wait_time} seconds...")
-                
-                if retry_count >= max_retries:
-                    logger.error("Too many rate limit errors. Exiting.")
-                    return 1
-                    
-                await asyncio.sleep(wait_time)
-                
-            except Exception as e:
-                retry_count += 1
-                logger.error(f"Connection failed: {e}")
-                
-                if retry_count >= max_retries:
-                    logger.error("Could not connect to Telegram after 3 attempts")
-                    return 1
-                
-                wait_time = 30 * retry_count
-                logger.info(f"Retrying in {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
+        restore_conversations()
+
+        # Both APIs are initialized at the same time
+        _, connected = await asyncio.gather(init_anthropic(), connect_telegram())
+        if not connected:
+            return 1
         
         # Check if bot is ready
         client = get_bydlan()
@@ -97,7 +139,7 @@ async def main():
             return 1
         
         logger.info("=" * 50)
-        logger.info("🎉 BOT IS RUNNING! 🎉")
+        logger.info("🎉 BOT IS RUNNING! 🎉", startup_seconds=round(time.monotonic() - started_at, 3))
         logger.info("Add bot to a Telegram group")
         logger.info("Make bot admin in the group")
         logger.info("Type: быдлан привет")
@@ -112,13 +154,74 @@ async def main():
     finally:
         logger.info("Shutting down...")
         await graceful_shutdown()
+        await anthropic_api.close()
+        await metrics_server.stop()
         logger.info("Shutdown complete")
         return 0
 
+async def supervise(worker_count: int):
+    """
+    Runs the bot in `worker_count` processes, chats are split between them (see `realm.telegram.sharding`).
+    Workers that exit are restarted, conversations survive as they are kept in a shared SQLite file.
+    """
+    env = dict(os.environ)
+    if not env.get(kv.Settings.conversations_db.value, "").strip():
+        env[kv.Settings.conversations_db.value] = "conversations.sqlite3"
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    processes = {}
+
+    async def run_worker(index: int):
+        restarts = 0
+        while not stopping.is_set():
+            started_at = loop.time()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env={**env, kv.Settings.worker_index.value: str(index)})
+            processes[index] = process
+            logger.info("worker started", worker=index, pid=process.pid)
+            exit_code = await process.wait()
+            if stopping.is_set():
+                break
+
+            # a worker which ran for a while is restarted right away, a crashing one is backed off
+            restarts = restarts + 1 if loop.time() - started_at < 60 else 0
+            delay = min(5 * restarts, 60)
+            logger.warning("worker exited, restarting", worker=index, exit_code=exit_code, restart_in_seconds=delay)
+            try:
+                await asyncio.wait_for(stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    workers = [asyncio.create_task(run_worker(index)) for index in range(worker_count)]
+    logger.info("supervising workers", workers=worker_count, conversations_db=env[kv.Settings.conversations_db.value])
+    await stopping.wait()
+
+    logger.info("stopping workers")
+    for process in processes.values():
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.gather(*workers), 60)
+    except asyncio.TimeoutError:
+        for process in processes.values():
+            if process.returncode is None:
+                logger.warning("worker didn't stop in time, killing it", pid=process.pid)
+                process.kill()
+    return 0
+
 if __name__ == "__main__":
     # Simple runner for Railway
     try:
-        exit_code = asyncio.run(main())
+        if sharding.is_supervisor():
+            exit_code = asyncio.run(supervise(sharding.WORKER_COUNT))
+        else:
+            if sharding.WORKER_INDEX >= 0:
+                structlog.contextvars.bind_contextvars(worker=sharding.WORKER_INDEX)
+            exit_code = asyncio.run(main())
         sys.exit(exit_code or 0)
     except KeyboardInterrupt:
         print("\nBot stopped by user")
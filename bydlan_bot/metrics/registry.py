@@ -0,0 +1,156 @@
+import bisect
+import contextlib
+import math
+import time
+import typing
+
+# Default histogram buckets (seconds), from tens of milliseconds up to a slow completion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+LabelValues = typing.Tuple[str, ...]
+
+
+def _format_labels(names: typing.Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _label_values(self, labels: typing.Dict[str, typing.Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> typing.List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}",
+                *self._samples()]
+
+    def _samples(self) -> typing.List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: typing.Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def _samples(self) -> typing.List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    A gauge whose values are read from `collect` at scrape time, so state owners don't need to push updates.
+    `collect` returns label values -> value.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 collect: typing.Callable[[], typing.Dict[LabelValues, float]], labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._collect = collect
+
+    def _samples(self) -> typing.List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._collect().items()]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts + the +Inf bucket, sum)
+        self._values: typing.Dict[LabelValues, typing.Tuple[typing.List[int], typing.List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        counts, total = self._values.setdefault(key, ([0] * (len(self._buckets) + 1), [0.0]))
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at, **labels)
+
+    def _samples(self) -> typing.List[str]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self._buckets, math.inf), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}")
+            samples.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: typing.Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: typing.Sequence[str] = (),
+                  buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, collect: typing.Callable[[], typing.Dict[LabelValues, float]],
+              labelnames: typing.Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, collect, labelnames))
+
+    def render(self) -> str:
+        """
+        Renders all metrics in Prometheus text exposition format.
+        https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
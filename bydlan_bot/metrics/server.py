@@ -0,0 +1,48 @@
+import asyncio
+import typing
+
+import structlog
+
+from metrics.registry import REGISTRY
+
+logger = structlog.get_logger()
+
+_SERVER: typing.Optional[asyncio.AbstractServer] = None
+
+
+async def start(host: str, port: int):
+    """
+    Serves `GET /metrics` in Prometheus text format.
+    """
+    global _SERVER
+    _SERVER = await asyncio.start_server(_handle_connection, host, port)
+    logger.info("metrics endpoint started", url=f"http://{host}:{port}/metrics")
+
+
+async def stop():
+    global _SERVER
+    if _SERVER:
+        _SERVER.close()
+        await _SERVER.wait_closed()
+        _SERVER = None
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # skip the headers, the request never has a body
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", REGISTRY.render().encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning("failed to serve metrics", error=e)
+    finally:
+        writer.close()
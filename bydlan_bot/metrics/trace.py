@@ -0,0 +1,86 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import typing
+
+# Events are written to disk in batches of this many
+_FLUSH_EVERY = 100
+
+TRACE_VERSION = 1
+
+
+def open_trace(path: str, mode: str) -> typing.TextIO:
+    """
+    Opens a trace file, gzip-compressed when the name ends with `.gz`.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TraceRecorder:
+    """
+    Records the traffic the bot sees as an anonymized trace: one compact JSON object per line, replayable with
+    `bench.replay`.
+
+    No text is recorded, only its length. Chat and user ids are replaced with salted hashes (the salt is random and
+    never saved, so traces can't be linked to chats or to each other), message ids are kept as they are only
+    meaningful within a chat. A trace is a single recording: an existing file is overwritten.
+
+    Events (`t` is milliseconds since the trace started):
+      - `{"k": "m", "t", "c": chat, "m": message id, "r": replied-to id, "u": user, "l": text length,
+        "tr": 0 - not a trigger, 1 - prefix trigger, 2 - reply to the bot}` for every group message;
+      - `{"k": "s", "t", "c", "m", "r", "l"}` for every message the bot sends;
+      - `{"k": "a", "t", "c", "model", "lat": completion seconds, "n": response length, "in", "out", "cr", "cw":
+        tokens}` for every completion.
+    """
+
+    def __init__(self, path: str, timer: typing.Callable[[], float] = time.monotonic):
+        self._timer = timer
+        self._started_at = timer()
+        self._salt = os.urandom(16)
+        self._file = open_trace(path, "w")
+        self._pending = 0
+        self._write({"k": "h", "v": TRACE_VERSION, "started_at": round(time.time())})
+
+    def message(self, chat_id: int, message_id: int, reply_to_id: typing.Optional[int],
+                user_id: typing.Optional[int], text_length: int, trigger: int):
+        self._write({"k": "m", "t": self._now(), "c": self._anonymize(chat_id), "m": message_id, "r": reply_to_id,
+                     "u": self._anonymize(user_id) if user_id is not None else None, "l": text_length,
+                     "tr": trigger})
+
+    def sent(self, chat_id: int, message_id: int, reply_to_id: typing.Optional[int], text_length: int):
+        self._write({"k": "s", "t": self._now(), "c": self._anonymize(chat_id), "m": message_id, "r": reply_to_id,
+                     "l": text_length})
+
+    def completion(self, chat_id: int, model: str, latency_seconds: float, response_length: int, input_tokens: int,
+                   output_tokens: int, cache_read_tokens: int, cache_write_tokens: int):
+        self._write({"k": "a", "t": self._now(), "c": self._anonymize(chat_id), "model": model,
+                     "lat": round(latency_seconds, 3), "n": response_length, "in": input_tokens, "out": output_tokens,
+                     "cr": cache_read_tokens, "cw": cache_write_tokens})
+
+    def close(self):
+        self._file.close()
+
+    def _now(self) -> int:
+        return round((self._timer() - self._started_at) * 1000)
+
+    def _anonymize(self, value: int) -> int:
+        digest = hashlib.blake2b(str(value).encode(), key=self._salt, digest_size=6).digest()
+        return int.from_bytes(digest, "big")
+
+    def _write(self, event: dict):
+        self._file.write(json.dumps(event, separators=(",", ":")) + "\n")
+        self._pending += 1
+        if self._pending >= _FLUSH_EVERY:
+            self._file.flush()
+            self._pending = 0
+
+
+def read_trace(path: str) -> typing.Iterator[dict]:
+    with open_trace(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -1,19 +1,71 @@
+import asyncio
+import time
 from enum import StrEnum
-from typing import List
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
 
+import anthropic.types
 import structlog
 from anthropic import AsyncAnthropic, NOT_GIVEN
 
 import db.kv
-from realm.anthropic.models import AnthropicConversationMessage, AnthropicMessageAuthorRole
+from metrics.registry import REGISTRY
+from realm.anthropic.models import AnthropicConversationMessage, AnthropicMessageAuthorRole, AnthropicUsage
+from realm.anthropic.resilience import (Deadline, DeadlineExceeded, LatencyTracker, backoff_seconds, hedged,
+                                        is_retryable)
+from realm.anthropic.response_cache import ResponseCache, make_key
+from realm.anthropic.transport import KEEPALIVE_PING_SECONDS, KeepAlive, build_http_client, warm_up
+
+R = TypeVar("R")
 
 # Must be < than model's max_tokens().
 # Note that streaming is required when max_tokens is greater than 21,333.
 # For thinking budgets above 32K: We recommend using batch processing.
 # https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking
 THINKING_TOKENS_BUDGET = 16_000
+# Smallest thinking budget the API accepts
+MIN_THINKING_TOKENS = 1024
+# Part of max_tokens always left for the answer when thinking is enabled
+MIN_ANSWER_TOKENS = 1024
+
+# Marks the end of a cacheable prompt prefix.
+# https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+# Time budget of a single completion, including retries and fallbacks
+COMPLETION_DEADLINE_SECONDS = db.kv.get_setting(db.kv.Settings.completion_deadline_seconds, 180.0)
+# Attempts per model before falling back to the next one, at least one
+COMPLETION_ATTEMPTS_PER_MODEL = max(db.kv.get_setting(db.kv.Settings.completion_attempts_per_model, 2), 1)
+
+
+def _parse_hedge_quantile(value: float) -> float:
+    if 0.0 <= value <= 1.0:
+        return value
+    print(f"WARNING: completion hedge quantile {value!r} is not between 0 and 1, hedging is disabled")
+    return 0.0
+
 
-_CLIENT: AsyncAnthropic
+# A second identical request is sent when the first one is slower than this quantile (e.g. 0.95) of recent latencies.
+# Set to 0 to disable hedging.
+COMPLETION_HEDGE_QUANTILE = _parse_hedge_quantile(db.kv.get_setting(db.kv.Settings.completion_hedge_quantile, 0.0))
+
+# Identical requests (same model, system prompt and conversation) are answered from a cache of this many
+# responses. Set to 0 to disable the cache.
+RESPONSE_CACHE_SIZE = db.kv.get_setting(db.kv.Settings.response_cache_size, 0)
+RESPONSE_CACHE_TTL_SECONDS = db.kv.get_setting(db.kv.Settings.response_cache_ttl_seconds, 600.0)
+
+_CLIENT: Optional[AsyncAnthropic] = None
+_KEEPALIVE: Optional[KeepAlive] = None
+_LATENCIES = LatencyTracker()
+_RESPONSE_CACHE: Optional[ResponseCache] = \
+    ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS) if RESPONSE_CACHE_SIZE > 0 else None
+
+_REQUEST_SECONDS = REGISTRY.histogram("anthropic_request_seconds", "Anthropic API request latency",
+                                      ["model", "outcome"])
+_FIRST_TOKEN_SECONDS = REGISTRY.histogram("anthropic_first_token_seconds",
+                                          "Time to the first text delta of streamed completions", ["model"])
+_TOKENS = REGISTRY.counter("anthropic_tokens_total", "Tokens used by completions", ["model", "kind"])
+REGISTRY.gauge("anthropic_response_cache_entries", "Responses in the response cache",
+               lambda: {(): _RESPONSE_CACHE.stats().entries} if _RESPONSE_CACHE else {})
 
 logger = structlog.get_logger()
 
@@ -26,6 +78,7 @@ class AnthropicModel(StrEnum):
     # Taken from https://docs.anthropic.com/en/docs/about-claude/models
     CLAUDE_3_7_SONNET_LATEST = "claude-3-7-sonnet-latest"
     CLAUDE_SONNET_4_LATEST = "claude-sonnet-4-20250514"
+    CLAUDE_3_5_HAIKU_LATEST = "claude-3-5-haiku-latest"
 
     def max_tokens(self) -> int:
         if self == AnthropicModel.CLAUDE_3_7_SONNET_LATEST:
@@ -39,33 +92,88 @@ class AnthropicModel(StrEnum):
         elif self == AnthropicModel.CLAUDE_SONNET_4_LATEST:
             # Same as in 3.7
             return 20_000
+        elif self == AnthropicModel.CLAUDE_3_5_HAIKU_LATEST:
+            # No extended thinking, so its max output is the limit
+            return 8192
         else:
             raise ValueError(f"max_tokens: unknown model: {self}")
 
+    def supports_thinking(self) -> bool:
+        if self in (AnthropicModel.CLAUDE_3_7_SONNET_LATEST, AnthropicModel.CLAUDE_SONNET_4_LATEST):
+            return True
+        elif self == AnthropicModel.CLAUDE_3_5_HAIKU_LATEST:
+            return False
+        else:
+            raise ValueError(f"supports_thinking: unknown model: {self}")
+
+    def fallback_models(self) -> List["AnthropicModel"]:
+        """
+        Models to try (in order) when this one keeps failing.
+        """
+        if self == AnthropicModel.CLAUDE_3_7_SONNET_LATEST:
+            return [AnthropicModel.CLAUDE_SONNET_4_LATEST]
+        elif self == AnthropicModel.CLAUDE_SONNET_4_LATEST:
+            return [AnthropicModel.CLAUDE_3_7_SONNET_LATEST]
+        elif self == AnthropicModel.CLAUDE_3_5_HAIKU_LATEST:
+            return [AnthropicModel.CLAUDE_SONNET_4_LATEST]
+        else:
+            raise ValueError(f"fallback_models: unknown model: {self}")
+
 
 async def init():
     api_key = await db.kv.get_value(db.kv.Keys.bydlan_anthropic_api_key)
-    global _CLIENT
-    _CLIENT = AsyncAnthropic(api_key=api_key)
+    global _CLIENT, _KEEPALIVE
+    # Retries are done by `_call_with_fallbacks`, so they share the completion deadline
+    http_client = build_http_client()
+    _CLIENT = AsyncAnthropic(api_key=api_key, max_retries=0, http_client=http_client)
+    # the first reply shouldn't wait for TCP and TLS handshakes
+    base_url = str(_CLIENT.base_url)
+    await warm_up(http_client, base_url)
+    if KEEPALIVE_PING_SECONDS > 0:
+        _KEEPALIVE = KeepAlive(http_client, base_url, KEEPALIVE_PING_SECONDS)
+        _KEEPALIVE.start()
+
+
+async def close():
+    global _KEEPALIVE
+    if _KEEPALIVE is not None:
+        await _KEEPALIVE.stop()
+        _KEEPALIVE = None
+    if _CLIENT is not None:
+        await _CLIENT.close()
 
 
-async def create_completion(model: AnthropicModel, system_prompt: str,
-                            messages: List[AnthropicConversationMessage]) -> AnthropicConversationMessage:
+def _build_request(model: AnthropicModel, system_prompt: str, messages: List[AnthropicConversationMessage],
+                   max_tokens: Optional[int] = None, thinking_budget: int = 0) -> Dict[str, Any]:
     """
-    See https://docs.anthropic.com/en/api/messages for API reference
-    and https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking for thinking reasoning
+    Builds `messages.create` params with prompt cache breakpoints on the system prompt and on the last message.
+    The latter caches the whole conversation, so the next turn (which only appends to it) reads it from the cache.
+
+    `max_tokens` is capped by the model's limit. Thinking is enabled with `thinking_budget` tokens when it's not 0
+    and the model supports it.
     """
-    # Check how it goes without thinking
-    # thinking = {
-    #     "type": "enabled",
-    #     "budget_tokens": THINKING_TOKENS_BUDGET,
-    # }
-    thinking = NOT_GIVEN
-    serialized_messages = [m.dict() for m in messages]
-    response = await _CLIENT.messages.create(
+    max_tokens = min(max_tokens or model.max_tokens(), model.max_tokens())
+    # the budget is a part of max_tokens, and must leave room for the answer
+    thinking_budget = min(thinking_budget, max_tokens - MIN_ANSWER_TOKENS)
+    if thinking_budget >= MIN_THINKING_TOKENS and model.supports_thinking():
+        thinking = {
+            "type": "enabled",
+            "budget_tokens": thinking_budget,
+        }
+    else:
+        thinking = NOT_GIVEN
+    # Messages are serialized once and reused on every turn, so only new messages cost anything
+    serialized_messages = [m.to_wire() for m in messages]
+    if serialized_messages and serialized_messages[-1]["content"]:
+        # shallow copies, as wire representations are shared
+        last_message = serialized_messages[-1]
+        *content, last_block = last_message["content"]
+        last_block = {**last_block, "cache_control": _CACHE_CONTROL}
+        serialized_messages[-1] = {**last_message, "content": [*content, last_block]}
+    return dict(
         model=model,
-        max_tokens=model.max_tokens(),
-        system=system_prompt,
+        max_tokens=max_tokens,
+        system=[{"type": "text", "text": system_prompt, "cache_control": _CACHE_CONTROL}],
         messages=serialized_messages,
         thinking=thinking,
         # tools=[{
@@ -74,5 +182,129 @@ async def create_completion(model: AnthropicModel, system_prompt: str,
         #     "max_uses": 5,
         # }]
     )
-    result = AnthropicConversationMessage(role=AnthropicMessageAuthorRole.assistant, content=response.content)
-    return result
+
+
+def _to_conversation_message(response: anthropic.types.Message) -> AnthropicConversationMessage:
+    usage = AnthropicUsage.from_response_usage(response.usage)
+    logger.info("completion usage", model=response.model, **usage.dict())
+    for kind, tokens in usage.dict().items():
+        _TOKENS.inc(tokens, model=response.model, kind=kind.removesuffix("_tokens"))
+    # Thinking of previous turns is never used by the API, and models without thinking support reject it
+    # https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking
+    content = [block for block in response.content if block.type not in ("thinking", "redacted_thinking")]
+    return AnthropicConversationMessage(role=AnthropicMessageAuthorRole.assistant, content=content, usage=usage,
+                                        model=response.model)
+
+
+async def _call_with_fallbacks(model: AnthropicModel, attempt: Callable[[AnthropicModel, float], Awaitable[R]],
+                              can_retry: Callable[[], bool] = lambda: True) -> R:
+    """
+    Runs `attempt(model, timeout)` within `COMPLETION_DEADLINE_SECONDS` (`timeout` is what's left of it).
+    Retryable errors are retried with a jittered backoff up to `COMPLETION_ATTEMPTS_PER_MODEL` times per model, then
+    the next of `model.fallback_models()` is tried. Nothing is retried once `can_retry()` returns False.
+    """
+    deadline = Deadline(COMPLETION_DEADLINE_SECONDS)
+    last_error: Optional[BaseException] = None
+    for current_model in [model, *model.fallback_models()]:
+        for attempt_number in range(COMPLETION_ATTEMPTS_PER_MODEL):
+            if last_error is not None:
+                delay = min(backoff_seconds(attempt_number), deadline.remaining())
+                await asyncio.sleep(delay)
+            if deadline.remaining() <= 0:
+                raise DeadlineExceeded(f"completion didn't succeed in {COMPLETION_DEADLINE_SECONDS}s") from last_error
+
+            try:
+                result = await attempt(current_model, deadline.remaining())
+                if current_model != model or attempt_number > 0:
+                    logger.warning("completion succeeded after failures", requested_model=model,
+                                   model=current_model, attempt=attempt_number + 1, error=last_error)
+                return result
+            except Exception as e:
+                if not is_retryable(e) or not can_retry():
+                    raise
+                last_error = e
+                logger.warning("completion attempt failed", model=current_model, attempt=attempt_number + 1,
+                               error=e, remaining_seconds=round(deadline.remaining(), 1))
+    raise last_error
+
+
+async def create_completion(model: AnthropicModel, system_prompt: str, messages: List[AnthropicConversationMessage],
+                            max_tokens: Optional[int] = None, thinking_budget: int = 0) -> AnthropicConversationMessage:
+    """
+    See https://docs.anthropic.com/en/api/messages for API reference
+    and https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking for thinking reasoning
+
+    `max_tokens` and `thinking_budget` are described in `_build_request`.
+    Retries, falls back to other models and hedges slow requests, see `_call_with_fallbacks` and `hedged`.
+    Answers identical requests from the response cache when it's enabled.
+    """
+    cache_key = make_key(model, system_prompt, messages, max_tokens, thinking_budget) if _RESPONSE_CACHE else None
+    if cache_key:
+        cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info("completion served from cache", model=model)
+            return cached
+
+    async def attempt(current_model: AnthropicModel, timeout: float) -> anthropic.types.Message:
+        params = _build_request(current_model, system_prompt, messages, max_tokens, thinking_budget)
+        hedge_after = _LATENCIES.quantile(COMPLETION_HEDGE_QUANTILE) if COMPLETION_HEDGE_QUANTILE else None
+        started_at = time.monotonic()
+        try:
+            response, is_hedge = await asyncio.wait_for(
+                hedged(lambda: _CLIENT.messages.create(**params, timeout=timeout), hedge_after), timeout)
+        except Exception:
+            _REQUEST_SECONDS.observe(time.monotonic() - started_at, model=current_model, outcome="error")
+            raise
+        latency = time.monotonic() - started_at
+        _REQUEST_SECONDS.observe(latency, model=current_model, outcome="success")
+        _LATENCIES.record(latency)
+        logger.info("completion received", model=current_model, latency_seconds=round(latency, 3), hedged=is_hedge)
+        return response
+
+    response = _to_conversation_message(await _call_with_fallbacks(model, attempt))
+    if cache_key:
+        _RESPONSE_CACHE.put(cache_key, response)
+    return response
+
+
+async def create_completion_stream(model: AnthropicModel, system_prompt: str,
+                                   messages: List[AnthropicConversationMessage], on_text: Callable[[str], None],
+                                   max_tokens: Optional[int] = None,
+                                   thinking_budget: int = 0) -> AnthropicConversationMessage:
+    """
+    Same as `create_completion`, but consumes the response as an event stream and calls `on_text` with every text
+    delta as soon as it arrives. Thinking deltas are not passed to `on_text`.
+    See https://docs.anthropic.com/en/api/messages-streaming
+
+    Failed requests are retried (or fall back to other models) only until the first text delta is passed on.
+    Streams are not hedged, and the deadline only bounds waiting for the next event, not the whole stream.
+    A cached response is passed to `on_text` at once.
+    """
+    cache_key = make_key(model, system_prompt, messages, max_tokens, thinking_budget) if _RESPONSE_CACHE else None
+    if cache_key:
+        cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info("completion served from cache", model=model)
+            on_text("".join(cached.assistant_text_blocks()))
+            return cached
+
+    text_emitted = False
+
+    async def attempt(current_model: AnthropicModel, timeout: float) -> anthropic.types.Message:
+        nonlocal text_emitted
+        params = _build_request(current_model, system_prompt, messages, max_tokens, thinking_budget)
+        started_at = time.monotonic()
+        with _REQUEST_SECONDS.time(model=current_model, outcome="stream"):
+            async with _CLIENT.messages.stream(**params, timeout=timeout) as stream:
+                async for text in stream.text_stream:
+                    if not text_emitted:
+                        text_emitted = True
+                        _FIRST_TOKEN_SECONDS.observe(time.monotonic() - started_at, model=current_model)
+                    on_text(text)
+                return await stream.get_final_message()
+
+    response = _to_conversation_message(
+        await _call_with_fallbacks(model, attempt, can_retry=lambda: not text_emitted))
+    if cache_key:
+        _RESPONSE_CACHE.put(cache_key, response)
+    return response
@@ -0,0 +1,118 @@
+import typing
+
+import structlog
+
+from db import kv
+from db.conversations import BYTES_PER_TOKEN, ConversationNode, ConversationStore, estimate_size_bytes
+from metrics.registry import REGISTRY
+from realm.anthropic.api import AnthropicModel, create_completion
+from realm.anthropic.models import AnthropicConversationMessage, AnthropicMessageAuthorRole
+from realm.anthropic.system_prompts import SUMMARY_SYSTEM_PROMPT
+
+logger = structlog.get_logger()
+
+# Conversations estimated to be larger than this get their older messages summarized
+CONTEXT_TOKEN_BUDGET = kv.get_setting(kv.Settings.context_token_budget, 40_000)
+# How much of the most recent conversation is always sent as is
+CONTEXT_RECENT_TOKENS = kv.get_setting(kv.Settings.context_recent_tokens, 10_000)
+
+SUMMARY_MODEL = AnthropicModel.CLAUDE_3_5_HAIKU_LATEST
+
+_SUMMARY_PREFIX = "[Краткое содержание начала разговора]\n"
+
+_SUMMARIZED = REGISTRY.counter("bydlan_context_summaries_total", "Conversation prefixes summarized to fit the budget")
+
+
+async def fit_to_budget(node: ConversationNode, store: typing.Optional[ConversationStore] = None,
+                        budget: int = CONTEXT_TOKEN_BUDGET, recent_tokens: int = CONTEXT_RECENT_TOKENS,
+                        on_summary: typing.Optional[typing.Callable[[AnthropicConversationMessage], None]] = None
+                        ) -> typing.List[AnthropicConversationMessage]:
+    """
+    Returns the conversation messages to send to the API. When the conversation is estimated to be larger than
+    `budget` tokens, older messages are replaced with a summary (made by a cheaper model) and only the most recent
+    `recent_tokens` are kept as is.
+
+    Summaries are kept on conversation nodes (and persisted by the `store`) and reused by later turns, so a prefix is
+    summarized only once. A new summary folds the previous one in, so its cost doesn't grow with the thread.
+    `on_summary` gets the response of the summary completion, e.g. to account its usage.
+    """
+    if node.history_tokens <= budget:
+        return node.history()
+
+    summarized_node, summary = _latest_summary(node)
+    if summarized_node is not None:
+        tokens = node.history_tokens - summarized_node.history_tokens + _estimate_tokens(summary)
+        if tokens <= budget:
+            return [summary, *node.history(since=summarized_node)]
+
+    # Everything older than the recent part goes to the summary, but the current message is always kept
+    cut_node = node.parent
+    tail_tokens = node.tokens
+    while cut_node is not None and cut_node is not summarized_node and tail_tokens + cut_node.tokens <= recent_tokens:
+        tail_tokens += cut_node.tokens
+        cut_node = cut_node.parent
+    if cut_node is None or cut_node is summarized_node:
+        # the recent part alone doesn't fit, nothing to summarize
+        return [summary, *node.history(since=summarized_node)] if summary else node.history()
+
+    to_summarize = cut_node.history(since=summarized_node)
+    try:
+        new_summary = await _summarize(summary, to_summarize, on_summary)
+    except Exception as e:
+        logger.error("failed to summarize conversation, sending it as is", error=e)
+        return node.history()
+
+    cut_node.set_summary(new_summary)
+    if store is not None:
+        store.save_summary(cut_node)
+    _SUMMARIZED.inc()
+    logger.info("summarized conversation", summarized_messages=len(to_summarize),
+                summarized_tokens=cut_node.history_tokens, summary_tokens=_estimate_tokens(new_summary),
+                kept_messages=node.depth - cut_node.depth)
+    return [new_summary, *node.history(since=cut_node)]
+
+
+def _latest_summary(node: ConversationNode) -> typing.Tuple[typing.Optional[ConversationNode],
+                                                            typing.Optional[AnthropicConversationMessage]]:
+    current = node.parent
+    while current is not None:
+        if current.summary is not None:
+            return current, current.summary
+        current = current.parent
+    return None, None
+
+
+def estimate_tokens(node: ConversationNode, messages: typing.List[AnthropicConversationMessage]) -> int:
+    """
+    Returns the estimated number of tokens in `messages` returned by `fit_to_budget` for `node`. Sizes are taken from
+    the nodes, so only a summary is serialized.
+    """
+    oldest = node
+    for _ in range(len(messages) - 1):
+        oldest = oldest.parent
+    # the first message is either the oldest one kept or the summary of everything up to it
+    first_tokens = oldest.tokens if messages[0] is oldest.message else _estimate_tokens(messages[0])
+    return node.history_tokens - oldest.history_tokens + first_tokens
+
+
+def _estimate_tokens(message: AnthropicConversationMessage) -> int:
+    return estimate_size_bytes(message) // BYTES_PER_TOKEN
+
+
+async def _summarize(previous_summary: typing.Optional[AnthropicConversationMessage],
+                     messages: typing.List[AnthropicConversationMessage],
+                     on_summary: typing.Optional[typing.Callable[[AnthropicConversationMessage], None]]
+                     ) -> AnthropicConversationMessage:
+    lines = []
+    if previous_summary is not None:
+        lines.append("".join(previous_summary.assistant_text_blocks()).removeprefix(_SUMMARY_PREFIX))
+    for message in messages:
+        text = "".join(message.assistant_text_blocks())
+        lines.append(f"бот: {text}" if message.role == AnthropicMessageAuthorRole.assistant else text)
+
+    transcript = AnthropicConversationMessage.from_group_chat_text(None, "\n\n".join(lines))
+    response = await create_completion(SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, [transcript])
+    if on_summary is not None:
+        on_summary(response)
+    summary_text = "".join(response.assistant_text_blocks())
+    return AnthropicConversationMessage.from_group_chat_text(None, _SUMMARY_PREFIX + summary_text)
@@ -2,7 +2,7 @@ import typing
 from enum import Enum
 
 import anthropic.types
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class AnthropicMessageAuthorRole(str, Enum):
@@ -14,6 +14,26 @@ class AnthropicMessageAuthorRole(str, Enum):
     assistant = "assistant"
 
 
+class AnthropicUsage(BaseModel):
+    """
+    Defines token usage of a single completion.
+    See https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching#tracking-cache-performance
+    """
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+
+    @classmethod
+    def from_response_usage(cls, usage: anthropic.types.Usage) -> "AnthropicUsage":
+        return cls(
+            input_tokens=usage.input_tokens or 0,
+            output_tokens=usage.output_tokens or 0,
+            cache_creation_input_tokens=usage.cache_creation_input_tokens or 0,
+            cache_read_input_tokens=usage.cache_read_input_tokens or 0,
+        )
+
+
 class AnthropicConversationMessage(BaseModel):
     """
     Defines a message used in a conversation with Anthropic.
@@ -21,6 +41,13 @@ class AnthropicConversationMessage(BaseModel):
     """
     role: AnthropicMessageAuthorRole
     content: typing.List[anthropic.types.ContentBlock]
+    # Set for assistant responses only, never sent back to the API
+    usage: typing.Optional[AnthropicUsage] = Field(default=None, exclude=True)
+    # The model which answered, may be a fallback of the requested one
+    model: typing.Optional[str] = Field(default=None, exclude=True)
+
+    # API representation of the message, built once on first use. Messages are never mutated after being created.
+    _wire: typing.Optional[typing.Dict[str, typing.Any]] = PrivateAttr(default=None)
 
     @classmethod
     def from_group_chat_text(cls, author_first_name: typing.Optional[str],
@@ -42,6 +69,17 @@ class AnthropicConversationMessage(BaseModel):
         content_block = anthropic.types.TextBlock(type="text", text="лолкек")
         return cls(role=AnthropicMessageAuthorRole.assistant, content=[content_block])
 
+    def to_wire(self) -> typing.Dict[str, typing.Any]:
+        """
+        Returns the message as sent to the API. The result is cached and shared, so it must not be modified.
+        """
+        # private attributes are read from pydantic's storage directly, `self._wire` goes through a slow `__getattr__`
+        private = self.__pydantic_private__
+        wire = private["_wire"]
+        if wire is None:
+            wire = private["_wire"] = self.model_dump(mode="json")
+        return wire
+
     def assistant_text_blocks(self) -> typing.List[str]:
         """
         Returns the assistant text (while skipping thinking entries), basically returns the first text block of
@@ -0,0 +1,107 @@
+import collections
+import dataclasses
+import time
+import typing
+
+from metrics.registry import REGISTRY
+
+# Quotas are enforced over a sliding window of this many seconds
+WINDOW_SECONDS = 60.0
+
+_THROTTLED = REGISTRY.counter("bydlan_quota_throttled_total", "Requests delayed or shrunk by per-chat quotas",
+                              ["action"])
+
+
+@dataclasses.dataclass
+class QuotaRequest:
+    started_at: float
+    # Estimated when the request starts, the real usage once it's done
+    tokens: int
+
+
+class ChatQuotas:
+    """
+    Per-chat tokens-per-minute and requests-per-minute quotas, so a single chat can't use up the API rate limit of
+    every chat. A limit of 0 disables it.
+
+    A chat over its quota waits: the scheduler doesn't start its requests while `delay` is positive, so the chat
+    doesn't hold a slot other chats could use. A request that starts gets its `max_tokens` shrunk to what is left of
+    the chat's token budget (`grant`), but never below `min_output_tokens`. Its cost is estimated until the real usage
+    is known (`settle`). Requests made on behalf of a chat's request, like summaries, are counted once done (`charge`).
+    """
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int, min_output_tokens: int,
+                 timer: typing.Callable[[], float] = time.monotonic):
+        self._tokens_per_minute = tokens_per_minute
+        self._requests_per_minute = requests_per_minute
+        self._min_output_tokens = min_output_tokens
+        self._timer = timer
+        # chat_id -> requests started within the window, the oldest first
+        self._windows: typing.Dict[int, typing.Deque[QuotaRequest]] = {}
+
+    def delay(self, chat_id: int) -> float:
+        """
+        Returns how many seconds the next request of the chat has to wait, 0 when it can start right away.
+        """
+        window = self._window(chat_id)
+        if not window:
+            return 0.0
+        now = self._timer()
+        started_at = None
+        if self._requests_per_minute and len(window) >= self._requests_per_minute:
+            started_at = window[len(window) - self._requests_per_minute].started_at
+        if self._tokens_per_minute:
+            # the request needs room for at least the smallest answer
+            excess = sum(r.tokens for r in window) + self._min_output_tokens - self._tokens_per_minute
+            for request in window:
+                if excess <= 0:
+                    break
+                excess -= request.tokens
+                started_at = request.started_at if started_at is None else max(started_at, request.started_at)
+        if started_at is None:
+            return 0.0
+        _THROTTLED.inc(action="delayed")
+        return max(started_at + WINDOW_SECONDS - now, 0.0)
+
+    @property
+    def limits_tokens(self) -> bool:
+        """
+        Whether `grant` needs the input size of a request.
+        """
+        return self._tokens_per_minute > 0
+
+    def grant(self, chat_id: int, input_tokens: int, max_tokens: int) -> typing.Tuple[int, QuotaRequest]:
+        """
+        Counts a request of the chat as started. Returns `max_tokens` to use, and the request to `settle` later.
+        """
+        window = self._window(chat_id)
+        if self._tokens_per_minute:
+            left = self._tokens_per_minute - sum(r.tokens for r in window) - input_tokens
+            if left < max_tokens:
+                _THROTTLED.inc(action="shrunk")
+                max_tokens = max(left, self._min_output_tokens)
+        request = QuotaRequest(started_at=self._timer(), tokens=input_tokens + max_tokens)
+        self._windows.setdefault(chat_id, collections.deque()).append(request)
+        return max_tokens, request
+
+    @staticmethod
+    def settle(request: QuotaRequest, tokens: int):
+        request.tokens = tokens
+
+    def charge(self, chat_id: int, tokens: int):
+        """
+        Counts a finished request of the chat which didn't go through `grant`.
+        """
+        self._windows.setdefault(chat_id, collections.deque()).append(
+            QuotaRequest(started_at=self._timer(), tokens=tokens))
+
+    def _window(self, chat_id: int) -> typing.Deque[QuotaRequest]:
+        window = self._windows.get(chat_id)
+        if window is None:
+            return collections.deque()
+        expired_before = self._timer() - WINDOW_SECONDS
+        while window and window[0].started_at <= expired_before:
+            window.popleft()
+        if not window:
+            del self._windows[chat_id]
+        return window
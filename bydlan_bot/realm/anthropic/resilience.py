@@ -0,0 +1,91 @@
+import asyncio
+import collections
+import random
+import time
+import typing
+
+import anthropic
+
+T = typing.TypeVar("T")
+
+# Not enough samples make the latency percentile meaningless
+_MIN_LATENCY_SAMPLES = 20
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request didn't succeed within its time budget.
+    """
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Connection errors, timeouts, rate limits and server-side errors (including 529 overloaded) are worth retrying.
+    See https://docs.anthropic.com/en/api/errors
+    """
+    if isinstance(e, (anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(e, anthropic.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+def backoff_seconds(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """
+    "Full jitter" exponential backoff for the given (0-based) attempt.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    """
+    Keeps latencies of recent successful requests to calculate percentiles.
+    """
+
+    def __init__(self, window: int = 200):
+        self._latencies: typing.Deque[float] = collections.deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._latencies.append(seconds)
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        if len(self._latencies) < _MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self._expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self._expires_at - time.monotonic())
+
+
+async def hedged(request: typing.Callable[[], typing.Awaitable[T]],
+                 hedge_after: typing.Optional[float]) -> typing.Tuple[T, bool]:
+    """
+    Runs `request`, and if it's not done within `hedge_after` seconds, runs a second identical one. Returns the first
+    successful result (the other request is cancelled) and whether the hedged request won.
+    """
+    primary = asyncio.ensure_future(request())
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            tasks.append(asyncio.ensure_future(request()))
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task is not primary
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
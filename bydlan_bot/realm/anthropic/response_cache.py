@@ -0,0 +1,67 @@
+import dataclasses
+import hashlib
+import json
+import typing
+
+import cachetools
+
+from metrics.registry import REGISTRY
+from realm.anthropic.models import AnthropicConversationMessage, AnthropicUsage
+
+_LOOKUPS = REGISTRY.counter("anthropic_response_cache_lookups_total", "Response cache lookups", ["result"])
+
+
+@dataclasses.dataclass
+class ResponseCacheStats:
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def make_key(model: str, system_prompt: str, messages: typing.List[AnthropicConversationMessage],
+             max_tokens: typing.Optional[int] = None, thinking_budget: int = 0) -> str:
+    """
+    Hashes everything that defines a completion request.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{model}\0{max_tokens}\0{thinking_budget}".encode())
+    digest.update(b"\0")
+    digest.update(system_prompt.encode())
+    for message in messages:
+        digest.update(b"\0")
+        digest.update(json.dumps(message.to_wire(), ensure_ascii=False, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of completions: identical model, system prompt and conversation get the same response.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self._responses: cachetools.TTLCache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl_seconds)
+        self._stats = ResponseCacheStats()
+
+    def get(self, key: str) -> typing.Optional[AnthropicConversationMessage]:
+        response = self._responses.get(key)
+        if response is None:
+            self._stats.misses += 1
+            _LOOKUPS.inc(result="miss")
+            return None
+
+        self._stats.hits += 1
+        _LOOKUPS.inc(result="hit")
+        # a cached answer costs no tokens
+        return response.model_copy(update={"usage": AnthropicUsage()})
+
+    def put(self, key: str, response: AnthropicConversationMessage):
+        self._responses[key] = response
+
+    def stats(self) -> ResponseCacheStats:
+        self._stats.entries = len(self._responses)
+        return self._stats
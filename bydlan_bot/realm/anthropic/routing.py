@@ -0,0 +1,111 @@
+import dataclasses
+import re
+import typing
+
+from db import kv
+from metrics.registry import REGISTRY
+from realm.anthropic.api import THINKING_TOKENS_BUDGET, AnthropicModel
+
+
+@dataclasses.dataclass(frozen=True)
+class Route:
+    name: str
+    model: AnthropicModel
+    max_tokens: int
+    # 0 disables thinking
+    thinking_budget: int
+
+
+BANTER = Route("banter", AnthropicModel.CLAUDE_3_5_HAIKU_LATEST, max_tokens=1024, thinking_budget=0)
+DEFAULT = Route("default", AnthropicModel.CLAUDE_3_7_SONNET_LATEST,
+                max_tokens=AnthropicModel.CLAUDE_3_7_SONNET_LATEST.max_tokens(), thinking_budget=0)
+HARD = Route("hard", AnthropicModel.CLAUDE_3_7_SONNET_LATEST,
+             max_tokens=AnthropicModel.CLAUDE_3_7_SONNET_LATEST.max_tokens(), thinking_budget=THINKING_TOKENS_BUDGET)
+
+ROUTES = {route.name: route for route in (BANTER, DEFAULT, HARD)}
+# Picks one of the routes per request, see `classify`
+AUTO = "auto"
+
+# Messages up to this long (without a question) are banter
+BANTER_MAX_CHARS = 60
+# Messages this long are likely to need a thought-through answer
+LONG_MESSAGE_CHARS = 400
+# Threads this deep have enough context to make a short question hard
+DEEP_THREAD_MESSAGES = 12
+
+_QUESTION_WORDS = re.compile(r"\b(почему|зачем|как|сколько|какой|какая|какие|что такое|чем|кто|где|когда|"
+                             r"why|how|what|which|who|when|where)\b", re.IGNORECASE)
+_HARD_WORDS = re.compile(r"\b(объясни|докажи|посчитай|вычисли|реши|сравни|проанализируй|напиши код|задач[аиу]|"
+                         r"explain|prove|calculate|solve|compare|analy[sz]e)\w*", re.IGNORECASE)
+_CODE = re.compile(r"```|\bdef \w+\(|^\s*(import|from) \w+", re.MULTILINE)
+
+_ROUTED = REGISTRY.counter("bydlan_routes_total", "Requests by the chosen route", ["route"])
+
+
+def _is_route(name: str) -> bool:
+    return name == AUTO or name in ROUTES
+
+
+def _parse_chat_routes(value: str) -> typing.Dict[int, str]:
+    """
+    Parses `chat_id=route` pairs separated by `;`. Pairs with an invalid chat id or an unknown route are skipped.
+    """
+    chat_routes = {}
+    for pair in value.split(";"):
+        if "=" not in pair:
+            continue
+        chat_id, name = pair.split("=", 1)
+        name = name.strip()
+        try:
+            if not _is_route(name):
+                raise ValueError(f"unknown route {name!r}")
+            chat_routes[int(chat_id.strip())] = name
+        except ValueError:
+            print(f"WARNING: invalid chat route {pair!r}, ignoring it")
+    return chat_routes
+
+
+def _parse_route(value: str) -> str:
+    if _is_route(value):
+        return value
+    print(f"WARNING: unknown route {value!r}, using {DEFAULT.name!r}")
+    return DEFAULT.name
+
+
+# Route of every chat: a route name or "auto". The default route keeps every request on the same settings.
+DEFAULT_ROUTE = _parse_route(kv.get_setting(kv.Settings.route, DEFAULT.name))
+# Per-chat overrides, `chat_id=route;...`
+CHAT_ROUTES = _parse_chat_routes(kv.get_setting(kv.Settings.chat_routes, ""))
+
+
+def classify(text: str, thread_depth: int) -> Route:
+    """
+    Picks a route from cheap features of the request: short remarks go to a fast model, questions that look hard
+    (explicit asks, code, long messages, questions deep into a thread) get thinking, the rest goes to the default.
+    """
+    is_question = "?" in text or _QUESTION_WORDS.search(text) is not None
+    if len(text) <= BANTER_MAX_CHARS and not is_question and thread_depth < DEEP_THREAD_MESSAGES:
+        return BANTER
+
+    score = 0
+    if _HARD_WORDS.search(text):
+        score += 2
+    if _CODE.search(text):
+        score += 2
+    if len(text) >= LONG_MESSAGE_CHARS:
+        score += 1
+    if is_question:
+        score += 1
+    if is_question and thread_depth >= DEEP_THREAD_MESSAGES:
+        score += 1
+    return HARD if score >= 3 else DEFAULT
+
+
+def choose_route(chat_id: int, text: str, thread_depth: int) -> Route:
+    """
+    Returns the route configured for the chat, classifying the request when it's "auto".
+    """
+    name = CHAT_ROUTES.get(chat_id, DEFAULT_ROUTE)
+    route = classify(text, thread_depth) if name == AUTO else ROUTES.get(name, DEFAULT)
+    _ROUTED.inc(route=route.name)
+    return route
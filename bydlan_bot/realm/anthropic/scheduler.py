@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import dataclasses
+import statistics
+import time
+import typing
+
+import structlog
+
+from metrics.registry import REGISTRY
+
+logger = structlog.get_logger()
+
+T = typing.TypeVar("T")
+
+# How many recent queue wait times are kept to calculate percentiles
+_WAIT_TIMES_WINDOW = 1000
+
+_WAIT_SECONDS = REGISTRY.histogram("bydlan_scheduler_wait_seconds", "Time replies waited in the scheduler queue")
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a chat already has too many queued requests.
+    """
+
+
+class SchedulerClosedError(Exception):
+    """
+    Raised when a request is submitted after the scheduler started draining.
+    """
+
+
+@dataclasses.dataclass
+class _Job:
+    run: typing.Callable[[], typing.Awaitable[typing.Any]]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+@dataclasses.dataclass
+class SchedulerStats:
+    queued: int
+    in_flight: int
+    queued_per_chat: typing.Dict[int, int]
+    completed: int
+    rejected: int
+    wait_p50_seconds: float
+    wait_p95_seconds: float
+    wait_max_seconds: float
+
+
+@dataclasses.dataclass
+class DrainReport:
+    # Requests which were running when draining started and finished in time
+    finished: int
+    # Requests which were still queued, they never started
+    dropped_queued: int
+    # Requests which were still running at the deadline
+    cancelled: int
+    # chat_id -> number of dropped and cancelled requests
+    lost_per_chat: typing.Dict[int, int]
+    seconds: float
+
+
+class CompletionScheduler:
+    """
+    Runs per-chat requests with a global concurrency limit.
+
+    Every chat has a FIFO queue, and a chat runs at most `max_in_flight_per_chat` requests at a time. Free slots are
+    handed out to chats in round-robin order, so one busy chat can't starve the rest.
+
+    `admission` returns for how many seconds a chat's next request has to wait (e.g. to stay within a quota). Such a
+    chat is skipped until then, without taking a slot.
+    """
+
+    def __init__(self, max_in_flight: int, max_in_flight_per_chat: int = 1, max_queued_per_chat: int = 20,
+                 admission: typing.Optional[typing.Callable[[int], float]] = None):
+        self._max_in_flight = max_in_flight
+        self._max_in_flight_per_chat = max_in_flight_per_chat
+        self._max_queued_per_chat = max_queued_per_chat
+        self._admission = admission
+
+        self._queues: typing.Dict[int, typing.Deque[_Job]] = collections.defaultdict(collections.deque)
+        # Chats with queued jobs and free per-chat slots, in round-robin order
+        self._ready: typing.OrderedDict[int, None] = collections.OrderedDict()
+        self._in_flight_per_chat: typing.Dict[int, int] = collections.defaultdict(int)
+        # Chats waiting for admission
+        self._parked: typing.Set[int] = set()
+        self._in_flight = 0
+        self._tasks: typing.Set[asyncio.Task] = set()
+        # chat_id of every running task
+        self._task_chats: typing.Dict[asyncio.Task, int] = {}
+        self._closed = False
+
+        self._completed = 0
+        self._rejected = 0
+        self._wait_times: typing.Deque[float] = collections.deque(maxlen=_WAIT_TIMES_WINDOW)
+
+    def submit(self, chat_id: int, run: typing.Callable[[], typing.Awaitable[T]]) -> "asyncio.Future[T]":
+        """
+        Queues `run` for the chat. Returns a future resolved with its result once it's done.
+        """
+        if self._closed:
+            raise SchedulerClosedError("scheduler is draining, no new requests are accepted")
+        queue = self._queues[chat_id]
+        if len(queue) >= self._max_queued_per_chat:
+            self._rejected += 1
+            raise QueueFullError(f"chat {chat_id} already has {len(queue)} queued requests")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(_Job(run=run, future=future, enqueued_at=time.monotonic()))
+        self._mark_ready(chat_id)
+        self._dispatch()
+        return future
+
+    def stats(self) -> SchedulerStats:
+        waits = sorted(self._wait_times)
+        return SchedulerStats(
+            queued=sum(len(q) for q in self._queues.values()),
+            in_flight=self._in_flight,
+            queued_per_chat={chat_id: len(q) for chat_id, q in self._queues.items() if q},
+            completed=self._completed,
+            rejected=self._rejected,
+            wait_p50_seconds=statistics.median(waits) if waits else 0.0,
+            wait_p95_seconds=waits[int(len(waits) * 0.95)] if waits else 0.0,
+            wait_max_seconds=waits[-1] if waits else 0.0,
+        )
+
+    async def drain(self, timeout: float) -> DrainReport:
+        """
+        Stops accepting and starting requests, then waits up to `timeout` seconds for the running ones to finish.
+        Queued requests are dropped right away, as they haven't cost anything yet, and requests still running at
+        the deadline are cancelled.
+        """
+        started_at = time.monotonic()
+        self._closed = True
+        lost_per_chat: typing.Dict[int, int] = collections.defaultdict(int)
+
+        dropped_queued = 0
+        for chat_id, queue in self._queues.items():
+            for job in queue:
+                job.future.cancel()
+            dropped_queued += len(queue)
+            lost_per_chat[chat_id] += len(queue)
+        self._queues.clear()
+        self._ready.clear()
+
+        running = set(self._tasks)
+        done, pending = await asyncio.wait(running, timeout=timeout) if running else (set(), set())
+        for task in pending:
+            lost_per_chat[self._task_chats[task]] += 1
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+        return DrainReport(finished=len(done), dropped_queued=dropped_queued, cancelled=len(pending),
+                           lost_per_chat=dict(lost_per_chat), seconds=time.monotonic() - started_at)
+
+    def _mark_ready(self, chat_id: int):
+        if (self._queues.get(chat_id) and chat_id not in self._parked
+                and self._in_flight_per_chat.get(chat_id, 0) < self._max_in_flight_per_chat):
+            self._ready.setdefault(chat_id, None)
+
+    def _unpark(self, chat_id: int):
+        self._parked.discard(chat_id)
+        self._mark_ready(chat_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        while not self._closed and self._ready and self._in_flight < self._max_in_flight:
+            chat_id, _ = self._ready.popitem(last=False)
+            delay = self._admission(chat_id) if self._admission is not None else 0.0
+            if delay > 0:
+                self._parked.add(chat_id)
+                asyncio.get_running_loop().call_later(delay, self._unpark, chat_id)
+                logger.info("chat over quota, request delayed", chat_id=chat_id, delay_seconds=round(delay, 3))
+                continue
+            job = self._queues[chat_id].popleft()
+            if not self._queues[chat_id]:
+                del self._queues[chat_id]
+
+            self._in_flight += 1
+            self._in_flight_per_chat[chat_id] += 1
+            # goes to the end of the round-robin order if it still has something to run
+            self._mark_ready(chat_id)
+
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_times.append(wait)
+            _WAIT_SECONDS.observe(wait)
+            if wait > 1:
+                logger.info("request waited in scheduler queue", chat_id=chat_id, wait_seconds=round(wait, 3))
+            task = asyncio.create_task(self._run(chat_id, job))
+            self._tasks.add(task)
+            self._task_chats[task] = chat_id
+            task.add_done_callback(self._forget_task)
+
+    def _forget_task(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._task_chats.pop(task, None)
+
+    async def _run(self, chat_id: int, job: _Job):
+        try:
+            result = await job.run()
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._completed += 1
+            self._in_flight -= 1
+            self._in_flight_per_chat[chat_id] -= 1
+            if self._in_flight_per_chat[chat_id] == 0:
+                del self._in_flight_per_chat[chat_id]
+            self._mark_ready(chat_id)
+            self._dispatch()
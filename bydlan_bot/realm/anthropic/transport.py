@@ -0,0 +1,131 @@
+import asyncio
+import importlib
+import importlib.util
+import time
+import typing
+
+import structlog
+from anthropic import DefaultAsyncHttpxClient
+
+from db import kv
+from metrics.registry import REGISTRY
+
+# Connections to the API. Requests over the limit wait for a free connection.
+MAX_CONNECTIONS = kv.get_setting(kv.Settings.anthropic_max_connections, 20)
+# Idle connections kept open, and for how long
+MAX_KEEPALIVE_CONNECTIONS = kv.get_setting(kv.Settings.anthropic_max_keepalive_connections, 10)
+KEEPALIVE_EXPIRY_SECONDS = kv.get_setting(kv.Settings.anthropic_keepalive_expiry_seconds, 120.0)
+# Multiplexes requests over a single connection, needs the optional `h2` package
+HTTP2 = kv.get_setting(kv.Settings.anthropic_http2, True) and importlib.util.find_spec("h2") is not None
+# When no request was sent for this long, a cheap request keeps a connection open. Set to 0 to disable.
+KEEPALIVE_PING_SECONDS = kv.get_setting(kv.Settings.anthropic_keepalive_ping_seconds, 30.0)
+
+# Monotonic time of the last request sent to the API
+_LAST_REQUEST_AT = 0.0
+
+_CONNECT_SECONDS = REGISTRY.histogram("anthropic_connect_seconds", "Time to open a connection to the API", ["phase"])
+
+logger = structlog.get_logger()
+
+# Newer SDK versions send requests with the `httpx2` fork of `httpx`, limits passed to the client and errors it raises
+# have to come from the same module
+httpx = importlib.import_module(DefaultAsyncHttpxClient.__mro__[1].__module__.partition(".")[0])
+
+
+class _ConnectionTrace:
+    """
+    Times the phases of opening a connection, see https://www.encode.io/httpcore/extensions/#trace.
+    Requests sent over an already open connection see no connection events and log nothing.
+    """
+
+    _PHASES = ("connect_tcp", "start_tls")
+
+    def __init__(self):
+        self._started: typing.Dict[str, float] = {}
+        self._ms: typing.Dict[str, float] = {}
+
+    async def __call__(self, event: str, info: typing.Dict[str, typing.Any]):
+        # e.g. "connection.start_tls.complete", "http2.send_connection_init.started"
+        layer, _, phase_and_state = event.partition(".")
+        phase, _, state = phase_and_state.rpartition(".")
+        if phase in self._PHASES:
+            if state == "started":
+                self._started[phase] = time.monotonic()
+            elif state == "complete" and phase in self._started:
+                seconds = time.monotonic() - self._started.pop(phase)
+                _CONNECT_SECONDS.observe(seconds, phase=phase)
+                self._ms[phase] = round(seconds * 1000, 1)
+        elif layer in ("http11", "http2") and self._ms:
+            logger.info("anthropic connection opened", http_version=layer,
+                        **{f"{phase}_ms": ms for phase, ms in self._ms.items()})
+            self._ms.clear()
+
+
+async def _on_request(request: httpx.Request):
+    global _LAST_REQUEST_AT
+    _LAST_REQUEST_AT = time.monotonic()
+    request.extensions["trace"] = _ConnectionTrace()
+
+
+def build_http_client() -> httpx.AsyncClient:
+    """
+    Returns the HTTP client for `AsyncAnthropic`: the SDK defaults (timeouts, redirects), with our pool limits
+    and connection timing in logs and metrics.
+    """
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS)
+    logger.info("anthropic http client", max_connections=MAX_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+                http2=HTTP2)
+    return DefaultAsyncHttpxClient(limits=limits, http2=HTTP2, event_hooks={"request": [_on_request]})
+
+
+async def warm_up(http_client: httpx.AsyncClient, base_url: str):
+    """
+    Opens a connection to the API (TCP, TLS, and HTTP/2 if enabled) with an unauthenticated `HEAD` request, so the
+    first completion doesn't pay for it. Any response means the connection is ready, failures are only logged.
+    """
+    started_at = time.monotonic()
+    try:
+        response = await http_client.head(base_url)
+        logger.info("anthropic connection warmed up", status=response.status_code, http_version=response.http_version,
+                    seconds=round(time.monotonic() - started_at, 3))
+    except Exception as e:
+        logger.warning("failed to warm up anthropic connection", error=repr(e))
+
+
+class KeepAlive:
+    """
+    Sends a warm-up request whenever the API wasn't used for `interval` seconds, so the pooled connection isn't
+    closed by the server (or `keepalive_expiry`) during quiet hours.
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, base_url: str, interval: float):
+        self._http_client = http_client
+        self._base_url = base_url
+        self._interval = interval
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            idle = time.monotonic() - _LAST_REQUEST_AT
+            if idle < self._interval:
+                await asyncio.sleep(self._interval - idle)
+                continue
+            try:
+                await warm_up(self._http_client, self._base_url)
+            except Exception as e:
+                logger.error("anthropic keep-alive failed", error=e)
+            # a failed request may not count as one, don't retry it right away
+            await asyncio.sleep(self._interval)
@@ -0,0 +1,58 @@
+import typing
+
+import cachetools
+from pyrogram.types import Message
+
+
+class IndexedMessage(typing.NamedTuple):
+    """
+    A compact snapshot of a group message: just enough to rebuild a reply chain without asking Telegram again.
+    """
+    chat_id: int
+    id: int
+    reply_to_id: typing.Optional[int]
+    has_author: bool
+    author_username: typing.Optional[str]
+    author_first_name: typing.Optional[str]
+    text: typing.Optional[str]
+
+
+class MessageIndex:
+    """
+    Bounded LRU index of group messages seen by the bot, keyed by `(chat_id, message_id)`.
+
+    Every incoming group message is recorded (together with the replied-to message pyrogram already parsed for it),
+    as well as every message the bot sends, so reply chains can be resolved locally.
+    """
+
+    def __init__(self, maxsize: int):
+        self._messages: cachetools.LRUCache = cachetools.LRUCache(maxsize=maxsize)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def record(self, message: typing.Optional[Message]) -> typing.Optional[IndexedMessage]:
+        """
+        Records the message and all the replied-to messages pyrogram has parsed along with it.
+        Returns the record of the message itself.
+        """
+        record = None
+        while message is not None and not message.empty:
+            author = message.from_user
+            indexed = IndexedMessage(
+                chat_id=message.chat.id,
+                id=message.id,
+                reply_to_id=message.reply_to_message_id,
+                has_author=author is not None,
+                author_username=author.username if author else None,
+                author_first_name=author.first_name if author else None,
+                text=message.text,
+            )
+            self._messages[(indexed.chat_id, indexed.id)] = indexed
+            if record is None:
+                record = indexed
+            message = message.reply_to_message
+        return record
+
+    def get(self, chat_id: int, message_id: int) -> typing.Optional[IndexedMessage]:
+        return self._messages.get((chat_id, message_id))
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import time
+import typing
+
+import structlog
+from pyrogram.errors import FloodWait
+
+from metrics.registry import REGISTRY
+
+logger = structlog.get_logger()
+
+T = typing.TypeVar("T")
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+TELEGRAM_GLOBAL_MESSAGES_PER_SECOND = 30
+TELEGRAM_GROUP_MESSAGES_PER_MINUTE = 20
+
+_SEND_SECONDS = REGISTRY.histogram("telegram_send_seconds", "Telegram send/edit request latency", ["outcome"])
+_THROTTLE_SECONDS = REGISTRY.histogram("telegram_throttle_seconds", "Time requests waited for rate limits")
+_FLOOD_WAITS = REGISTRY.counter("telegram_flood_waits_total", "FloodWait errors received from Telegram")
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `capacity` tokens. Waiters are served in FIFO order.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds: float):
+        """
+        Holds all acquirers for `seconds`, e.g. when Telegram asked to wait.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+@dataclasses.dataclass
+class OutboxStats:
+    sent: int = 0
+    flood_waits: int = 0
+    flood_wait_seconds: float = 0
+    throttled_seconds: float = 0
+
+
+class Outbox:
+    """
+    Central gate for every outgoing Telegram request (sends and edits).
+
+    Requests wait for a global and a per-chat token bucket matching Telegram limits. A `FloodWait` pauses the chat's
+    bucket for the requested time and the request is retried, so bursts turn into delays instead of errors.
+    Multi-part replies should be sent within `sequence(chat_id)` so their parts are not interleaved with other
+    replies to the same chat.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_MESSAGES_PER_SECOND,
+                 per_chat_rate: float = TELEGRAM_GROUP_MESSAGES_PER_MINUTE / 60, per_chat_burst: float = 3,
+                 max_flood_waits: int = 5, max_flood_wait_seconds: float = 300):
+        self._global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._chat_buckets: typing.Dict[int, TokenBucket] = {}
+        self._chat_locks: typing.Dict[int, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        self._max_flood_waits = max_flood_waits
+        self._max_flood_wait_seconds = max_flood_wait_seconds
+        self._stats = OutboxStats()
+
+    @contextlib.asynccontextmanager
+    async def sequence(self, chat_id: int):
+        """
+        Holds the chat for a sequence of requests which must not be interleaved with others.
+        """
+        async with self._chat_locks[chat_id]:
+            yield
+
+    async def send(self, chat_id: int, request: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        """
+        Runs `request` (a send or an edit to the chat) once the rate limits allow, retrying on `FloodWait`.
+        """
+        chat_bucket = self._chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self._chat_buckets[chat_id] = TokenBucket(rate=self._per_chat_rate,
+                                                                    capacity=self._per_chat_burst)
+
+        flood_waits = 0
+        while True:
+            started_at = time.monotonic()
+            await chat_bucket.acquire()
+            await self._global_bucket.acquire()
+            throttled_seconds = time.monotonic() - started_at
+            self._stats.throttled_seconds += throttled_seconds
+            _THROTTLE_SECONDS.observe(throttled_seconds)
+            started_at = time.monotonic()
+            try:
+                result = await request()
+                self._stats.sent += 1
+                _SEND_SECONDS.observe(time.monotonic() - started_at, outcome="success")
+                return result
+            except FloodWait as e:
+                _SEND_SECONDS.observe(time.monotonic() - started_at, outcome="flood_wait")
+                _FLOOD_WAITS.inc()
+                flood_waits += 1
+                wait_seconds = float(e.value)
+                self._stats.flood_waits += 1
+                self._stats.flood_wait_seconds += wait_seconds
+                if flood_waits > self._max_flood_waits or wait_seconds > self._max_flood_wait_seconds:
+                    raise
+                logger.warning("telegram asked to wait, resuming later", chat_id=chat_id, wait_seconds=wait_seconds)
+                chat_bucket.pause(wait_seconds)
+
+    def stats(self) -> OutboxStats:
+        return self._stats
@@ -0,0 +1,37 @@
+import zlib
+
+from pyrogram import filters
+
+from db import kv
+
+# Number of worker processes chats are split between, 1 runs the bot in a single process
+WORKER_COUNT = max(kv.get_setting(kv.Settings.workers, 1), 1)
+# Set by the supervisor for every worker it starts, -1 in the supervisor itself
+WORKER_INDEX = kv.get_setting(kv.Settings.worker_index, -1)
+
+
+def shard_of(chat_id: int, worker_count: int) -> int:
+    """
+    Returns the index of the worker a chat belongs to. Stable across processes and restarts, unlike `hash()`.
+    """
+    return zlib.crc32(str(chat_id).encode()) % worker_count
+
+
+def is_supervisor() -> bool:
+    return WORKER_COUNT > 1 and WORKER_INDEX < 0
+
+
+def owns_chat(chat_id: int) -> bool:
+    """
+    Every worker receives every update, but only handles the chats of its shard. A chat is always handled by
+    the same worker, so per-chat state (message index, ordering, rate limits) stays local to the process.
+    """
+    return WORKER_COUNT <= 1 or shard_of(chat_id, WORKER_COUNT) == WORKER_INDEX
+
+
+async def _is_owned(_, __, update) -> bool:
+    return update.chat is not None and owns_chat(update.chat.id)
+
+
+# The check is a coroutine, pyrogram would run a plain function in a thread pool
+owned_chats = filters.create(_is_owned, "OwnedChatsFilter")
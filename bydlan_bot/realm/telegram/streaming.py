@@ -0,0 +1,145 @@
+import asyncio
+import time
+import typing
+
+import pyrogram.enums
+import structlog
+from pyrogram.errors import MessageNotModified
+from pyrogram.types import Message
+
+from realm.telegram.outbox import Outbox
+from realm.telegram.utils import MessageSplitter, TELEGRAM_MAX_MESSAGE_LENGTH, split_if_large_message, truncate_utf16
+
+logger = structlog.get_logger()
+
+# Telegram tolerates roughly one edit per second per chat before it starts throwing FloodWait
+DEFAULT_EDIT_INTERVAL_SECONDS = 1.5
+
+
+class StreamingReply:
+    """
+    Progressively renders a streamed response as a reply to `message`.
+
+    The first chunk is posted as soon as there is any text, then the reply is edited at most once per
+    `edit_interval` seconds. Text beyond `TELEGRAM_MAX_MESSAGE_LENGTH` rolls over into new messages, each replying to
+    the previous one (same as a non-streamed reply). Text is split as it arrives, so messages which are complete are
+    never split again. Intermediate renders are sent as plain text since a half-streamed Markdown entity can't be
+    parsed; `finish` renders the final text with Markdown. A reply which fails before it's finished is `abort`ed.
+
+    All sends and edits go through the `outbox`, so they respect Telegram rate limits. Every render holds the chat's
+    outbox sequence, so its messages aren't interleaved with other replies, while the chat isn't held in between
+    renders (e.g. while the model is thinking).
+    """
+
+    def __init__(self, message: Message, outbox: Outbox, edit_interval: float = DEFAULT_EDIT_INTERVAL_SECONDS):
+        self._message = message
+        self._outbox = outbox
+        self._edit_interval = edit_interval
+        self._deltas: typing.List[str] = []
+        self._splitter = MessageSplitter()
+        self._sent: typing.List[Message] = []
+        self._rendered: typing.List[str] = []
+        self._text_arrived = asyncio.Event()
+        self._finished = False
+        # set once the final text is rendered, or the reply is aborted
+        self._done = False
+        self._flusher: typing.Optional[asyncio.Task] = None
+
+    def append(self, delta: str):
+        """
+        Adds a piece of streamed text. Never blocks: rendering happens in a background task.
+        """
+        if self._finished or not delta:
+            return
+        self._deltas.append(delta)
+        self._splitter.feed(delta)
+        self._text_arrived.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def finish(self, final_text: str) -> typing.List[Message]:
+        """
+        Stops progressive rendering and renders `final_text` with Markdown. Returns all messages of the reply.
+        """
+        self._finished = True
+        self._text_arrived.set()
+        if self._flusher is not None:
+            await self._flusher
+        # the final text differs from the streamed one when the response came from a cache or a fallback
+        chunks = self._splitter.finish() if "".join(self._deltas) == final_text else split_if_large_message(final_text)
+        chunks = [chunk for chunk in chunks if len(chunk) > 0]
+        async with self._outbox.sequence(self._message.chat.id):
+            await self._render(chunks, pyrogram.enums.ParseMode.MARKDOWN)
+            # the final text may take fewer messages than the streamed one did
+            await self._delete(len(chunks))
+        self._done = True
+        return self._sent
+
+    async def abort(self):
+        """
+        Stops progressive rendering and deletes the messages sent so far, for a reply which failed before it was
+        finished. Does nothing once the reply is finished.
+        """
+        if self._done:
+            return
+        self._done = self._finished = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        if self._sent:
+            logger.info("deleting aborted streamed reply", messages=len(self._sent))
+            async with self._outbox.sequence(self._message.chat.id):
+                await self._delete(0)
+
+    async def _flush_periodically(self):
+        while not self._finished:
+            await self._text_arrived.wait()
+            self._text_arrived.clear()
+            if self._finished:
+                return
+            started_at = time.monotonic()
+            # the message being written may be over the limit while its end is held back by the splitter
+            pending = truncate_utf16(self._splitter.pending(), TELEGRAM_MAX_MESSAGE_LENGTH)
+            try:
+                async with self._outbox.sequence(self._message.chat.id):
+                    await self._render([chunk for chunk in [*self._splitter.chunks, pending] if len(chunk) > 0],
+                                       pyrogram.enums.ParseMode.DISABLED)
+            except Exception as e:
+                # keep streaming, the final render will try again
+                logger.warning("failed to render streamed reply", error=e)
+            await asyncio.sleep(max(0.0, self._edit_interval - (time.monotonic() - started_at)))
+
+    async def _render(self, chunks: typing.List[str], parse_mode: pyrogram.enums.ParseMode):
+        for i, chunk in enumerate(chunks):
+            if i < len(self._sent):
+                if self._rendered[i] == chunk and parse_mode == pyrogram.enums.ParseMode.DISABLED:
+                    continue
+                try:
+                    sent_msg = self._sent[i]
+                    self._sent[i] = await self._outbox.send(
+                        self._message.chat.id, lambda: sent_msg.edit_text(chunk, parse_mode=parse_mode))
+                except MessageNotModified:
+                    pass
+                self._rendered[i] = chunk
+            else:
+                reply_to_id = self._sent[-1].id if self._sent else self._message.id
+                logger.info("sending streamed reply message", chunk_index=i)
+                sent_msg = await self._outbox.send(self._message.chat.id, lambda: self._message.reply(
+                    chunk, reply_to_message_id=reply_to_id, parse_mode=parse_mode))
+                self._sent.append(sent_msg)
+                self._rendered.append(chunk)
+
+    async def _delete(self, keep: int):
+        """
+        Deletes sent messages past the first `keep` ones.
+        """
+        for sent_msg in self._sent[keep:]:
+            try:
+                await self._outbox.send(self._message.chat.id, sent_msg.delete)
+            except Exception as e:
+                logger.warning("failed to delete streamed reply message", message_id=sent_msg.id, error=e)
+        del self._sent[keep:]
+        del self._rendered[keep:]
@@ -0,0 +1,73 @@
+import typing
+
+
+def parse_chat_ids(value: str) -> typing.Set[int]:
+    """
+    Parses comma separated chat ids, e.g. `-1001234567890,-1009876543210`. Invalid ids are skipped.
+    """
+    chat_ids = set()
+    for chat_id in value.replace(" ", "").split(","):
+        if not chat_id:
+            continue
+        try:
+            chat_ids.add(int(chat_id))
+        except ValueError:
+            print(f"WARNING: invalid chat id {chat_id!r}, ignoring it")
+    return chat_ids
+
+
+def parse_chat_prefixes(value: str) -> typing.Dict[int, typing.Tuple[str, ...]]:
+    """
+    Parses `chat_id=prefix|prefix` pairs separated by `;`, e.g. `-1001234567890=быдлан|бот;-1009876543210=эй`.
+    Pairs with an invalid chat id are skipped.
+    """
+    chat_prefixes = {}
+    for pair in value.split(";"):
+        if "=" not in pair:
+            continue
+        chat_id, prefixes = pair.split("=", 1)
+        try:
+            chat_prefixes[int(chat_id.strip())] = tuple(p.strip().lower() for p in prefixes.split("|") if p.strip())
+        except ValueError:
+            print(f"WARNING: invalid chat id in chat prefixes {pair!r}, ignoring it")
+    return chat_prefixes
+
+
+class TriggerConfig:
+    """
+    Which chats the bot answers in, and which prefixes (case-insensitive) make it answer in every chat.
+    """
+
+    def __init__(self, default_prefixes: typing.Tuple[str, ...],
+                 chat_prefixes: typing.Optional[typing.Dict[int, typing.Tuple[str, ...]]] = None,
+                 enabled_chats: typing.Optional[typing.Set[int]] = None,
+                 disabled_chats: typing.Optional[typing.Set[int]] = None):
+        self._default_prefixes = tuple(prefix.lower() for prefix in default_prefixes)
+        self._chat_prefixes = chat_prefixes or {}
+        # None means every chat which is not disabled
+        self._enabled_chats = enabled_chats or None
+        self._disabled_chats = disabled_chats or set()
+
+    def is_enabled(self, chat_id: int) -> bool:
+        return chat_id not in self._disabled_chats and (self._enabled_chats is None or chat_id in self._enabled_chats)
+
+    def prefixes(self, chat_id: int) -> typing.Tuple[str, ...]:
+        return self._chat_prefixes.get(chat_id, self._default_prefixes)
+
+    def matched_prefix(self, chat_id: int, text: str) -> typing.Optional[str]:
+        lowered = text.lower()
+        for prefix in self.prefixes(chat_id):
+            if lowered.startswith(prefix):
+                return prefix
+        return None
+
+    def strip_prefix(self, chat_id: int, text: str) -> str:
+        """
+        Removes the word starting with a prefix (to support cases like быдланчик, etc.).
+        """
+        prefix = self.matched_prefix(chat_id, text)
+        if prefix is None:
+            return text
+        rest = text[len(prefix):]
+        space = rest.find(" ")
+        return rest[space + 1:] if space >= 0 else ""
@@ -1,11 +1,325 @@
+import dataclasses
+import functools
+import re
 import typing
 
+# In UTF-16 code units, which is how Telegram counts
 TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
+# Delimiters of pyrogram's Markdown (`pyrogram.parser.markdown`) in its matching order, links, then the places a
+# message is preferably split at: newlines and sentence ends. Spaces are looked up only when they are needed.
+_TOKENS = re.compile(r"(```|`|~~|--|__|\*\*|\|\|)|\[.+?\]\(.+?\)|(\n+)|[.!?…](?= )")
+_PRE = "```"
+_FIXED_WIDTH = {"`", _PRE}
+# pyrogram takes the rest of the first line of a code block as its language, only a short identifier is reopened
+# with a split code block (and waited for when streamed)
+_LANGUAGE = re.compile(r"[\w+#.-]{0,32}")
 
-def split_if_large_message(message: str) -> typing.List[str]:
+# Messages have to fit at least some text besides the markup of open spans
+MIN_LIMIT = 16
+
+# Kinds of split points, the most preferred first
+_PARAGRAPH, _LINE, _SENTENCE, _WORD, _ANYWHERE = range(5)
+# A more preferred split point wins over a later one if the chunk it ends is at least this full
+_MIN_FILL = 0.5
+# Streamed text this close to its end may still change meaning, e.g. `*` becoming `**`
+_HOLD_BACK = 3
+
+# Open formatting spans: (delimiter, language of a code block)
+Spans = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _utf16_prefix(text: str, start: int, end: int, units: int) -> int:
+    """
+    Returns the largest `i <= end` such that `text[start:i]` is at most `units` UTF-16 code units long.
+    """
+    i = min(end, start + units)
+    while i > start:
+        excess = utf16_length(text[start:i]) - units
+        if excess <= 0:
+            return i
+        # every code point is one or two units
+        i -= (excess + 1) // 2
+    return start
+
+
+def truncate_utf16(text: str, limit: int) -> str:
+    return text[:_utf16_prefix(text, 0, len(text), limit)]
+
+
+def _opening(spans: Spans) -> str:
+    return "".join(delim + language + "\n" if delim == _PRE else delim for delim, language in spans)
+
+
+def _closing(spans: Spans) -> str:
+    return "".join("\n" + delim if delim == _PRE else delim for delim, _ in reversed(spans))
+
+
+@functools.lru_cache(maxsize=256)
+def _closing_units(spans: Spans) -> int:
+    # checked on every token, while only a few distinct sets of spans ever occur
+    return utf16_length(_closing(spans))
+
+
+@functools.lru_cache(maxsize=256)
+def _markup_units(spans: Spans) -> int:
+    return utf16_length(_opening(spans)) + _closing_units(spans)
+
+
+@dataclasses.dataclass
+class _SplitPoint:
+    kind: int
+    # The chunk ends at `end`, the next one starts at `resume` (whitespace in between is dropped)
+    end: int
+    resume: int
+    # UTF-16 units from the start of the buffer
+    end_units: int
+    resume_units: int
+    # Spans open at the split point: closed at the end of the chunk and reopened in the next one
+    spans: Spans
+
+
+class MessageSplitter:
+    """
+    Splits text into messages of at most `limit` UTF-16 code units (the length Telegram checks), in a single pass.
+
+    Messages are split at paragraph, line, sentence and word boundaries, in this order of preference. Markdown is
+    tracked the way pyrogram parses it: a split inside a formatting span or a code block closes it at the end of the
+    message and reopens it (with the code block language) at the start of the next one, so every message renders
+    the same as its part of the whole text would. Links are never split, unless one can't fit in a message at all.
+    A span left open to the end of the text (e.g. a lone `--`) is closed at the end of every message but the last, as
+    it's only known to never close once the whole text is seen.
+
+    Text can be fed in pieces as it's streamed: `chunks` are complete messages which won't change, `pending` is the
+    text of the message being written.
+    """
+
+    def __init__(self, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH):
+        if limit < MIN_LIMIT:
+            raise ValueError(f"limit must be at least {MIN_LIMIT}")
+        self._limit = limit
+        self.chunks: typing.List[str] = []
+
+        self._buffer = ""
+        # Start of the message being written, and the spans reopened at its start
+        self._start = 0
+        self._start_units = 0
+        self._prefix = ""
+        self._prefix_units = 0
+        # Everything before `_scanned` is tokenized
+        self._scanned = 0
+        self._scanned_units = 0
+        # End of the last token, the text after it is split like plain text
+        self._words_from = 0
+        self._words_from_units = 0
+        self._spans: Spans = ()
+        # The spans closed and reopened at a split point. With a small limit the markup of the spans may leave no
+        # room for text, then they are split as plain text instead: every message takes at least one character.
+        self._carried: Spans = ()
+        self._fixed_width = False
+        # The latest split point of every kind, split points inside spans are kept apart as less preferred
+        self._points: typing.Dict[typing.Tuple[int, bool], _SplitPoint] = {}
+
+    def feed(self, text: str):
+        if self._start > len(self._buffer) // 2:
+            self._rebase()
+        self._buffer += text
+        self._scan(self._safe_end(), final=False)
+
+    def pending(self) -> str:
+        return self._prefix + self._buffer[self._start:]
+
+    def finish(self) -> typing.List[str]:
+        """
+        Splits the rest of the text, returns every message. Nothing can be fed afterwards.
+        """
+        self._scan(len(self._buffer), final=True)
+        if self._buffer[self._start:].strip():
+            self.chunks.append(self.pending())
+        return self.chunks
+
+    def _safe_end(self) -> int:
+        """
+        Returns the end of the text which is tokenized the same way whatever is appended to it.
+        """
+        end = len(self._buffer) - _HOLD_BACK
+        # a link can't span lines, so a `[` on the last line may still start one
+        last_line = self._buffer.rfind("\n", self._scanned) + 1
+        bracket = self._buffer.find("[", max(last_line, self._scanned))
+        if bracket >= 0:
+            end = min(end, bracket)
+        # and a run of newlines may still grow into a paragraph break
+        while end > self._scanned and self._buffer[end - 1] in "\n ":
+            end -= 1
+        return end
+
+    def _scan(self, end: int, final: bool):
+        # text up to `stop` is tokenized, the rest waits for more text
+        stop = end
+        for match in _TOKENS.finditer(self._buffer, self._scanned):
+            token_start, token_end = match.span()
+            delimiter, newlines = match.group(1), match.group(2)
+            if token_end > end or (delimiter == _PRE and not final and self._buffer.find("\n", token_end) < 0
+                                   and _LANGUAGE.fullmatch(self._buffer, token_end)):
+                # the language of a code block is the rest of its first line
+                stop = min(token_start, end)
+                break
+            if match.group(0)[0] == "[" and utf16_length(match.group(0)) + _markup_units(self._carried) > self._limit:
+                # a link which doesn't fit in any message is split as plain text
+                continue
+
+            units = self._scanned_units + utf16_length(self._buffer[self._scanned:token_start])
+            self._add_word_point(token_start)
+            spans_before = self._carried
+            self._fit(token_start, units, spans_before, hard_cut_from=self._words_from)
+            if delimiter is not None:
+                self._toggle(delimiter, token_end)
+            elif newlines is not None:
+                kind = _PARAGRAPH if len(newlines) > 1 else _LINE
+                self._add_point(kind, token_start, token_end, units, units + len(newlines))
+            elif token_end - token_start == 1:
+                # a sentence end, the space after it is dropped
+                self._add_point(_SENTENCE, token_end, token_end + 1, units + 1, units + 2)
+
+            token_units = units + utf16_length(match.group(0))
+            self._scanned, self._scanned_units = token_end, token_units
+            # a token is never split: if it doesn't fit, the message ends before it
+            self._fit(token_end, token_units, self._carried,
+                      hard_cut=_SplitPoint(_ANYWHERE, token_start, token_start, units, units, spans_before))
+            self._words_from, self._words_from_units = token_end, token_units
+
+        # and so is the text after the last token, so a stream without tokens is split as it arrives
+        if stop > self._scanned:
+            units = self._scanned_units + utf16_length(self._buffer[self._scanned:stop])
+            self._add_word_point(stop)
+            self._fit(stop, units, self._carried, hard_cut_from=self._words_from)
+            self._scanned, self._scanned_units = stop, units
+
+    def _toggle(self, delimiter: str, token_end: int):
+        # same rules as pyrogram: nothing but code delimiters counts within code
+        if delimiter in _FIXED_WIDTH:
+            self._fixed_width = not self._fixed_width
+        elif self._fixed_width:
+            return
+        opened = [span for span in self._spans if span[0] != delimiter]
+        if len(opened) == len(self._spans):
+            language = ""
+            if delimiter == _PRE:
+                line_end = self._buffer.find("\n", token_end)
+                language = self._buffer[token_end:line_end if line_end >= 0 else len(self._buffer)]
+                if not _LANGUAGE.fullmatch(language):
+                    language = ""
+            opened.append((delimiter, language))
+        self._spans = tuple(opened)
+        self._carried = self._spans if _markup_units(self._spans) <= (self._limit - 2) // 2 else ()
+
+    def _add_word_point(self, end: int):
+        space = self._buffer.rfind(" ", self._scanned, end)
+        if space <= self._start:
+            return
+        units = self._scanned_units + utf16_length(self._buffer[self._scanned:space])
+        # the new word split point replaces the previous one, which has to be used first if the text up to the new
+        # one doesn't fit
+        self._fit(space, units, self._carried, hard_cut_from=self._words_from)
+        if space > self._start:
+            self._add_point(_WORD, space, space + 1, units, units + 1)
+
+    def _add_point(self, kind: int, end: int, resume: int, end_units: int, resume_units: int):
+        spans = self._carried
+        self._points[(kind, not spans)] = _SplitPoint(kind, end, resume, end_units, resume_units, spans)
+
+    def _length(self, point: _SplitPoint) -> int:
+        return self._prefix_units + point.end_units - self._start_units + _closing_units(point.spans)
+
+    def _fit(self, end: int, end_units: int, spans: Spans, hard_cut_from: int = -1,
+             hard_cut: typing.Optional[_SplitPoint] = None):
+        """
+        Ends messages until the text up to `end` fits in the message being written. When no split point fits,
+        the message is cut at `hard_cut`, or as late as possible after `hard_cut_from`.
+        """
+        while self._prefix_units + end_units - self._start_units + _closing_units(spans) > self._limit:
+            fitting = [p for p in self._points.values() if p.end > self._start and self._length(p) <= self._limit]
+            if hard_cut_from >= 0:
+                # only the last space before a token is kept as a split point, the last one that fits is as good
+                # whether the text came at once or in pieces
+                cut = self._cut_anywhere(max(hard_cut_from, self._start), end, spans)
+                if cut.kind == _WORD and self._length(cut) <= self._limit:
+                    fitting.append(cut)
+            best = next((p for p in sorted(fitting, key=lambda p: (p.kind, bool(p.spans), -p.end))
+                         if self._length(p) >= _MIN_FILL * self._limit), None)
+            if best is None and fitting:
+                best = max(fitting, key=lambda p: p.end)
+            if best is None and hard_cut is not None and hard_cut.end > self._start:
+                # a split above may have left more spans to reopen than there was when `hard_cut` was made
+                best = hard_cut if self._length(hard_cut) <= self._limit \
+                    else self._cut_anywhere(max(self._words_from, self._start), hard_cut.end, hard_cut.spans)
+            if best is None:
+                best = self._cut_anywhere(max(hard_cut_from, self._start), end, spans)
+            self._split(best)
+
+    def _cut_anywhere(self, start: int, end: int, spans: Spans) -> _SplitPoint:
+        """
+        Returns the split point at the last space that fits, or right where the limit is reached. Only called for
+        text without tokens between `start` and `end`, so the spans are the same all the way. `start` is either the
+        start of the message or the end of the last token.
+        """
+        units = self._start_units if start == self._start else self._words_from_units
+        budget = self._limit - self._prefix_units - (units - self._start_units) - _closing_units(spans)
+        if budget < 0:
+            # a split made the spans reopened at the start take the room of the text before `start`, which can't be
+            # split anywhere else: the tokens in it are cut as well
+            start, units = self._start, self._start_units
+            budget = self._limit - self._prefix_units - _closing_units(spans)
+        cut = _utf16_prefix(self._buffer, start, end, max(budget, 0))
+        if cut <= self._start:
+            # the limit is too small for the spans to fit, make progress anyway
+            cut = self._start + 1
+        cut_units = units + utf16_length(self._buffer[start:cut])
+        space = self._buffer.rfind(" ", start, min(cut + 1, end))
+        if space > self._start:
+            space_units = cut_units - utf16_length(self._buffer[space:cut])
+            return _SplitPoint(_WORD, space, space + 1, space_units, space_units + 1, spans)
+        return _SplitPoint(_ANYWHERE, cut, cut, cut_units, cut_units, spans)
+
+    def _split(self, point: _SplitPoint):
+        body = self._buffer[self._start:point.end]
+        if body.strip():
+            self.chunks.append(self._prefix + body + _closing(point.spans))
+        self._start, self._start_units = point.resume, point.resume_units
+        self._prefix = _opening(point.spans)
+        self._prefix_units = utf16_length(self._prefix)
+        self._points = {key: p for key, p in self._points.items() if p.end > self._start}
+
+    def _rebase(self):
+        """
+        Drops the text of finished messages, so a long stream doesn't keep all of it.
+        """
+        # the message may start right after the scanned text, past a dropped space
+        shift = min(self._start, self._scanned)
+        shift_units = self._start_units if shift == self._start else self._scanned_units
+        self._buffer = self._buffer[shift:]
+        self._start -= shift
+        self._start_units -= shift_units
+        self._scanned -= shift
+        self._scanned_units -= shift_units
+        if self._words_from < shift:
+            # only used from the start of the message on
+            self._words_from, self._words_from_units = shift, shift_units
+        self._words_from -= shift
+        self._words_from_units -= shift_units
+        for p in self._points.values():
+            p.end, p.resume = p.end - shift, p.resume - shift
+            p.end_units, p.resume_units = p.end_units - shift_units, p.resume_units - shift_units
+
+
+def split_if_large_message(message: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> typing.List[str]:
     """
-    Splits messages in chunks of size `TELEGRAM_MAX_MESSAGE_LENGTH`
+    Splits a message in chunks of at most `limit` UTF-16 code units, see `MessageSplitter`.
     """
-    return [message[i:i + TELEGRAM_MAX_MESSAGE_LENGTH] for i in
-            range(0, len(message), TELEGRAM_MAX_MESSAGE_LENGTH)]
+    splitter = MessageSplitter(limit)
+    splitter.feed(message)
+    return splitter.finish()